@@ -0,0 +1,158 @@
+"""Keyset-paginated browsing of BigQuery tables for the dashboard.
+
+Pages are fetched on demand with ``WHERE (order_column, id) < cursor``
+instead of OFFSET, so page N costs the same as page 1. The page after the
+one being shown is prefetched on a thread of one process-wide pool, and
+only the most recently used pages are kept in memory. With a
+``query_builder.Scope`` the pages are restricted to that athlete and date
+range. Rows whose order column is NULL can't be placed by a cursor and are
+not listed.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import pandas as pd
+import streamlit as st
+from google.cloud import bigquery
+
+import bq_arrow
+import query_builder
+
+PAGE_SIZES = [25, 50, 100, 200]
+MAX_CACHED_PAGES = 8
+# Threads prefetching next pages, shared by every pager in the process
+PREFETCH_WORKERS = 4
+
+
+@st.cache_resource
+def get_prefetch_executor() -> ThreadPoolExecutor:
+    """One pool for all sessions and reruns, instead of a thread per pager that is never shut down."""
+    return ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="pager-prefetch")
+
+
+class KeysetPager:
+    """Pages through ``table`` ordered by ``(order_column DESC, id DESC)``."""
+
+    def __init__(self, client: bigquery.Client, table: str, columns, order_column: str,
+                 page_size: int = 50, version=None, scope: query_builder.Scope = None):
+        self.client = client
+        self.table = table
+        self.columns = list(columns)
+        self.order_column = order_column
+        self.page_size = page_size
+        self.version = version
+        self.scope = scope
+        self.bytes_processed = 0
+        # cursors[i] is the (order value, id) of the last row before page i
+        self.cursors = {0: None}
+        self.pages = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = get_prefetch_executor()
+
+    def _fetch(self, cursor) -> pd.DataFrame:
+        conditions = [f"{self.order_column} IS NOT NULL"]
+        params = [bigquery.ScalarQueryParameter('page_size', 'INT64', self.page_size)]
+        if self.scope is not None:
+            conditions.append(query_builder.where())
+            scope_params = self.scope.params
+            params += [
+                bigquery.ScalarQueryParameter('athlete_id', 'INT64', scope_params['athlete_id']),
+                bigquery.ScalarQueryParameter('scope_start', 'TIMESTAMP', scope_params['scope_start']),
+                bigquery.ScalarQueryParameter('scope_end', 'TIMESTAMP', scope_params['scope_end']),
+            ]
+        if cursor is not None:
+            conditions.append(f"""({self.order_column} < @cursor_value
+               OR ({self.order_column} = @cursor_value AND id < @cursor_id))""")
+            params += [
+                bigquery.ScalarQueryParameter('cursor_value', 'TIMESTAMP', cursor[0]),
+                bigquery.ScalarQueryParameter('cursor_id', 'INT64', int(cursor[1])),
+            ]
+        query = f"""
+        SELECT {', '.join(self.columns)}
+        FROM `{self.table}`
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {self.order_column} DESC, id DESC
+        LIMIT @page_size
+        """
+        page, job = bq_arrow.query_to_frame(self.client, query, job_config=bigquery.QueryJobConfig(query_parameters=params))
+        with self.lock:
+            self.bytes_processed += job.total_bytes_processed or 0
+        return page
+
+    def _remember(self, index: int, page: pd.DataFrame) -> None:
+        with self.lock:
+            self.pages[index] = page
+            self.pages.move_to_end(index)
+            while len(self.pages) > MAX_CACHED_PAGES:
+                self.pages.popitem(last=False)
+            if len(page) == self.page_size:
+                last = page.iloc[-1]
+                self.cursors[index + 1] = (last[self.order_column], last['id'])
+
+    def _load(self, index: int) -> pd.DataFrame:
+        page = self._fetch(self.cursors[index])
+        self._remember(index, page)
+        return page
+
+    def _prefetch(self, index: int) -> None:
+        with self.lock:
+            if index in self.pages or index in self.pending or index not in self.cursors:
+                return
+            self.pending[index] = self.executor.submit(self._load, index)
+
+    def page(self, index: int) -> pd.DataFrame:
+        """Return page ``index``; earlier pages must have been visited to know its cursor."""
+        with self.lock:
+            cached = self.pages.get(index)
+            if cached is not None:
+                self.pages.move_to_end(index)
+            future = self.pending.pop(index, None)
+        if cached is None:
+            cached = future.result() if future is not None else self._load(index)
+        self._prefetch(index + 1)
+        return cached
+
+    def has_next(self, index: int) -> bool:
+        return index + 1 in self.cursors
+
+
+def render_pager(key: str, client: bigquery.Client, table: str, columns, order_column: str, version=None,
+                 scope: query_builder.Scope = None, stats: dict = None) -> None:
+    """Render a paginated table with page-size and previous/next controls.
+
+    ``stats`` (see ``query_builder.view_stats``) accumulates the bytes processed by page fetches.
+    """
+    state = st.session_state
+    page_size = st.selectbox("Rows per page", PAGE_SIZES, index=1, key=f"{key}_page_size")
+
+    pager = state.get(f"{key}_pager")
+    if pager is None or pager.page_size != page_size or pager.version != version or pager.scope != scope:
+        # New data, a new scope or a new page size invalidates every cursor
+        pager = KeysetPager(client, table, columns, order_column, page_size=page_size, version=version, scope=scope)
+        state[f"{key}_pager"] = pager
+        state[f"{key}_page"] = 0
+
+    index = state.get(f"{key}_page", 0)
+    bytes_before = pager.bytes_processed
+    page = pager.page(index)
+    if stats is not None:
+        stats['queries'] += 1
+        stats['cached'] += int(pager.bytes_processed == bytes_before)
+        stats['bytes_processed'] += pager.bytes_processed - bytes_before
+
+    previous_col, label_col, next_col = st.columns([1, 2, 1])
+    with previous_col:
+        if st.button("◀ Previous", key=f"{key}_prev", disabled=index == 0):
+            state[f"{key}_page"] = index - 1
+            st.rerun()
+    with label_col:
+        first = index * page_size + 1
+        st.markdown(f"Page {index + 1} · rows {first}–{first + len(page) - 1}")
+    with next_col:
+        if st.button("Next ▶", key=f"{key}_next", disabled=not pager.has_next(index)):
+            state[f"{key}_page"] = index + 1
+            st.rerun()
+
+    st.dataframe(page)
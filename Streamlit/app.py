@@ -7,12 +7,23 @@ Original file is located at
     https://colab.research.google.com/drive/1AEEWgCUNkVPdUV905PqVG_8_re3RL9T8
 """
 
+import time
+_run_started = time.perf_counter()
+
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-from google.cloud import bigquery
-import vertexai
-from vertexai.generative_models import GenerativeModel, ChatSession
+import startup_profiler
+import query_cache
+import query_builder
+import chat_context
+import activity_pager
+import scatter_lod
+import similar_runs
+import chat_stream
+import response_cache
+
+# Plotly and Vertex AI are imported lazily by the tabs that need them
+startup_profiler.mark_run_start(_run_started)
 
 # Page configuration
 st.set_page_config(
@@ -128,84 +139,104 @@ if st.sidebar.button("🔮 ML Predictions", key="ml_predictions_button"):
 
 st.sidebar.markdown("</div>", unsafe_allow_html=True)
 
-# Initialize Vertex AI
+# Every view below is scoped to one athlete and date range
+scope = query_builder.select_scope()
+if scope is None:
+    st.info("No athlete data yet. Connect a Strava account and wait for the first ETL run.")
+    st.stop()
+
+# Vertex AI settings
 GCP_PROJECT = 'strava-etl'
 GCP_REGION = "us-central1"
-vertexai.init(project=GCP_PROJECT, location=GCP_REGION)
-
-model = GenerativeModel("gemini-1.5-flash-002")
-chat_session = model.start_chat(response_validation=False)
-
-# Function to fetch Strava data from BigQuery
-def get_strava_data():
-    query = """
-    SELECT *
-    FROM `strava-etl.strava_data.activities`
-    WHERE start_date_local >= '2024-01-01'
-    ORDER BY start_date_local DESC
-    LIMIT 50
-    """
-    client = bigquery.Client(project=GCP_PROJECT, location="US")
-    query_job = client.query(query)
-    result = query_job.result()
-
-    data = pd.DataFrame([dict(row.items()) for row in result])
-    return data
-
-# Function to fetch ML predictions from BigQuery
-def get_ml_predictions():
-    query = """
+CHAT_MODEL = "gemini-1.5-flash-002"
+
+# Process-wide: initialise Vertex AI and build the model once, on first use
+@st.cache_resource
+def get_chat_model():
+    vertexai = startup_profiler.timed_import("vertexai")
+    generative_models = startup_profiler.timed_import("vertexai.generative_models")
+    with startup_profiler.timed("vertexai.init"):
+        vertexai.init(project=GCP_PROJECT, location=GCP_REGION)
+    with startup_profiler.timed("GenerativeModel"):
+        return generative_models.GenerativeModel(CHAT_MODEL)
+
+# Session-scoped: each browser session keeps its own chat history
+def get_chat_session():
+    if "chat_session" not in st.session_state:
+        with startup_profiler.timed("start_chat"):
+            st.session_state.chat_session = get_chat_model().start_chat(response_validation=False)
+    return st.session_state.chat_session
+
+ACTIVITIES_TABLE = "strava-etl.strava_data.activities"
+CLUSTERING_LABELS_TABLE = "strava-etl.strava_data.clustering_labels"
+ROLLUPS_DAILY_TABLE = "strava-etl.strava_data.athlete_rollups_daily"
+
+# Columns shown in the paginated browsers
+ACTIVITY_BROWSER_COLUMNS = [
+    'id', 'name', 'sport_type', 'start_date_local', 'distance', 'moving_time',
+    'average_speed', 'average_heartrate', 'calories', 'total_elevation_gain', 'kudos_count',
+]
+PREDICTION_BROWSER_COLUMNS = ['id', 'start_date', 'distance', 'moving_time', 'average_heartrate', 'run_type_str']
+
+# Function to fetch every labeled run for the 3D scatter (reduced by scatter_lod before plotting)
+def get_scatter_points(scope):
+    query = f"""
     SELECT id, start_date, distance, moving_time, average_heartrate, run_type_str
-    FROM `strava-etl.strava_data.clustering_labels`
-    ORDER BY start_date DESC
-    LIMIT 50
+    FROM {query_builder.scoped(CLUSTERING_LABELS_TABLE)}
+    WHERE distance IS NOT NULL AND moving_time IS NOT NULL AND average_heartrate IS NOT NULL
     """
-    client = bigquery.Client(project=GCP_PROJECT, location="US")
-    query_job = client.query(query)
-    result = query_job.result()
-
-    predictions = pd.DataFrame([dict(row.items()) for row in result])
-    return predictions
-
-# Function to get chat response from Vertex AI
-def get_chat_response(chat: ChatSession, prompt: str, dataset: pd.DataFrame) -> str:
-    dataset_sample = dataset.head(50).to_dict(orient='records')
+    return query_builder.run_scoped(query, scope, tables=[CLUSTERING_LABELS_TABLE], label="scatter_points")
+
+# Function to read KPIs for the selected range from the daily rollup table maintained by the ETL flow
+def get_kpis(scope):
+    query = f"""
+    SELECT
+      SUM(activities) AS total_activities,
+      SUM(total_distance) AS total_distance,
+      SAFE_DIVIDE(SUM(total_distance), SUM(activities)) AS average_distance,
+      SUM(total_calories) AS total_calories,
+      SAFE_DIVIDE(SUM(speed_sum), SUM(speed_count)) AS average_speed,
+      MAX(max_average_speed) AS max_average_speed,
+      MAX(max_calories) AS max_calories,
+      SAFE_DIVIDE(SUM(heartrate_sum), SUM(heartrate_count)) AS average_heartrate,
+      SUM(total_moving_time) AS total_moving_time
+    FROM {query_builder.scoped(ROLLUPS_DAILY_TABLE, date_column='day', date_type='DATE')}
+    """
+    kpis = query_builder.run_scoped(query, scope, tables=[ROLLUPS_DAILY_TABLE], label="kpis")
+    return {name: (value if pd.notna(value) else 0) for name, value in kpis.iloc[0].items()}
 
+# Function to stream a chat response from Vertex AI
+def get_chat_response(chat, prompt: str, context: str) -> chat_stream.ChatStream:
     dataset_summary = f"""
-    Here are the first 50 rows of your Strava data:
-    {dataset_sample}
+    {context}
     You can ask me questions about trends, gear usage, total distance, or any specific activity.
     """
 
     full_prompt = f"{dataset_summary}\n\nQuestion: {prompt}"
 
-    text_response = []
-    responses = chat.send_message(full_prompt, stream=True)
-    for chunk in responses:
-        text_response.append(chunk.text)
-
-    return "".join(text_response)
+    return chat_stream.ChatStream(chat.send_message(full_prompt, stream=True))
 
 # Main Navigation and Content Rendering
 if st.session_state.active_tab == "Data Overview":
     st.title("📊 Data Overview")
+    view_stats = query_builder.start_view("Data Overview")
     try:
-        strava_data_df = get_strava_data()
-
         # Create and display visual statistics (KPI-style)
         st.subheader("Summary Statistics (KPIs)")
+        st.caption(f"Totals for {scope.describe()}, from the daily rollup table.")
 
         # Prepare data for the KPIs
+        kpis = get_kpis(scope)
         stats = {
-            "Total Activities": len(strava_data_df),
-            "Total Distance (meters)": strava_data_df['distance'].sum(),
-            "Average Distance (meters)": strava_data_df['distance'].mean(),
-            "Total Calories Burned": strava_data_df['calories'].sum(),
-            "Average Speed (m/s)": strava_data_df['average_speed'].mean(),
-            "Max Speed (m/s)": strava_data_df['average_speed'].max(),
-            "Max Calories Burned": strava_data_df['calories'].max(),
-            "Average Heart Rate (bpm)": strava_data_df['average_heartrate'].mean(),
-            "Total Moving Time (seconds)": strava_data_df['moving_time'].sum(),
+            "Total Activities": kpis['total_activities'],
+            "Total Distance (meters)": kpis['total_distance'],
+            "Average Distance (meters)": kpis['average_distance'],
+            "Total Calories Burned": kpis['total_calories'],
+            "Average Speed (m/s)": kpis['average_speed'],
+            "Max Speed (m/s)": kpis['max_average_speed'],
+            "Max Calories Burned": kpis['max_calories'],
+            "Average Heart Rate (bpm)": kpis['average_heartrate'],
+            "Total Moving Time (seconds)": kpis['total_moving_time'],
         }
 
         # Display the KPIs in card format
@@ -286,65 +317,96 @@ if st.session_state.active_tab == "Data Overview":
                 </div>
             """, unsafe_allow_html=True)
 
-        # Display the dataframe
-        st.subheader("Recent Strava Activities")
-        st.dataframe(strava_data_df)
+        # Browse the full activity history page by page
+        st.subheader("Strava Activities")
+        client = query_cache.get_bigquery_client()
+        activity_pager.render_pager(
+            "activities", client, ACTIVITIES_TABLE, ACTIVITY_BROWSER_COLUMNS, "start_date_local",
+            version=query_cache.get_query_cache().data_version(client, [ACTIVITIES_TABLE]),
+            scope=scope, stats=view_stats,
+        )
+        query_builder.render_view_stats()
 
     except Exception as e:
         st.error(f"An error occurred: {e}")
 
 elif st.session_state.active_tab == "Chatbot":
     st.title("🤖 Chatbot")
+    query_builder.start_view("Chatbot")
+    if st.session_state.get("chat_scope") != scope:
+        # An answer about another athlete or range must not be shown again
+        st.session_state.chat_scope = scope
+        st.session_state.pop("chat_last", None)
     st.subheader("Ask the Chatbot")
     prompt = st.text_input("Ask a question about your Strava data:")
+    bypass_cache = st.checkbox("Bypass response cache", key="bypass_response_cache",
+                               help="Always ask the model, even if this question was answered for the current data.")
     try:
-        strava_data_df = get_strava_data()
+        context = chat_context.get_context(scope)
         if prompt:
-            response = get_chat_response(chat_session, prompt, strava_data_df)
-            st.markdown(f"**Chatbot Response:** {response}")
-        st.markdown("**Note**: The chatbot can only answer questions based on the last 50 runs.")
+            # Reruns (other widgets, Stop) show the stored answer instead of asking again
+            answer = chat_stream.last_answer(prompt)
+            if answer is None or (bypass_cache and answer.get('source')):
+                responses = response_cache.get_response_cache()
+                version = (chat_context.data_version(), scope)
+                cached, kind, score = (None, None, 0.0) if bypass_cache else responses.lookup(prompt, version)
+                if cached is not None:
+                    source = ("⚡ Answered from cache" if kind == 'exact'
+                              else f"⚡ Answered from cache: similar to \"{cached['prompt']}\" ({score:.2f})")
+                    answer = chat_stream.remember_answer(prompt, cached['answer'], source)
+                    chat_stream.render_answer(answer)
+                else:
+                    answer = chat_stream.render_stream(get_chat_response(get_chat_session(), prompt, context), prompt)
+                    if not answer['cancelled'] and answer['text']:
+                        responses.put(prompt, version, answer['text'])
+            else:
+                chat_stream.render_answer(answer)
+        st.markdown("**Note**: The chatbot answers from a summary of the selected date range plus your most recent activities in it.")
+
+        # The old 50-row size is measured once per data version and scope, not on every rerun
+        context_tokens = chat_context.estimate_tokens(context)
+        legacy_tokens = chat_context.legacy_prompt_tokens(scope)
+        savings = 1 - context_tokens / legacy_tokens if legacy_tokens else 0
+        st.caption(f"Context: ~{context_tokens} tokens per prompt (budget {chat_context.TOKEN_BUDGET}) "
+                   f"vs ~{legacy_tokens} for 50 raw rows ({savings:.0%} saved).")
+        query_builder.render_view_stats()
     except Exception as e:
         st.error(f"An error occurred: {e}")
 
 elif st.session_state.active_tab == "ML Predictions":
     st.title("🔮 ML Predictions")
+    view_stats = query_builder.start_view("ML Predictions")
     
     # Display 3D scatter plot before the data table
     st.subheader("3D Scatter Plot: Distance vs Moving Time vs Average Heart Rate")
     try:
-        ml_predictions_df = get_ml_predictions()
-
-        # Create a 3D scatter plot with adjusted size
-        fig = px.scatter_3d(
-            ml_predictions_df,
-            x='distance',
-            y='moving_time',
-            z='average_heartrate',
-            color='run_type_str',
-            title='3D Scatter Plot of Runs',
-            labels={
-                'distance': 'Distance (m)',
-                'moving_time': 'Moving Time (s)',
-                'average_heartrate': 'Average Heart Rate (bpm)'
-            }
-        )
-        
-        # Update layout with larger dimensions
-        fig.update_layout(
-            height=600,
-            width=1200,
-            margin=dict(l=50, r=50, b=50, t=50)
-        )
-
-        st.plotly_chart(fig)
+        # Every labeled run, reduced to a bounded number of markers before it reaches the browser
+        scatter_lod.render_scatter(get_scatter_points(scope), key="ml_scatter")
 
         # Display the dataframe below the chart
         st.subheader("Clustering Labels and Analysis")
-        st.dataframe(ml_predictions_df)
+        client = query_cache.get_bigquery_client()
+        activity_pager.render_pager(
+            "predictions", client, CLUSTERING_LABELS_TABLE, PREDICTION_BROWSER_COLUMNS, "start_date",
+            version=query_cache.get_query_cache().data_version(client, [CLUSTERING_LABELS_TABLE]),
+            scope=scope, stats=view_stats,
+        )
+
+        # Nearest runs to a picked run, from the scope's in-process KD-tree index
+        st.subheader("Similar Runs")
+        similar_runs.render_panel(scope, key="similar_runs")
+        query_builder.render_view_stats()
 
     except Exception as e:
         st.error(f"An error occurred: {e}")
 
+query_cache.render_debug_panel()
+chat_stream.render_debug_panel()
+response_cache.render_debug_panel()
+startup_profiler.render_panel()
+
 # Footer
 st.sidebar.markdown("---")
 st.sidebar.markdown("Your Strava Journey, Visualized | Powered by Streamlit and Strava Data | Team 4: Bennett Blanco | Yu-Chin (Alyssa) Chen | Dhruv Shah | Ahmed Farid Khan")
+
+startup_profiler.mark_run_end()
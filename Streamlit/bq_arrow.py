@@ -0,0 +1 @@
+../cloud_functions/common/bq_arrow.py
\ No newline at end of file
@@ -0,0 +1,188 @@
+"""Compact, token-budgeted chatbot context built from the athlete's whole history.
+
+Instead of pasting every column of 50 raw rows into each prompt, the context
+is a handful of small tables (totals, per-sport aggregates, personal bests,
+weekly volume and a few recent runs with only the columns that matter).
+It is scoped to the selected athlete and date range, built once per data
+version and scope, and reused across prompts.
+"""
+import threading
+
+import pandas as pd
+import streamlit as st
+
+import query_cache
+import query_builder
+
+ACTIVITIES_TABLE = "strava-etl.strava_data.activities"
+
+# Rough token budget for the whole context block
+TOKEN_BUDGET = 1500
+# Crude but stable estimate used for budgeting and reporting
+CHARS_PER_TOKEN = 4
+
+WEEKS_OF_HISTORY = 26
+RECENT_RUNS = 15
+
+TOTALS_SQL = """
+SELECT
+  COUNT(*) AS activities,
+  ROUND(SUM(distance) / 1000, 1) AS total_km,
+  ROUND(SUM(moving_time) / 3600, 1) AS total_hours,
+  ROUND(SUM(calories)) AS total_calories,
+  DATE(MIN(start_date_local)) AS first_activity,
+  DATE(MAX(start_date_local)) AS last_activity
+FROM {activities}
+"""
+
+SPORT_SQL = """
+SELECT
+  sport_type,
+  COUNT(*) AS activities,
+  ROUND(SUM(distance) / 1000, 1) AS km,
+  ROUND(SUM(moving_time) / 3600, 1) AS hours,
+  ROUND(AVG(average_speed), 2) AS avg_speed_ms,
+  ROUND(AVG(average_heartrate)) AS avg_hr,
+  ROUND(SUM(total_elevation_gain)) AS elev_gain_m
+FROM {activities}
+GROUP BY sport_type
+ORDER BY activities DESC
+"""
+
+WEEKLY_SQL = f"""
+SELECT
+  DATE_TRUNC(DATE(start_date_local), WEEK(MONDAY)) AS week,
+  COUNT(*) AS activities,
+  ROUND(SUM(distance) / 1000, 1) AS km,
+  ROUND(SUM(moving_time) / 3600, 1) AS hours,
+  ROUND(AVG(average_heartrate)) AS avg_hr
+FROM {{activities}}
+GROUP BY week
+ORDER BY week DESC
+LIMIT {WEEKS_OF_HISTORY}
+"""
+
+BESTS_SQL = """
+WITH ranked AS (
+  SELECT
+    sport_type, name, DATE(start_date_local) AS date,
+    ROUND(distance / 1000, 2) AS km, moving_time, ROUND(average_speed, 2) AS avg_speed_ms,
+    ROW_NUMBER() OVER (PARTITION BY sport_type ORDER BY distance DESC) AS by_distance,
+    ROW_NUMBER() OVER (PARTITION BY sport_type ORDER BY moving_time DESC) AS by_time,
+    ROW_NUMBER() OVER (PARTITION BY sport_type ORDER BY IF(distance >= 1000, average_speed, NULL) DESC) AS by_speed
+  FROM {activities}
+)
+SELECT sport_type, 'longest' AS record, name, date, km, moving_time, avg_speed_ms FROM ranked WHERE by_distance = 1
+UNION ALL
+SELECT sport_type, 'longest_time', name, date, km, moving_time, avg_speed_ms FROM ranked WHERE by_time = 1
+UNION ALL
+SELECT sport_type, 'fastest_1km_plus', name, date, km, moving_time, avg_speed_ms FROM ranked WHERE by_speed = 1
+ORDER BY sport_type, record
+"""
+
+RECENT_SQL = f"""
+SELECT
+  DATE(start_date_local) AS date, name, sport_type,
+  ROUND(distance / 1000, 2) AS km, moving_time,
+  ROUND(average_speed, 2) AS avg_speed_ms, ROUND(average_heartrate) AS avg_hr,
+  ROUND(calories) AS calories, ROUND(total_elevation_gain) AS elev_gain_m
+FROM {{activities}}
+ORDER BY start_date_local DESC
+LIMIT {RECENT_RUNS}
+"""
+
+# What the chatbot used to send: every column of the 50 latest rows
+LEGACY_SQL = """
+SELECT *
+FROM {activities}
+ORDER BY start_date_local DESC
+LIMIT 50
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _table(title: str, df: pd.DataFrame) -> str:
+    """Render a frame as a compact pipe-separated table."""
+    if df.empty:
+        return f"{title}: none"
+    lines = [f"{title}:", "|".join(df.columns)]
+    for row in df.itertuples(index=False):
+        lines.append("|".join("" if pd.isna(value) else str(value) for value in row))
+    return "\n".join(lines)
+
+
+def _fit(title: str, df: pd.DataFrame, budget_tokens: int) -> str:
+    """Render as many leading rows of ``df`` as fit within ``budget_tokens``."""
+    for rows in range(len(df), 0, -1):
+        text = _table(title, df.head(rows))
+        if estimate_tokens(text) <= budget_tokens:
+            return text
+    return ""
+
+
+def build_context(scope: query_builder.Scope, token_budget: int = TOKEN_BUDGET) -> str:
+    """Build the context block, filling sections in priority order until the budget is spent."""
+    tables = [ACTIVITIES_TABLE]
+    activities = query_builder.scoped(ACTIVITIES_TABLE)
+
+    def run(sql, label):
+        return query_builder.run_scoped(sql.format(activities=activities), scope, tables, label=label)
+
+    sections = [
+        ("Totals", run(TOTALS_SQL, "chat_totals")),
+        ("By sport", run(SPORT_SQL, "chat_by_sport")),
+        ("Personal bests", run(BESTS_SQL, "chat_bests")),
+        ("Weekly volume (latest first)", run(WEEKLY_SQL, "chat_weekly")),
+        ("Recent activities", run(RECENT_SQL, "chat_recent")),
+    ]
+
+    parts = [f"Summary of the athlete's Strava history from {scope.start:%Y-%m-%d} to {scope.end:%Y-%m-%d} "
+             "(distances in km, times in seconds unless noted)."]
+    remaining = token_budget - estimate_tokens(parts[0])
+    for title, df in sections:
+        text = _fit(title, df, remaining)
+        if text:
+            parts.append(text)
+            remaining -= estimate_tokens(text)
+    return "\n\n".join(parts)
+
+
+@st.cache_resource
+def _context_store() -> dict:
+    return {'lock': threading.Lock(), 'by_version': {}}
+
+
+def data_version() -> tuple:
+    """Version of the data the context is built from; changes when the ETL writes."""
+    return query_cache.get_query_cache().data_version(query_cache.get_bigquery_client(), [ACTIVITIES_TABLE])
+
+
+def _per_version(kind: str, scope: query_builder.Scope, build):
+    """``build(scope)`` for the current data version, computed at most once per version, kind and scope."""
+    store = _context_store()
+    version = data_version()
+    with store['lock']:
+        if version not in store['by_version']:
+            # Values for older versions are dropped as soon as new data arrives
+            store['by_version'] = {version: {}}
+        values = store['by_version'][version]
+        if (kind, scope) not in values:
+            values[(kind, scope)] = build(scope)
+        return values[(kind, scope)]
+
+
+def get_context(scope: query_builder.Scope) -> str:
+    """Context for the current data version and ``scope``, built at most once per pair."""
+    return _per_version('context', scope, build_context)
+
+
+def legacy_prompt_tokens(scope: query_builder.Scope) -> int:
+    """Estimated size of the old context (the 50 latest rows as a Python repr), once per data version and scope."""
+    def build(scope):
+        sql = LEGACY_SQL.format(activities=query_builder.scoped(ACTIVITIES_TABLE))
+        dataset = query_builder.run_scoped(sql, scope, [ACTIVITIES_TABLE], label="chat_legacy_size")
+        return estimate_tokens(str(dataset.to_dict(orient='records')))
+    return _per_version('legacy', scope, build)
@@ -0,0 +1,134 @@
+"""Streaming chatbot answers into the dashboard.
+
+Chunks from ``chat.send_message(..., stream=True)`` are written to the page as
+they arrive, with time to first token and total generation time recorded per
+answer. Generation stops early when the user presses *Stop* or asks something
+new: either interaction reruns the script, which interrupts ``st.write_stream``,
+and the stream is then closed so the model response is abandoned.
+"""
+from collections import deque
+import statistics
+import threading
+import time
+
+import pandas as pd
+import streamlit as st
+
+_lock = threading.Lock()
+_history = deque(maxlen=20)  # timings of recent answers, across sessions
+
+
+class ChatStream:
+    """Iterates the text of a streamed model response while timing it."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.parts = []
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.finished = None
+        self.cancelled = False
+
+    def __iter__(self):
+        for chunk in self.responses:
+            text = chunk.text
+            if text and self.first_token is None:
+                self.first_token = time.perf_counter()
+            self.parts.append(text)
+            yield text
+        self.finished = time.perf_counter()
+
+    def close(self) -> None:
+        """Stop reading the response; a no-op once it has been read to the end."""
+        if self.finished is not None:
+            return
+        self.cancelled = True
+        self.finished = time.perf_counter()
+        close = getattr(self.responses, 'close', None)
+        if close is not None:
+            close()
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    @property
+    def stats(self) -> dict:
+        def ms(end):
+            return round((end - self.started) * 1000, 1) if end is not None else None
+        return {
+            'first_token_ms': ms(self.first_token),
+            'total_ms': ms(self.finished),
+            'chunks': len(self.parts),
+            'cancelled': self.cancelled,
+        }
+
+
+def _render_stats(answer: dict) -> None:
+    if answer.get('source'):
+        st.caption(answer['source'])
+    if answer['cancelled']:
+        st.caption("⏹ Generation stopped.")
+    timings = []
+    if answer['first_token_ms'] is not None:
+        timings.append(f"first token in {answer['first_token_ms']:.0f} ms")
+    if answer['total_ms'] is not None:
+        timings.append(f"{'stopped' if answer['cancelled'] else 'generated'} in {answer['total_ms'] / 1000:.1f} s")
+    if timings:
+        st.caption(" · ".join(timings).capitalize())
+
+
+def render_answer(answer: dict) -> None:
+    """Re-display an answer that was already generated in this session."""
+    st.markdown(f"**Chatbot Response:** {answer['text']}")
+    _render_stats(answer)
+
+
+def render_stream(stream: ChatStream, prompt: str, key: str = "chat") -> dict:
+    """Write ``stream`` to the page as it arrives and remember the answer in the session.
+
+    The answer (possibly partial) is stored under ``st.session_state[f"{key}_last"]`` even when
+    the run is interrupted, so the rerun that interrupted it does not ask the model again.
+    """
+    stop = st.empty()
+    stop.button("⏹ Stop generating", key=f"{key}_stop")
+    st.markdown("**Chatbot Response:**")
+    try:
+        st.write_stream(stream)
+    finally:
+        stream.close()
+        answer = {'prompt': prompt, 'text': stream.text, **stream.stats}
+        st.session_state[f"{key}_last"] = answer
+        with _lock:
+            _history.appendleft({'prompt': prompt[:60], **stream.stats})
+    stop.empty()
+    _render_stats(answer)
+    return answer
+
+
+def remember_answer(prompt: str, text: str, source: str, key: str = "chat") -> dict:
+    """Store an answer that did not come from the model (e.g. a cache hit) as the session's last answer."""
+    answer = {'prompt': prompt, 'text': text, 'first_token_ms': None, 'total_ms': None,
+              'chunks': 0, 'cancelled': False, 'source': source}
+    st.session_state[f"{key}_last"] = answer
+    return answer
+
+
+def last_answer(prompt: str, key: str = "chat"):
+    """The answer stored for ``prompt`` in this session, if it is the most recent one."""
+    answer = st.session_state.get(f"{key}_last")
+    return answer if answer is not None and answer['prompt'] == prompt else None
+
+
+def render_debug_panel() -> None:
+    """Sidebar panel with time-to-first-token and generation time of recent answers."""
+    with _lock:
+        history = list(_history)
+    with st.sidebar.expander("🛠 Debug: chat latency"):
+        first_tokens = [row['first_token_ms'] for row in history if row['first_token_ms'] is not None]
+        if first_tokens:
+            st.write(f"Median time to first token: {statistics.median(first_tokens):.0f} ms over {len(first_tokens)} answers")
+        if history:
+            st.dataframe(pd.DataFrame(history), hide_index=True)
+        else:
+            st.write("No answers generated yet.")
@@ -0,0 +1 @@
+../cloud_functions/common/feature_store.py
\ No newline at end of file
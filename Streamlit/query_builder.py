@@ -0,0 +1,134 @@
+"""Athlete- and date-scoped queries for the dashboard.
+
+Every dashboard query reads the shared tables through ``scoped()``, which
+filters on ``athlete_id`` and a date range. Filtering on the partitioning and
+clustering columns lets BigQuery prune what it scans, and keeps one athlete's
+view from showing everyone's data. ``run_scoped`` refuses SQL that is not
+filtered on the athlete.
+
+Bytes processed are accumulated per view (one tab of one script run) and shown
+under it with ``render_view_stats``.
+"""
+from datetime import date, datetime, time, timedelta, timezone
+from typing import NamedTuple
+import re
+
+import pandas as pd
+import streamlit as st
+
+import query_cache
+
+ATHLETES_TABLE = "strava-etl.strava_data.athlete_rollups_all_time"
+
+# Date range presets in the sidebar: label -> days back from today (None = the athlete's whole history)
+RANGE_PRESETS = {
+    "Last 30 days": 30,
+    "Last 90 days": 90,
+    "Last 12 months": 365,
+    "All time": None,
+}
+DEFAULT_PRESET = "Last 12 months"
+
+
+class Scope(NamedTuple):
+    athlete_id: int
+    start: date
+    end: date  # inclusive
+
+    @property
+    def params(self) -> dict:
+        """Query parameters referenced by ``where()``."""
+        return {
+            'athlete_id': self.athlete_id,
+            'scope_start': datetime.combine(self.start, time.min, tzinfo=timezone.utc),
+            'scope_end': datetime.combine(self.end + timedelta(days=1), time.min, tzinfo=timezone.utc),
+            'scope_start_day': self.start,
+            'scope_end_day': self.end,
+        }
+
+    def describe(self) -> str:
+        return f"athlete {self.athlete_id}, {self.start:%Y-%m-%d} to {self.end:%Y-%m-%d}"
+
+
+def where(date_column: str = 'start_date', date_type: str = 'TIMESTAMP') -> str:
+    """Filter on the scope's athlete and date range; ``date_type`` is 'TIMESTAMP' or 'DATE'."""
+    if date_type == 'DATE':
+        dates = f"{date_column} BETWEEN @scope_start_day AND @scope_end_day"
+    else:
+        dates = f"{date_column} >= @scope_start AND {date_column} < @scope_end"
+    return f"athlete_id = @athlete_id AND {dates}"
+
+
+def scoped(table: str, date_column: str = 'start_date', date_type: str = 'TIMESTAMP') -> str:
+    """``table`` restricted to the scope, for use in a FROM clause."""
+    return f"(SELECT * FROM `{table}` WHERE {where(date_column, date_type)})"
+
+
+def start_view(name: str) -> dict:
+    """Start accumulating query stats for the view rendered by this script run."""
+    st.session_state.view_stats = {'view': name, 'queries': 0, 'cached': 0, 'bytes_processed': 0}
+    return st.session_state.view_stats
+
+
+def view_stats() -> dict:
+    return st.session_state.get("view_stats") or start_view("dashboard")
+
+
+def run_scoped(sql: str, scope: Scope, tables, label: str = None, params=None) -> pd.DataFrame:
+    """Run ``sql`` with the scope's parameters through the query cache."""
+    if '@athlete_id' not in sql:
+        raise ValueError(f"Dashboard query {label or sql.strip().splitlines()[0]!r} is not filtered on athlete_id")
+    used = set(re.findall(r'@(\w+)', sql))
+    query_params = {name: value for name, value in scope.params.items() if name in used}
+    query_params.update(params or {})
+    return query_cache.run_query(sql, tables, params=query_params, label=label, stats=view_stats())
+
+
+def select_scope():
+    """Sidebar athlete and date range selectors; returns a Scope, or None when no athlete has data yet.
+
+    ``?athlete=<id>`` in the URL preselects an athlete and hides the selector.
+    """
+    athletes = query_cache.run_query(
+        f"SELECT athlete_id, first_day, last_day, activities FROM `{ATHLETES_TABLE}` ORDER BY activities DESC",
+        tables=[ATHLETES_TABLE], label="athletes",
+    )
+    if athletes.empty:
+        return None
+    athletes = athletes.set_index('athlete_id')
+
+    st.sidebar.markdown("---")
+    pinned = st.query_params.get("athlete")
+    if pinned is not None and pinned.isdigit() and int(pinned) in athletes.index:
+        athlete_id = int(pinned)
+        st.sidebar.markdown(f"**Athlete:** {athlete_id}")
+    else:
+        athlete_id = st.sidebar.selectbox(
+            "Athlete", list(athletes.index), key="scope_athlete",
+            format_func=lambda a: f"{a} ({athletes.loc[a, 'activities']} activities)",
+        )
+
+    preset = st.sidebar.radio("Date range", list(RANGE_PRESETS) + ["Custom"],
+                              index=list(RANGE_PRESETS).index(DEFAULT_PRESET), key="scope_preset")
+    first_day, last_day = athletes.loc[athlete_id, 'first_day'], athletes.loc[athlete_id, 'last_day']
+    today = date.today()
+    if preset == "Custom":
+        selected = st.sidebar.date_input("From – to", (today - timedelta(days=365), today), key="scope_dates")
+        if len(selected) != 2:
+            st.sidebar.caption("Pick an end date.")
+            selected = (selected[0], selected[0])
+        start, end = selected
+    elif RANGE_PRESETS[preset] is None:
+        start = first_day if pd.notna(first_day) else today
+        end = max(last_day, today) if pd.notna(last_day) else today
+    else:
+        start, end = today - timedelta(days=RANGE_PRESETS[preset]), today
+    return Scope(int(athlete_id), start, end)
+
+
+def render_view_stats() -> None:
+    """Caption with the bytes processed by this view's queries."""
+    stats = view_stats()
+    if stats['queries']:
+        st.caption(f"🔎 {stats['view']}: {stats['queries']} queries ({stats['cached']} cached), "
+                   f"{stats['bytes_processed'] / 1e6:.1f} MB processed")
@@ -0,0 +1,161 @@
+"""Query-result cache for the dashboard.
+
+Results are keyed by the SQL text, its parameters and the *data version* of
+the tables it reads. The data version is the tables' last-modified time in
+BigQuery, which changes whenever the ETL flow or the labeling functions
+write, so cached results are invalidated by writes rather than a blind TTL.
+"""
+from collections import OrderedDict, deque
+import datetime
+import threading
+import time
+
+import pandas as pd
+import streamlit as st
+from google.cloud import bigquery
+
+import bq_arrow
+
+GCP_PROJECT = 'strava-etl'
+BQ_LOCATION = 'US'
+
+# Maximum number of cached result frames (least recently used are evicted)
+MAX_ENTRIES = 64
+# How often table metadata is re-read to detect new writes
+VERSION_CHECK_SECONDS = 10
+
+
+@st.cache_resource
+def get_bigquery_client() -> bigquery.Client:
+    """One BigQuery client shared by every session of this process."""
+    return bigquery.Client(project=GCP_PROJECT, location=BQ_LOCATION)
+
+
+class QueryCache:
+    """Thread-safe LRU of query results with hit/miss and latency stats."""
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.versions = {}  # table_id -> (version, checked_at)
+        self.hits = 0
+        self.misses = 0
+        self.recent = deque(maxlen=20)
+        self.lock = threading.Lock()
+
+    def data_version(self, client: bigquery.Client, tables) -> tuple:
+        """Last-modified times of ``tables``, re-read at most every VERSION_CHECK_SECONDS."""
+        now = time.monotonic()
+        version = []
+        for table_id in sorted(tables):
+            cached = self.versions.get(table_id)
+            if cached is None or now - cached[1] >= VERSION_CHECK_SECONDS:
+                modified = client.get_table(table_id).modified
+                cached = (modified.isoformat() if modified else None, now)
+                self.versions[table_id] = cached
+            version.append((table_id, cached[0]))
+        return tuple(version)
+
+    def bump(self, tables=None) -> None:
+        """Force the next lookup to re-read the version of ``tables`` (default: all)."""
+        with self.lock:
+            for table_id in list(tables or self.versions):
+                self.versions.pop(table_id, None)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value) -> None:
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def record(self, label: str, seconds: float, cached: bool, bytes_processed=None) -> None:
+        self.recent.appendleft({
+            'query': label,
+            'cached': cached,
+            'latency_ms': round(seconds * 1000, 1),
+            'bytes_processed': bytes_processed,
+        })
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+@st.cache_resource
+def get_query_cache() -> QueryCache:
+    """Process-wide cache, shared across sessions and reruns."""
+    return QueryCache()
+
+
+def _to_param(name, value):
+    if isinstance(value, (list, tuple)):
+        element_type = 'INT64' if value and isinstance(value[0], int) else 'STRING'
+        return bigquery.ArrayQueryParameter(name, element_type, list(value))
+    if isinstance(value, bool):
+        return bigquery.ScalarQueryParameter(name, 'BOOL', value)
+    if isinstance(value, int):
+        return bigquery.ScalarQueryParameter(name, 'INT64', value)
+    if isinstance(value, float):
+        return bigquery.ScalarQueryParameter(name, 'FLOAT64', value)
+    if isinstance(value, datetime.datetime):
+        return bigquery.ScalarQueryParameter(name, 'TIMESTAMP', value)
+    if isinstance(value, datetime.date):
+        return bigquery.ScalarQueryParameter(name, 'DATE', value)
+    return bigquery.ScalarQueryParameter(name, 'STRING', value)
+
+
+def run_query(sql: str, tables, params=None, label: str = None, stats: dict = None) -> pd.DataFrame:
+    """Run ``sql`` through the cache; ``tables`` are the tables whose writes invalidate it.
+
+    ``stats``, if given, accumulates ``queries``, ``cached`` and ``bytes_processed`` counts.
+    """
+    client = get_bigquery_client()
+    cache = get_query_cache()
+    label = label or sql.strip().splitlines()[0]
+    params = params or {}
+
+    started = time.perf_counter()
+    key = (sql, tuple(sorted((k, str(v)) for k, v in params.items())), cache.data_version(client, tables))
+    cached = cache.get(key)
+    if stats is not None:
+        stats['queries'] += 1
+    if cached is not None:
+        cache.record(label, time.perf_counter() - started, cached=True)
+        if stats is not None:
+            stats['cached'] += 1
+        return cached
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[_to_param(name, value) for name, value in params.items()]
+    )
+    data, query_job = bq_arrow.query_to_frame(client, sql, job_config=job_config)
+
+    cache.put(key, data)
+    if stats is not None:
+        stats['bytes_processed'] += query_job.total_bytes_processed or 0
+    cache.record(label, time.perf_counter() - started, cached=False,
+                 bytes_processed=query_job.total_bytes_processed)
+    return data
+
+
+def render_debug_panel() -> None:
+    """Sidebar panel with cache hit rate and recent query latencies."""
+    cache = get_query_cache()
+    with st.sidebar.expander("🛠 Debug: query cache"):
+        st.write(f"Hit rate: {cache.hit_rate:.0%} ({cache.hits} hits / {cache.misses} misses)")
+        st.write(f"Cached results: {len(cache.entries)} / {cache.max_entries}")
+        if cache.recent:
+            st.dataframe(pd.DataFrame(list(cache.recent)), hide_index=True)
+        if st.button("Invalidate data versions", key="invalidate_query_cache"):
+            cache.bump()
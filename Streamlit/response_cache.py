@@ -0,0 +1,113 @@
+"""Cache of chatbot answers for repeated questions.
+
+Answers are keyed by the normalized prompt and the data version the context
+was built from, so a new ETL load makes every cached answer stale. A lookup
+first tries the exact normalized prompt, then the most similar cached prompt
+for the same data version. Similarity is the cosine between hashed word and
+character n-gram vectors computed locally, so a lookup never calls a model.
+"""
+from collections import OrderedDict
+import re
+import threading
+import zlib
+
+import numpy as np
+import streamlit as st
+
+MAX_ENTRIES = 128
+# Minimum cosine similarity for a near-identical prompt to reuse an answer
+SIMILARITY_THRESHOLD = 0.9
+EMBEDDING_DIM = 1024
+CHAR_NGRAM = 3
+
+# Common contractions, written without the apostrophe
+CONTRACTIONS = {
+    'whats': 'what is', 'hows': 'how is', 'wheres': 'where is', 'whens': 'when is',
+    'im': 'i am', 'ive': 'i have', 'didnt': 'did not', 'dont': 'do not', 'havent': 'have not',
+}
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Lower-case, expand common contractions, drop punctuation and collapse whitespace."""
+    text = re.sub(r"[^\w\s]", " ", prompt.lower().replace("'", "").replace("\u2019", ""))
+    return " ".join(CONTRACTIONS.get(word, word) for word in text.split())
+
+
+def embed(normalized: str) -> np.ndarray:
+    """Unit-length hashed bag of words and character trigrams."""
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    words = normalized.split()
+    padded = f" {normalized} "
+    features = words + [padded[i:i + CHAR_NGRAM] for i in range(len(padded) - CHAR_NGRAM + 1)]
+    for feature in features:
+        vector[zlib.crc32(feature.encode()) % EMBEDDING_DIM] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class ResponseCache:
+    """Thread-safe LRU of answers with exact and similarity lookup."""
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, threshold: float = SIMILARITY_THRESHOLD):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.entries = OrderedDict()  # (normalized prompt, version) -> {'prompt', 'answer', 'vector'}
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, prompt: str, version):
+        """Return ``(entry, kind, score)`` with kind 'exact' or 'similar', or ``(None, None, best score)``."""
+        normalized = normalize_prompt(prompt)
+        with self.lock:
+            entry = self.entries.get((normalized, version))
+            if entry is not None:
+                self.entries.move_to_end((normalized, version))
+                self.exact_hits += 1
+                return entry, 'exact', 1.0
+
+            candidates = [key for key in self.entries if key[1] == version]
+            best_key, best_score = None, 0.0
+            if candidates:
+                scores = np.stack([self.entries[key]['vector'] for key in candidates]) @ embed(normalized)
+                best = int(np.argmax(scores))
+                best_key, best_score = candidates[best], float(scores[best])
+            if best_key is not None and best_score >= self.threshold:
+                self.entries.move_to_end(best_key)
+                self.similar_hits += 1
+                return self.entries[best_key], 'similar', best_score
+            self.misses += 1
+            return None, None, best_score
+
+    def put(self, prompt: str, version, answer: str) -> None:
+        normalized = normalize_prompt(prompt)
+        with self.lock:
+            self.entries[(normalized, version)] = {'prompt': prompt, 'answer': answer, 'vector': embed(normalized)}
+            self.entries.move_to_end((normalized, version))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        hits = self.exact_hits + self.similar_hits
+        total = hits + self.misses
+        return hits / total if total else 0.0
+
+
+@st.cache_resource
+def get_response_cache() -> ResponseCache:
+    """Process-wide cache, shared across sessions and reruns."""
+    return ResponseCache()
+
+
+def render_debug_panel() -> None:
+    """Sidebar panel with response cache hit rate and size."""
+    cache = get_response_cache()
+    with st.sidebar.expander("🛠 Debug: response cache"):
+        st.write(f"Hit rate: {cache.hit_rate:.0%} ({cache.exact_hits} exact, {cache.similar_hits} similar, "
+                 f"{cache.misses} misses)")
+        st.write(f"Cached answers: {len(cache.entries)} / {cache.max_entries}")
+        if st.button("Clear response cache", key="clear_response_cache"):
+            with cache.lock:
+                cache.entries.clear()
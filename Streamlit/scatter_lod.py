@@ -0,0 +1,154 @@
+"""Level-of-detail rendering for the 3D run scatter.
+
+The browser only ever receives a bounded number of markers, however many runs
+are labeled. The full label table is read once (as Arrow, through the query
+cache) and reduced on the server according to how many runs are in view:
+
+- up to ``max_points``: every run is drawn;
+- up to ``DENSITY_THRESHOLD``: a per-cluster stratified sample of ``max_points``
+  runs, so small clusters keep their share of the plot;
+- beyond that: a voxel grid per cluster, drawn as one marker per occupied cell
+  at the cell's centroid and sized by the number of runs in it.
+
+Narrowing the filters shrinks the view, so the plot moves back to finer levels
+(and finally to the raw points) as the user drills in.
+"""
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+import startup_profiler
+
+AXES = ['distance', 'moving_time', 'average_heartrate']
+AXIS_LABELS = {
+    'distance': 'Distance (m)',
+    'moving_time': 'Moving Time (s)',
+    'average_heartrate': 'Average Heart Rate (bpm)',
+}
+CLUSTER_COLUMN = 'run_type_str'
+
+POINT_CAPS = [1000, 2500, 5000, 10000]
+DEFAULT_MAX_POINTS = 5000
+# Above this many runs in view, individual markers are replaced by density cells
+DENSITY_THRESHOLD = 25000
+# Bounds for the voxel grid resolution (cells per axis)
+MIN_GRID, MAX_GRID = 2, 256
+# Fixed seed so the same view samples the same runs on every rerun
+SAMPLE_SEED = 0
+
+
+def stratified_sample(df: pd.DataFrame, max_points: int, by: str = CLUSTER_COLUMN) -> pd.DataFrame:
+    """At most ``max_points`` rows, split across ``by`` in proportion to group size (at least one each)."""
+    if len(df) <= max_points:
+        return df
+    sizes = df[by].value_counts(dropna=False)
+    quotas = np.maximum(1, np.floor(sizes * max_points / len(df))).astype(int)
+    parts = [
+        group.sample(n=min(len(group), quotas[name]), random_state=SAMPLE_SEED)
+        for name, group in df.groupby(by, dropna=False, sort=False)
+    ]
+    return pd.concat(parts)
+
+
+def _voxel_codes(values: np.ndarray, lower: np.ndarray, span: np.ndarray, grid: int) -> np.ndarray:
+    cells = np.minimum(((values - lower) / span * grid).astype(np.int64), grid - 1)
+    return (cells[:, 0] * grid + cells[:, 1]) * grid + cells[:, 2]
+
+
+def voxel_aggregate(df: pd.DataFrame, max_points: int, axes=AXES, by: str = CLUSTER_COLUMN) -> pd.DataFrame:
+    """Aggregate runs into per-cluster voxels, using the finest grid that yields at most ``max_points`` cells.
+
+    Returns one row per occupied (cluster, voxel) with the mean of each axis and a ``count`` column.
+    """
+    values = df[axes].to_numpy(dtype=np.float64)
+    lower = values.min(axis=0)
+    span = np.where(values.max(axis=0) > lower, values.max(axis=0) - lower, 1.0)
+    clusters = pd.factorize(df[by])[0].astype(np.int64)
+
+    def occupied(grid):
+        keys = clusters * grid ** 3 + _voxel_codes(values, lower, span, grid)
+        return keys, len(np.unique(keys))
+
+    # The number of occupied cells grows with the grid size, so binary search the finest grid under the cap
+    low, high = MIN_GRID, MAX_GRID
+    best, _ = occupied(MIN_GRID)
+    while low <= high:
+        grid = (low + high) // 2
+        keys, cells = occupied(grid)
+        if cells <= max_points:
+            best, low = keys, grid + 1
+        else:
+            high = grid - 1
+
+    grouped = df[axes + [by]].groupby(best, sort=False)
+    points = grouped[axes].mean()
+    points[by] = grouped[by].first()
+    points['count'] = grouped.size()
+    return points.reset_index(drop=True)
+
+
+def level_of_detail(df: pd.DataFrame, max_points: int = DEFAULT_MAX_POINTS):
+    """Reduce ``df`` for plotting; returns ``(points, mode)`` with mode 'raw', 'sampled' or 'density'."""
+    if len(df) <= max_points:
+        return df, 'raw'
+    if len(df) <= DENSITY_THRESHOLD:
+        return stratified_sample(df, max_points), 'sampled'
+    return voxel_aggregate(df, max_points), 'density'
+
+
+def _range_filter(df: pd.DataFrame, column: str, label: str, key: str) -> pd.DataFrame:
+    low, high = float(df[column].min()), float(df[column].max())
+    if low >= high:
+        return df
+    selected = st.slider(label, low, high, (low, high), key=key)
+    return df[df[column].between(*selected)]
+
+
+def render_scatter(df: pd.DataFrame, key: str = "lod_scatter") -> None:
+    """Render the filter controls and the level-of-detail 3D scatter for ``df``."""
+    df = df.dropna(subset=AXES)
+    if df.empty:
+        st.info("No labeled runs to plot yet.")
+        return
+
+    with st.expander("Filter runs", expanded=False):
+        run_types = sorted(df[CLUSTER_COLUMN].dropna().unique())
+        selected_types = st.multiselect("Run types", run_types, default=run_types, key=f"{key}_types")
+        view = df[df[CLUSTER_COLUMN].isin(selected_types)]
+        for column in AXES:
+            if not view.empty:
+                view = _range_filter(view, column, AXIS_LABELS[column], f"{key}_{column}")
+        max_points = st.select_slider("Max points", POINT_CAPS, value=DEFAULT_MAX_POINTS, key=f"{key}_cap")
+
+    if view.empty:
+        st.info("No runs match the current filters.")
+        return
+
+    points, mode = level_of_detail(view, max_points)
+    px = startup_profiler.timed_import("plotly.express")
+    if mode == 'density':
+        fig = px.scatter_3d(
+            points, x='distance', y='moving_time', z='average_heartrate',
+            color=CLUSTER_COLUMN, size='count', size_max=18, opacity=0.7,
+            hover_data={'count': True}, title='3D Scatter Plot of Runs (density)', labels=AXIS_LABELS,
+        )
+    else:
+        fig = px.scatter_3d(
+            points, x='distance', y='moving_time', z='average_heartrate',
+            color=CLUSTER_COLUMN, title='3D Scatter Plot of Runs', labels=AXIS_LABELS,
+        )
+        fig.update_traces(marker=dict(size=3 if len(points) > 1000 else 6))
+
+    fig.update_layout(
+        height=600,
+        width=1200,
+        margin=dict(l=50, r=50, b=50, t=50)
+    )
+    st.plotly_chart(fig)
+
+    descriptions = {
+        'raw': f"all {len(view):,} runs in view",
+        'sampled': f"a stratified sample of {len(points):,} of {len(view):,} runs in view",
+        'density': f"{len(points):,} density cells summarising {len(view):,} runs in view (marker size = runs per cell)",
+    }
+    st.caption(f"Showing {descriptions[mode]}. Narrow the filters to see more detail.")
@@ -0,0 +1,249 @@
+"""Nearest-neighbour "similar runs" lookups for the dashboard.
+
+Each of an athlete's runs is a feature vector: the clustering features
+(``feature_store.FEATURE_NAMES``) plus features derived from its laps (lap
+count, pace variation across laps, fastest lap against the average, heart
+rate drift from the first lap to the last). Vectors are standardized and
+weighted, then kept in a KD-tree (scikit-learn), so the k nearest runs are
+found in well under a millisecond instead of computing distances over every
+activity.
+
+There is one index per dashboard scope (athlete and date range): its runs
+are read through ``query_builder.run_scoped``, like every dashboard query, so
+a lookup compares runs within the selected range. An index is built on first
+use and kept current incrementally: when the activities or laps table
+changes, only the runs not indexed yet are read. They go to a delta buffer that is searched by brute force next to the
+tree. Once the buffer outgrows ``REBUILD_FRACTION`` of the tree, the tree is
+rebuilt over every run. Standardization statistics are taken at build time.
+A run edited after it was indexed keeps its old vector until the index is
+rebuilt from scratch (the "Rebuild" button, or a restart).
+"""
+from collections import OrderedDict
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+import feature_store
+import query_builder
+import query_cache
+import startup_profiler
+
+ACTIVITIES_TABLE = "strava-etl.strava_data.activities"
+LAPS_TABLE = "strava-etl.strava_data.laps"
+TABLES = [ACTIVITIES_TABLE, LAPS_TABLE]
+
+CLUSTERING_FEATURES = feature_store.FEATURE_NAMES
+LAP_FEATURES = ['lap_count', 'lap_pace_cv', 'fastest_lap_ratio', 'heartrate_drift']
+FEATURES = CLUSTERING_FEATURES + LAP_FEATURES
+# Lap features refine the match; the run's overall shape matters most
+WEIGHTS = np.array([1.0] * len(CLUSTERING_FEATURES) + [0.5] * len(LAP_FEATURES))
+DISPLAY_COLUMNS = ['id', 'name', 'start_date', 'distance', 'moving_time', 'average_heartrate']
+
+# The delta buffer is folded into the tree once it holds this share of the tree's runs (and at least MIN_REBUILD)
+REBUILD_FRACTION = 0.1
+MIN_REBUILD = 64
+LEAF_SIZE = 16
+NEIGHBOUR_COUNTS = [5, 10, 20]
+# Scopes whose indexes are kept; the least recently used one is dropped beyond this
+MAX_INDEXES = 32
+
+
+def _runs_sql(only_ids: bool) -> str:
+    """Runs in the scope with their features; ``only_ids`` restricts them to ``@ids``.
+
+    Laps start after their run, so their date range reaches a day past the scope.
+    """
+    run_filter = "AND id IN UNNEST(@ids)" if only_ids else ""
+    lap_filter = "AND activity_id IN UNNEST(@ids)" if only_ids else ""
+    return f"""
+    WITH runs AS (
+      SELECT {', '.join(dict.fromkeys(DISPLAY_COLUMNS + CLUSTERING_FEATURES))}
+      FROM `{ACTIVITIES_TABLE}`
+      WHERE {query_builder.where()} AND type = 'Run' {run_filter}
+    ),
+    lap_features AS (
+      SELECT
+        activity_id,
+        COUNT(*) AS lap_count,
+        SAFE_DIVIDE(STDDEV_POP(average_speed), AVG(average_speed)) AS lap_pace_cv,
+        SAFE_DIVIDE(MAX(average_speed), AVG(average_speed)) AS fastest_lap_ratio,
+        ARRAY_AGG(average_heartrate IGNORE NULLS ORDER BY lap_index DESC LIMIT 1)[SAFE_OFFSET(0)]
+          - ARRAY_AGG(average_heartrate IGNORE NULLS ORDER BY lap_index LIMIT 1)[SAFE_OFFSET(0)] AS heartrate_drift
+      FROM `{LAPS_TABLE}`
+      WHERE athlete_id = @athlete_id AND start_date >= @scope_start
+        AND start_date < TIMESTAMP_ADD(@scope_end, INTERVAL 1 DAY) {lap_filter}
+      GROUP BY activity_id
+    )
+    SELECT runs.*, {', '.join(f'lap_features.{name}' for name in LAP_FEATURES)}
+    FROM runs
+    LEFT JOIN lap_features ON lap_features.activity_id = runs.id
+    """
+
+
+class SimilarityIndex:
+    """KD-tree plus delta buffer over the runs of one scope."""
+
+    def __init__(self, scope: query_builder.Scope):
+        self.scope = scope
+        self.version = None
+        self.rows = pd.DataFrame(columns=DISPLAY_COLUMNS)
+        self.vectors = np.empty((0, len(FEATURES)))
+        self.positions = {}  # activity id -> row of ``rows``/``vectors``
+        self.tree = None
+        self.tree_size = 0
+        self.mean = np.zeros(len(FEATURES))
+        self.scale = np.ones(len(FEATURES))
+        self.bytes_processed = 0
+        self.builds = 0
+        self.lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return len(self.positions)
+
+    @property
+    def delta_size(self) -> int:
+        return self.size - self.tree_size
+
+    def _query(self, sql: str, label: str, ids=None) -> pd.DataFrame:
+        """Run ``sql`` scoped to the index's scope; its bytes count towards the view and the index."""
+        stats = query_builder.view_stats()
+        bytes_before = stats['bytes_processed']
+        frame = query_builder.run_scoped(sql, self.scope, TABLES, label=label,
+                                         params={'ids': [int(i) for i in ids]} if ids is not None else None)
+        self.bytes_processed += stats['bytes_processed'] - bytes_before
+        return frame
+
+    def _embed(self, frame: pd.DataFrame) -> np.ndarray:
+        """Weighted standardized vectors; a missing feature sits at the mean."""
+        values = frame[FEATURES].to_numpy(dtype=np.float64, na_value=np.nan)
+        return np.nan_to_num((values - self.mean) / self.scale) * WEIGHTS
+
+    def _build(self) -> None:
+        """Refit the standardization and rebuild the tree over every indexed run."""
+        neighbors = startup_profiler.timed_import("sklearn.neighbors")
+        values = self.rows[FEATURES].to_numpy(dtype=np.float64, na_value=np.nan)
+        with np.errstate(all='ignore'):
+            mean, scale = np.nanmean(values, axis=0), np.nanstd(values, axis=0)
+        self.mean = np.nan_to_num(mean)
+        self.scale = np.where(np.nan_to_num(scale) > 0, np.nan_to_num(scale), 1.0)
+        self.vectors = self._embed(self.rows)
+        self.tree = neighbors.KDTree(self.vectors, leaf_size=LEAF_SIZE) if len(self.vectors) else None
+        self.tree_size = len(self.vectors)
+        self.builds += 1
+
+    def _append(self, frame: pd.DataFrame) -> None:
+        frame = frame[~frame['id'].isin(self.positions)].reset_index(drop=True)
+        if frame.empty:
+            return
+        start = len(self.rows)
+        self.rows = pd.concat([self.rows, frame], ignore_index=True) if start else frame
+        self.positions.update({activity_id: start + offset for offset, activity_id in enumerate(frame['id'])})
+        if self.delta_size > max(MIN_REBUILD, REBUILD_FRACTION * self.tree_size):
+            self._build()
+        else:
+            self.vectors = np.vstack([self.vectors, self._embed(frame)])
+
+    def refresh(self, version) -> None:
+        """Bring the index up to ``version`` of the tables, reading only runs it doesn't have."""
+        with self.lock:
+            if version == self.version:
+                return
+            if self.version is None:
+                self._append(self._query(_runs_sql(only_ids=False), "similar runs: build"))
+                if self.delta_size:
+                    self._build()
+            else:
+                ids = self._query(f"""
+                    SELECT id FROM `{ACTIVITIES_TABLE}` WHERE {query_builder.where()} AND type = 'Run'
+                """, "similar runs: ids")['id']
+                new_ids = [activity_id for activity_id in ids if activity_id not in self.positions]
+                if new_ids:
+                    self._append(self._query(_runs_sql(only_ids=True), "similar runs: new runs", ids=new_ids))
+            self.version = version
+
+    def neighbours(self, activity_id, k: int = 10) -> pd.DataFrame:
+        """The ``k`` runs nearest to ``activity_id`` (itself excluded), nearest first, with their ``distance_score``."""
+        with self.lock:
+            position = self.positions[activity_id]
+            vector = self.vectors[position]
+            candidates = []
+            if self.tree is not None:
+                distances, rows = self.tree.query(vector[None, :], k=min(k + 1, self.tree_size))
+                candidates += zip(distances[0], rows[0])
+            if self.delta_size:
+                delta = np.linalg.norm(self.vectors[self.tree_size:] - vector, axis=1)
+                nearest = np.argsort(delta)[:k + 1]
+                candidates += zip(delta[nearest], nearest + self.tree_size)
+            ranked = sorted((distance, row) for distance, row in candidates if row != position)[:k]
+            result = self.rows.iloc[[row for _, row in ranked]][DISPLAY_COLUMNS].copy()
+        result['distance_score'] = [round(float(distance), 3) for distance, _ in ranked]
+        return result.reset_index(drop=True)
+
+
+class SimilarityStore:
+    """Process-wide indexes, one per scope, the ``MAX_INDEXES`` most recently used."""
+
+    def __init__(self):
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, scope: query_builder.Scope, version) -> SimilarityIndex:
+        with self.lock:
+            index = self.indexes.get(scope)
+            if index is None:
+                index = self.indexes[scope] = SimilarityIndex(scope)
+                while len(self.indexes) > MAX_INDEXES:
+                    self.indexes.popitem(last=False)
+            self.indexes.move_to_end(scope)
+        index.refresh(version)
+        return index
+
+    def drop(self, scope: query_builder.Scope) -> None:
+        with self.lock:
+            self.indexes.pop(scope, None)
+
+
+@st.cache_resource
+def get_similarity_store() -> SimilarityStore:
+    return SimilarityStore()
+
+
+def _label(run) -> str:
+    return f"{run.start_date:%Y-%m-%d} · {run.name} · {run.distance / 1000:.1f} km"
+
+
+def render_panel(scope: query_builder.Scope, key: str = "similar_runs") -> None:
+    """Pick a run in the scope's date range and list the most similar runs in the same range.
+
+    The index's queries count towards the view's stats (``query_builder.view_stats``).
+    """
+    client = query_cache.get_bigquery_client()
+    version = query_cache.get_query_cache().data_version(client, TABLES)
+    store = get_similarity_store()
+    index = store.get(scope, version)
+    if index.size < 2:
+        st.info("Not enough runs in the selected date range to compare.")
+        return
+
+    runs = index.rows.sort_values('start_date', ascending=False)
+    labels = {run.id: _label(run) for run in runs.itertuples()}
+
+    column, count_column = st.columns([3, 1])
+    activity_id = column.selectbox("Run", list(labels), format_func=labels.get, key=f"{key}_run")
+    k = count_column.select_slider("Neighbours", NEIGHBOUR_COUNTS, value=10, key=f"{key}_k")
+
+    started = time.perf_counter()
+    similar = index.neighbours(activity_id, k)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    st.dataframe(similar, hide_index=True)
+    st.caption(f"{len(similar)} nearest of {index.size:,} runs in {elapsed_ms:.2f} ms "
+               f"(KD-tree of {index.tree_size:,}, {index.delta_size:,} in the delta buffer, "
+               f"{index.builds} builds, {index.bytes_processed / 1e6:.1f} MB read). "
+               f"Features: {', '.join(FEATURES)}.")
+    if st.button("Rebuild", key=f"{key}_rebuild", help="Re-read every run, e.g. after activities were edited."):
+        store.drop(scope)
+        st.rerun()
@@ -0,0 +1,112 @@
+"""Startup and rerun profiling for the dashboard.
+
+Inside the app it records, per process, how long each lazily imported
+dependency and each resource initialisation took, plus the duration of
+recent script runs (the first one approximates time to first paint).
+
+Run it directly to measure cold import time per dependency in a fresh
+interpreter::
+
+    python startup_profiler.py
+"""
+from collections import deque
+from contextlib import contextmanager
+import importlib
+import re
+import subprocess
+import sys
+import threading
+import time
+
+# Heavy dependencies of the dashboard, in the order the app may load them
+DEPENDENCIES = [
+    'streamlit',
+    'pandas',
+    'google.cloud.bigquery',
+    'plotly.express',
+    'vertexai',
+    'vertexai.generative_models',
+]
+
+_lock = threading.Lock()
+_events = []  # {'name', 'kind', 'ms'} for first-time imports and initialisations
+_runs = deque(maxlen=20)  # durations of recent script runs in ms
+_run_started = threading.local()
+
+
+def _record(name: str, kind: str, seconds: float) -> None:
+    with _lock:
+        _events.append({'name': name, 'kind': kind, 'ms': round(seconds * 1000, 1)})
+
+
+def timed_import(module_name: str):
+    """Import ``module_name``, recording the cost the first time it is loaded in this process."""
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    started = time.perf_counter()
+    module = importlib.import_module(module_name)
+    _record(module_name, 'import', time.perf_counter() - started)
+    return module
+
+
+@contextmanager
+def timed(name: str, kind: str = 'init'):
+    """Time a block, e.g. creating a client or model."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, kind, time.perf_counter() - started)
+
+
+def mark_run_start(started: float = None) -> None:
+    _run_started.value = started if started is not None else time.perf_counter()
+
+
+def mark_run_end() -> None:
+    started = getattr(_run_started, 'value', None)
+    if started is not None:
+        with _lock:
+            _runs.append(round((time.perf_counter() - started) * 1000, 1))
+
+
+def render_panel() -> None:
+    """Sidebar panel with import/initialisation costs and recent run durations."""
+    import pandas as pd
+    import streamlit as st
+
+    with st.sidebar.expander("🛠 Debug: startup profile"):
+        with _lock:
+            events = list(_events)
+            runs = list(_runs)
+        if runs:
+            st.write(f"First run: {runs[0]:.0f} ms · last run: {runs[-1]:.0f} ms · runs recorded: {len(runs)}")
+        if events:
+            st.dataframe(pd.DataFrame(events), hide_index=True)
+        else:
+            st.write("No lazy imports or initialisations yet.")
+
+
+def measure_cold_imports(modules=DEPENDENCIES) -> dict:
+    """Cumulative import time (ms) of each module in a fresh interpreter, via ``-X importtime``."""
+    results = {}
+    for module in modules:
+        completed = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            capture_output=True, text=True,
+        )
+        if completed.returncode != 0:
+            results[module] = None
+            continue
+        cumulative_us = 0
+        for line in completed.stderr.splitlines():
+            match = re.match(r'import time:\s+\d+\s+\|\s+(\d+)\s+\|\s*(\S+)', line)
+            if match and match.group(2) == module:
+                cumulative_us = int(match.group(1))
+        results[module] = round(cumulative_us / 1000, 1)
+    return results
+
+
+if __name__ == '__main__':
+    for module, ms in measure_cold_imports().items():
+        print(f"{module:<32} {'not installed' if ms is None else f'{ms:>8.1f} ms'}")
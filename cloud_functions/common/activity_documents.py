@@ -0,0 +1,61 @@
+"""Activity documents as fetched from Strava, cached by activity id.
+
+``fetch-data`` GETs each new activity from Strava once and stores the
+document at ``activities/athlete_{a}_activity_{id}_activities.json`` in the
+``strava-users`` bucket, where the ETL flow reads it too. Functions that need
+the document later read it here instead of calling the Strava API again:
+from an in-memory LRU first, then from the stored blob. Strava calls are
+rate limited per application, so each one saved leaves room for new uploads.
+
+Cached documents expire after ``DOCUMENT_TTL_SECONDS``, so a document that
+``fetch-data`` stores again (after an update event) is picked up by warm
+instances.
+"""
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT_BUCKET = 'strava-users'
+MAX_CACHED_DOCUMENTS = 256
+DOCUMENT_TTL_SECONDS = 600
+
+# activity id -> (read_at, document), least recently used first
+_cache: 'OrderedDict[str, tuple]' = OrderedDict()
+_lock = threading.Lock()
+
+
+def document_path(athlete_id, activity_id, data_type: str = 'activities') -> str:
+    """Blob name of a stored ``activities`` or ``laps`` document."""
+    return f'{data_type}/athlete_{athlete_id}_activity_{activity_id}_{data_type}.json'
+
+
+def _remember(key: str, document: Dict[str, Any]) -> None:
+    with _lock:
+        _cache[key] = (time.monotonic(), document)
+        _cache.move_to_end(key)
+        while len(_cache) > MAX_CACHED_DOCUMENTS:
+            _cache.popitem(last=False)
+
+
+def get(bucket, athlete_id, activity_id) -> Optional[Dict[str, Any]]:
+    """The stored document of an activity, or None if ``fetch-data`` hasn't stored one."""
+    key = str(activity_id)
+    with _lock:
+        cached = _cache.get(key)
+        if cached is not None and time.monotonic() - cached[0] < DOCUMENT_TTL_SECONDS:
+            _cache.move_to_end(key)
+            return cached[1]
+
+    from google.api_core.exceptions import NotFound
+    try:
+        document = json.loads(bucket.blob(document_path(athlete_id, activity_id)).download_as_bytes())
+    except NotFound:
+        logger.info(f"No stored document for activity {activity_id} of athlete {athlete_id}")
+        return None
+    _remember(key, document)
+    return document
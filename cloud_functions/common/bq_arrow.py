@@ -0,0 +1,85 @@
+"""Arrow-native BigQuery reads shared by the dashboard and the cloud functions.
+
+Query results are downloaded as Arrow (through the BigQuery Storage Read API
+when ``google-cloud-bigquery-storage`` is installed) and converted to pandas
+without building a Python object per row. Primitive columns are handed over
+without copying, strings stay Arrow-backed, and nullable integers keep an
+integer dtype instead of being widened to float.
+"""
+from typing import Optional, Tuple
+import logging
+
+import pandas as pd
+import pyarrow as pa
+from google.cloud import bigquery
+
+logger = logging.getLogger(__name__)
+
+_read_client = {'client': None, 'checked': False}
+
+
+def get_read_client():
+    """Shared BigQuery Storage read client, or None when the library isn't installed."""
+    if not _read_client['checked']:
+        _read_client['checked'] = True
+        try:
+            from google.cloud import bigquery_storage
+            _read_client['client'] = bigquery_storage.BigQueryReadClient()
+        except ImportError:
+            logger.info("google-cloud-bigquery-storage not installed; reading results over REST")
+    return _read_client['client']
+
+
+def _compact_type(arrow_type: pa.DataType):
+    if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+        return pd.StringDtype("pyarrow")
+    if pa.types.is_integer(arrow_type):
+        return pd.Int64Dtype()
+    if pa.types.is_boolean(arrow_type):
+        return pd.BooleanDtype()
+    return None  # let pyarrow pick the (zero-copy) numpy dtype
+
+
+def to_frame(data) -> pd.DataFrame:
+    """Convert an Arrow table or record batch to pandas with compact dtypes."""
+    if isinstance(data, pa.Table):
+        return data.to_pandas(types_mapper=_compact_type, split_blocks=True, self_destruct=True)
+    return data.to_pandas(types_mapper=_compact_type)
+
+
+def query_to_arrow(client: bigquery.Client, sql: str,
+                   job_config: Optional[bigquery.QueryJobConfig] = None) -> Tuple[pa.Table, bigquery.QueryJob]:
+    """Run ``sql`` and return its result as an Arrow table together with the finished job."""
+    job = client.query(sql, job_config=job_config)
+    table = job.result().to_arrow(bqstorage_client=get_read_client(), create_bqstorage_client=False)
+    return table, job
+
+
+def query_to_frame(client: bigquery.Client, sql: str,
+                   job_config: Optional[bigquery.QueryJobConfig] = None) -> Tuple[pd.DataFrame, bigquery.QueryJob]:
+    """Run ``sql`` and return its result as a compact DataFrame together with the finished job."""
+    table, job = query_to_arrow(client, sql, job_config=job_config)
+    return to_frame(table), job
+
+
+def iter_frames(client: bigquery.Client, sql: str, page_size: int,
+                job_config: Optional[bigquery.QueryJobConfig] = None):
+    """Yield the result of ``sql`` as a stream of DataFrames of at most ``page_size`` rows.
+
+    The Storage Read API ignores ``page_size`` and sends blocks of the size
+    the server picks, so batches are re-cut here to keep callers' memory
+    bounds in rows.
+    """
+    rows = client.query(sql, job_config=job_config).result(page_size=page_size)
+    pending, pending_rows = [], 0
+    for batch in rows.to_arrow_iterable(bqstorage_client=get_read_client()):
+        while batch.num_rows:
+            take = min(page_size - pending_rows, batch.num_rows)
+            pending.append(batch.slice(0, take))
+            pending_rows += take
+            batch = batch.slice(take)
+            if pending_rows == page_size:
+                yield to_frame(pa.Table.from_batches(pending))
+                pending, pending_rows = [], 0
+    if pending_rows:
+        yield to_frame(pa.Table.from_batches(pending))
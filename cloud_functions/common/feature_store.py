@@ -0,0 +1,313 @@
+"""Activity feature store.
+
+One feature definition (``FEATURE_SPEC``) fills two stores:
+
+* the offline store, the columnar BigQuery table ``clustering_data`` used
+  for training (written by create-clustering-data);
+* the online store, an embedded SQLite key/value file keyed by activity_id
+  and snapshotted to GCS, used for lookups at scoring time (refreshed in
+  bulk by create-clustering-data).
+
+Rows for new activities (written by fetch-data as they arrive) are stored
+as one small object each under ``PENDING_PREFIX``, so a write costs the
+same however large the snapshot is and never contends with other writers.
+Lookups prefer a pending row over the snapshot; ``compact`` folds the
+pending rows into the snapshot in one publish.
+"""
+from typing import Any, Dict, Iterable, List, Optional
+import json
+import logging
+import sqlite3
+import time
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+logger = logging.getLogger(__name__)
+
+OFFLINE_TABLE = 'strava-etl.strava_data.clustering_data'
+SOURCE_TABLE = 'strava-etl.strava_data.activities'
+
+FEATURE_BUCKET = 'strava-models'
+ONLINE_SNAPSHOT = 'feature_store/online.sqlite'
+PENDING_PREFIX = 'feature_store/pending/'
+LOCAL_SNAPSHOT_PATH = '/tmp/online_features.sqlite'
+
+# Seconds between checks of the GCS snapshot generation
+ONLINE_REFRESH_SECONDS = 30
+PUBLISH_RETRIES = 5
+# Ids per SQLite lookup, under its bound-parameter limit
+LOOKUP_CHUNK = 500
+
+# Entity columns identify the activity; feature columns are what models consume
+ENTITY_SPEC = [
+    ('id', 'STRING'),
+    ('athlete_id', 'INTEGER'),
+    ('start_date', 'TIMESTAMP'),
+]
+FEATURE_SPEC = [
+    ('distance', 'FLOAT'),
+    ('moving_time', 'FLOAT'),
+    ('average_heartrate', 'FLOAT'),
+    ('suffer_score', 'FLOAT'),
+]
+FEATURE_NAMES = [name for name, _ in FEATURE_SPEC]
+COLUMNS = [name for name, _ in ENTITY_SPEC] + FEATURE_NAMES
+
+
+def _to_float(value) -> Optional[float]:
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    # NaN (from pandas rows) is stored as a missing value, like None
+    return value if value == value else None
+
+
+def _to_int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def build_features(activity: Dict[str, Any]) -> Dict[str, Any]:
+    """Build one feature row from a Strava activity document or an activities table row."""
+    athlete_id = activity.get('athlete_id')
+    if athlete_id is None and isinstance(activity.get('athlete'), dict):
+        athlete_id = activity['athlete'].get('id')
+
+    start_date = activity.get('start_date')
+    if hasattr(start_date, 'isoformat'):
+        start_date = start_date.isoformat()
+
+    row = {'id': str(activity['id']), 'athlete_id': _to_int(athlete_id), 'start_date': start_date}
+    for name in FEATURE_NAMES:
+        row[name] = _to_float(activity.get(name))
+    return row
+
+
+def select_sql(source_table: str = SOURCE_TABLE, where: str = '') -> str:
+    """SQL projecting the feature definition from the activities table."""
+    projections = ['CAST(id AS STRING) AS id', 'athlete_id', 'start_date']
+    projections += [f'CAST({name} AS FLOAT64) AS {name}' for name in FEATURE_NAMES]
+    where_clause = f'WHERE {where}' if where else ''
+    return f"""
+        SELECT {', '.join(projections)}
+        FROM `{source_table}`
+        {where_clause}
+    """
+
+
+def _missing_sql(target_table: str, source_table: str, where: str) -> str:
+    """Ids and start dates of source activities up to ``@since`` that ``target_table`` has no row for."""
+    source_filter = f' AND {where}' if where else ''
+    return f"""
+        SELECT CAST(A.id AS STRING) AS id, A.start_date
+        FROM `{source_table}` A
+        LEFT JOIN (SELECT CAST(id AS STRING) AS id FROM `{target_table}`) T
+        ON T.id = CAST(A.id AS STRING)
+        WHERE T.id IS NULL AND A.start_date <= @since{source_filter}
+    """
+
+
+def incremental_sql(client, target_table: str, since, source_table: str = SOURCE_TABLE, where: str = ''):
+    """Feature rows newer than ``since``, plus the older rows ``target_table`` has none for.
+
+    Returns ``(sql, query_parameters, missing)``, ``missing`` being the count
+    of older rows. Finding them reads only the id and start_date columns (and
+    those of ``where``) of the source table. Their features are read from the
+    months between the first and the last of them, so the feature columns of
+    the whole table are scanned only when a backfill spans the whole history.
+    """
+    from google.cloud import bigquery
+
+    parameters = [bigquery.ScalarQueryParameter('since', 'TIMESTAMP', since)]
+    missing_sql = _missing_sql(target_table, source_table, where)
+    row = list(client.query(
+        f"SELECT COUNT(*) AS missing, MIN(start_date) AS first_missing, MAX(start_date) AS last_missing "
+        f"FROM ({missing_sql})",
+        job_config=bigquery.QueryJobConfig(query_parameters=parameters),
+    ).result())[0]
+
+    recent = ' AND '.join(filter(None, ['start_date > @since', where]))
+    sql = select_sql(source_table, where=recent)
+    if row['missing']:
+        parameters += [
+            bigquery.ScalarQueryParameter('missing_from', 'TIMESTAMP', _timestamp(row['first_missing'])),
+            bigquery.ScalarQueryParameter('missing_to', 'TIMESTAMP', _timestamp(row['last_missing'])),
+        ]
+        backfill = select_sql(source_table, where='start_date >= @missing_from AND start_date <= @missing_to')
+        sql += f"""
+        UNION ALL
+        SELECT F.*
+        FROM ({backfill}) F
+        JOIN ({missing_sql}) M ON M.id = F.id
+        """
+    return sql, parameters, row['missing']
+
+
+def _timestamp(value):
+    import pandas as pd
+
+    return pd.Timestamp(value).to_pydatetime()
+
+
+def offline_schema():
+    """BigQuery schema of the offline feature table."""
+    from google.cloud import bigquery
+
+    schema = [bigquery.SchemaField('id', 'STRING', mode='REQUIRED')]
+    schema += [bigquery.SchemaField(name, field_type, mode='NULLABLE')
+               for name, field_type in ENTITY_SPEC[1:] + FEATURE_SPEC]
+    return schema
+
+
+class OnlineFeatureStore:
+    """Embedded key/value feature store with a GCS-backed snapshot."""
+
+    def __init__(self, bucket, local_path: str = LOCAL_SNAPSHOT_PATH):
+        self.bucket = bucket
+        self.local_path = local_path
+        self.generation = 0  # GCS generation of the local copy; 0 means none
+        self.checked_at = 0.0
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.local_path, check_same_thread=False)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS features (id TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID'
+            )
+        return self._conn
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def refresh(self, force: bool = False) -> None:
+        """Download the snapshot if GCS has a newer generation than the local copy."""
+        if not force and time.monotonic() - self.checked_at < ONLINE_REFRESH_SECONDS:
+            return
+        self.checked_at = time.monotonic()
+
+        blob = self.bucket.get_blob(ONLINE_SNAPSHOT)
+        if blob is None:
+            self.generation = 0
+            return
+        if blob.generation != self.generation:
+            self._close()
+            try:
+                blob.download_to_filename(self.local_path, if_generation_match=blob.generation)
+            except (NotFound, PreconditionFailed):
+                # Replaced while we were reading; pick it up on the next refresh
+                self.checked_at = 0.0
+                return
+            self.generation = blob.generation
+            logger.info(f"Loaded online feature snapshot generation {self.generation}")
+
+    def _snapshot_rows(self, activity_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        self.refresh()
+        conn = self._connect()
+        found = {}
+        for start in range(0, len(activity_ids), LOOKUP_CHUNK):
+            chunk = activity_ids[start:start + LOOKUP_CHUNK]
+            placeholders = ', '.join('?' * len(chunk))
+            rows = conn.execute(f'SELECT id, value FROM features WHERE id IN ({placeholders})', chunk)
+            found.update((row_id, json.loads(value)) for row_id, value in rows)
+        return found
+
+    def _pending_row(self, activity_id) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(self.bucket.blob(f'{PENDING_PREFIX}{activity_id}.json').download_as_bytes())
+        except NotFound:
+            return None
+
+    def get(self, activity_id) -> Optional[Dict[str, Any]]:
+        """Look up the feature row for one activity."""
+        row = self._pending_row(activity_id)
+        if row is not None:
+            return row
+        return self._snapshot_rows([str(activity_id)]).get(str(activity_id))
+
+    def get_many(self, activity_ids: Iterable) -> Dict[str, Dict[str, Any]]:
+        """Look up several activities; missing ids are left out of the result."""
+        activity_ids = list(dict.fromkeys(str(activity_id) for activity_id in activity_ids))
+        found = self._snapshot_rows(activity_ids)
+        wanted = set(activity_ids)
+        for blob in self.bucket.list_blobs(prefix=PENDING_PREFIX):
+            activity_id = blob.name[len(PENDING_PREFIX):-len('.json')]
+            if activity_id in wanted:
+                row = self._pending_row(activity_id)
+                if row is not None:
+                    found[activity_id] = row
+        return found
+
+    def put(self, row: Dict[str, Any]) -> None:
+        """Write one feature row as its own pending object; raises if the upload fails."""
+        blob = self.bucket.blob(f"{PENDING_PREFIX}{row['id']}.json")
+        blob.upload_from_string(json.dumps(row), content_type='application/json')
+
+    def compact(self, rows: Iterable[Dict[str, Any]] = ()) -> int:
+        """Publish ``rows`` and every pending row in one snapshot, then delete the folded pending objects.
+
+        Pending rows are applied last, so they win over ``rows`` read from the
+        warehouse. A pending object rewritten while compacting is kept for the
+        next compaction. Returns the number of pending rows folded in.
+        """
+        folded = []
+        pending_rows = []
+        for blob in self.bucket.list_blobs(prefix=PENDING_PREFIX):
+            generation = blob.generation
+            try:
+                pending_rows.append(json.loads(blob.download_as_bytes(if_generation_match=generation)))
+            except (NotFound, PreconditionFailed):
+                continue
+            folded.append((blob, generation))
+
+        self.put_many(list(rows) + pending_rows)
+        for blob, generation in folded:
+            try:
+                blob.delete(if_generation_match=generation)
+            except (NotFound, PreconditionFailed):
+                pass
+        return len(folded)
+
+    def put_many(self, rows: List[Dict[str, Any]]) -> None:
+        """Upsert feature rows and publish a new snapshot.
+
+        Publishing is conditional on the generation we started from, so a
+        concurrent writer forces a reload-and-reapply instead of a lost update.
+        """
+        if not rows:
+            return
+        records = [(row['id'], json.dumps(row)) for row in rows]
+
+        for attempt in range(PUBLISH_RETRIES):
+            self.refresh(force=True)
+            conn = self._connect()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO features (id, value) VALUES (?, ?)', records)
+            self._close()
+
+            blob = self.bucket.blob(ONLINE_SNAPSHOT)
+            try:
+                blob.upload_from_filename(self.local_path, if_generation_match=self.generation)
+            except PreconditionFailed:
+                logger.info(f"Online snapshot changed concurrently, retrying (attempt {attempt + 1})")
+                self.generation = -1  # force a fresh download on the next attempt
+                continue
+            self.generation = blob.generation
+            logger.info(f"Published {len(records)} feature rows to the online store")
+            return
+        raise RuntimeError("Could not publish online feature snapshot after concurrent updates")
+
+
+_online_stores: Dict[str, OnlineFeatureStore] = {}
+
+
+def get_online_store(storage_client) -> OnlineFeatureStore:
+    """Process-wide online store, so warm instances reuse the local snapshot."""
+    if FEATURE_BUCKET not in _online_stores:
+        _online_stores[FEATURE_BUCKET] = OnlineFeatureStore(storage_client.bucket(FEATURE_BUCKET))
+    return _online_stores[FEATURE_BUCKET]
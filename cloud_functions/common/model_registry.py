@@ -0,0 +1,186 @@
+"""Versioned registry for the run-type clustering model.
+
+Layout inside the ``strava-models`` bucket::
+
+    registry/versions/<version>/scaler.joblib
+    registry/versions/<version>/kmeans_model.joblib
+    registry/versions/<version>/manifest.json
+    registry/current.json
+
+Version directories are written once (create-only uploads) and never
+modified, so consumers can cache a loaded version for the lifetime of the
+process. ``current.json`` is the only mutable object; it is written after
+every artifact of a version exists, which makes promotion an atomic swap.
+"""
+from datetime import datetime, timezone
+from typing import Any, Dict, List, NamedTuple, Optional
+import io
+import json
+import logging
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+MODEL_BUCKET = 'strava-models'
+REGISTRY_PREFIX = 'registry'
+CURRENT_POINTER = f'{REGISTRY_PREFIX}/current.json'
+
+# How long a process trusts its last read of current.json
+CURRENT_POINTER_TTL_SECONDS = 60
+
+# Run types ordered from the shortest/easiest cluster centroid to the longest
+RUN_TYPES = [
+    "Low-Intensity Run",
+    "Medium-Distance Steady Run",
+    "Long Tempo Run",
+    "Marathon Prep",
+]
+UNKNOWN_RUN_TYPE = "Unknown Run Type"
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class RegisteredModel(NamedTuple):
+    version: str
+    scaler: Any
+    model: Any
+    manifest: Dict[str, Any]
+
+    @property
+    def features(self) -> List[str]:
+        return self.manifest['features']
+
+    @property
+    def cluster_labels(self) -> Dict[int, str]:
+        return {int(k): v for k, v in self.manifest['cluster_labels'].items()}
+
+
+# version -> RegisteredModel; safe to keep forever because versions are immutable
+_loaded_versions: Dict[str, RegisteredModel] = {}
+_current_pointer = {'version': None, 'read_at': 0.0}
+
+
+def _version_path(version: str, name: str) -> str:
+    return f'{REGISTRY_PREFIX}/versions/{version}/{name}'
+
+
+def new_version_id() -> str:
+    """Return a sortable, UTC-timestamped version identifier.
+
+    Milliseconds and a random suffix keep trainings that finish in the same
+    second from colliding on the create-only uploads.
+    """
+    now = datetime.now(timezone.utc)
+    return f"{now:%Y%m%dT%H%M%S}{now.microsecond // 1000:03d}Z-{uuid.uuid4().hex[:8]}"
+
+
+def name_clusters(centroids, features: List[str]) -> Dict[int, str]:
+    """Name clusters by ranking their (unscaled) centroids on distance."""
+    if len(centroids) != len(RUN_TYPES):
+        return {i: f"Cluster {i}" for i in range(len(centroids))}
+    rank_column = features.index('distance') if 'distance' in features else 0
+    order = sorted(range(len(centroids)), key=lambda i: centroids[i][rank_column])
+    return {cluster: RUN_TYPES[rank] for rank, cluster in enumerate(order)}
+
+
+def _upload_immutable(bucket, path: str, data: bytes, content_type: str) -> None:
+    blob = bucket.blob(path)
+    blob.cache_control = IMMUTABLE_CACHE_CONTROL
+    # if_generation_match=0 makes the upload fail instead of overwriting
+    blob.upload_from_string(data, content_type=content_type, if_generation_match=0)
+
+
+def publish_version(bucket, scaler, model, features: List[str], cluster_labels: Dict[int, str],
+                    metrics: Optional[Dict[str, Any]] = None, set_current: bool = True) -> str:
+    """Write a new immutable model version and optionally promote it to current."""
+    version = new_version_id()
+    manifest = {
+        'version': version,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'features': list(features),
+        'cluster_labels': {str(k): v for k, v in cluster_labels.items()},
+        'metrics': metrics or {},
+        'artifacts': {
+            'scaler': _version_path(version, 'scaler.joblib'),
+            'model': _version_path(version, 'kmeans_model.joblib'),
+        },
+    }
+
+    import joblib
+
+    for key, obj in (('scaler', scaler), ('model', model)):
+        buffer = io.BytesIO()
+        joblib.dump(obj, buffer)
+        _upload_immutable(bucket, manifest['artifacts'][key], buffer.getvalue(), 'application/octet-stream')
+
+    # The manifest goes last: a version is only visible once it is complete
+    _upload_immutable(bucket, _version_path(version, 'manifest.json'),
+                      json.dumps(manifest, indent=2).encode('utf-8'), 'application/json')
+    logger.info(f"Published model version {version} with features {features}")
+
+    if set_current:
+        set_current_version(bucket, version)
+    return version
+
+
+def set_current_version(bucket, version: str) -> None:
+    """Point current.json at an existing version."""
+    if not bucket.blob(_version_path(version, 'manifest.json')).exists():
+        raise ValueError(f"Model version {version} has no manifest")
+    pointer = {'version': version, 'updated_at': datetime.now(timezone.utc).isoformat()}
+    blob = bucket.blob(CURRENT_POINTER)
+    blob.cache_control = 'no-cache'
+    blob.upload_from_string(json.dumps(pointer), content_type='application/json')
+    _current_pointer.update(version=version, read_at=time.monotonic())
+    logger.info(f"Current model version is now {version}")
+
+
+def get_current_version(bucket, max_age: float = CURRENT_POINTER_TTL_SECONDS) -> str:
+    """Return the current version id, re-reading the pointer at most every ``max_age`` seconds."""
+    now = time.monotonic()
+    if _current_pointer['version'] and now - _current_pointer['read_at'] < max_age:
+        return _current_pointer['version']
+
+    blob = bucket.blob(CURRENT_POINTER)
+    if not blob.exists():
+        raise ValueError("No model version has been published; run train_kmeans first")
+    version = json.loads(blob.download_as_bytes())['version']
+    _current_pointer.update(version=version, read_at=now)
+    return version
+
+
+def load_version(bucket, version: Optional[str] = None) -> RegisteredModel:
+    """Load a model version (default: current), caching it for the life of the process."""
+    version = version or get_current_version(bucket)
+    if version in _loaded_versions:
+        return _loaded_versions[version]
+
+    # joblib (and the scikit-learn classes it unpickles) is only paid for by a process that loads a model
+    import joblib
+
+    manifest = json.loads(bucket.blob(_version_path(version, 'manifest.json')).download_as_bytes())
+    scaler = joblib.load(io.BytesIO(bucket.blob(manifest['artifacts']['scaler']).download_as_bytes()))
+    model = joblib.load(io.BytesIO(bucket.blob(manifest['artifacts']['model']).download_as_bytes()))
+
+    registered = RegisteredModel(version=version, scaler=scaler, model=model, manifest=manifest)
+    _loaded_versions[version] = registered
+    logger.info(f"Loaded model version {version}")
+    return registered
+
+
+def predict_run_types(registered: RegisteredModel, df) -> List[str]:
+    """Predict run types for the rows of ``df`` using the version's own feature list.
+
+    Rows missing any of the version's features get ``UNKNOWN_RUN_TYPE``.
+    """
+    features = df[registered.features].astype(float)
+    complete = features.notna().all(axis=1).tolist()
+    run_types = [UNKNOWN_RUN_TYPE] * len(features)
+    if any(complete):
+        clusters = registered.model.predict(registered.scaler.transform(features[complete]))
+        labels = registered.cluster_labels
+        positions = [position for position, ok in enumerate(complete) if ok]
+        for position, cluster in zip(positions, clusters):
+            run_types[position] = labels.get(int(cluster), UNKNOWN_RUN_TYPE)
+    return run_types
@@ -0,0 +1,248 @@
+"""Trace IDs and spans shared by the pipeline functions and the ETL flow.
+
+A trace is minted when ``webhook()`` receives an event and travels with the
+work it triggers: as a W3C ``traceparent`` Pub/Sub message attribute between
+the functions, and as a flow parameter from ``trigger_prefect_flow`` to
+``etl_flow``. Each entry point runs in a span continuing that trace, and
+external calls (GCS, BigQuery, Strava, Prefect) are wrapped in child spans.
+
+Finished spans are buffered and written, one OTLP/JSON ``resourceSpans``
+document per entry point invocation, to ``TRACE_EXPORT_PATH``: ``-`` writes
+them to stdout, where Cloud Logging ingests each line as a structured
+entry; a file path appends them for an OpenTelemetry collector file
+receiver (or ``jq``). Export is off by default. ``/tmp`` is in memory on
+Cloud Functions, so don't point it at a file there.
+Work that batches several traces (one flow run for many messages) runs in a
+span of its own with a link to each trace it covers.
+``instrument_logging()`` adds ``trace_id`` to every log record so log lines
+can be joined to their trace.
+"""
+from contextlib import contextmanager
+from typing import Any, Dict, NamedTuple, Optional
+import contextvars
+import functools
+import json
+import logging
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT_ATTRIBUTE = 'traceparent'
+# Empty (the default) disables export, '-' writes to stdout, anything else is a file to append to
+TRACE_EXPORT_PATH = os.environ.get('TRACE_EXPORT_PATH', '')
+SERVICE_NAME = os.environ.get('K_SERVICE') or os.environ.get('SERVICE_NAME', 'strava-etl')
+# Flush early when a long-running entry point has buffered this many spans
+MAX_BUFFERED_SPANS = 512
+
+# OTLP span kinds and status codes
+SPAN_KINDS = {'internal': 1, 'server': 2, 'client': 3, 'producer': 4, 'consumer': 5}
+STATUS_OK, STATUS_ERROR = 1, 2
+
+_TRACEPARENT_RE = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+
+
+class SpanContext(NamedTuple):
+    trace_id: str
+    span_id: str
+
+
+class Span:
+    """A timed operation; ``set()`` adds attributes, an exception marks it as failed."""
+
+    def __init__(self, name: str, kind: str, context: SpanContext, parent_span_id: Optional[str],
+                 attributes: Dict[str, Any], links=()):
+        self.name = name
+        self.kind = kind
+        self.context = context
+        self.parent_span_id = parent_span_id
+        self.attributes = dict(attributes)
+        self.links = [link for link in links if link is not None]
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = STATUS_OK
+        self.status_message = ''
+
+    def set(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def fail(self, message: str) -> None:
+        self.status = STATUS_ERROR
+        self.status_message = message
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar('tracing_span', default=None)
+_buffer = []
+_lock = threading.Lock()
+
+
+def new_trace_id() -> str:
+    return secrets.token_hex(16)
+
+
+def _new_span_id() -> str:
+    return secrets.token_hex(8)
+
+
+def current_trace_id() -> Optional[str]:
+    span = _current.get()
+    return span.context.trace_id if span is not None else None
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[SpanContext]:
+    """Parse a W3C ``traceparent`` value; a bare 32-hex trace ID is accepted too."""
+    if not value:
+        return None
+    value = value.strip().lower()
+    match = _TRACEPARENT_RE.match(value)
+    if match:
+        return SpanContext(match.group(1), match.group(2))
+    if re.fullmatch(r'[0-9a-f]{32}', value):
+        return SpanContext(value, None)
+    return None
+
+
+def traceparent() -> Optional[str]:
+    """``traceparent`` value for the current span, to hand to downstream work."""
+    span = _current.get()
+    if span is None:
+        return None
+    return f"00-{span.context.trace_id}-{span.context.span_id}-01"
+
+
+def message_attributes() -> Dict[str, str]:
+    """Pub/Sub message attributes carrying the current trace."""
+    value = traceparent()
+    return {TRACEPARENT_ATTRIBUTE: value} if value else {}
+
+
+def from_event(event) -> Optional[SpanContext]:
+    """Trace context of a Pub/Sub cloud event (message attributes) or an HTTP request (header)."""
+    data = getattr(event, 'data', None)
+    if isinstance(data, dict):
+        attributes = (data.get('message') or {}).get('attributes') or {}
+        return parse_traceparent(attributes.get(TRACEPARENT_ATTRIBUTE))
+    headers = getattr(event, 'headers', None)
+    if headers is not None:
+        return parse_traceparent(headers.get(TRACEPARENT_ATTRIBUTE))
+    return None
+
+
+@contextmanager
+def span(name: str, kind: str = 'client', parent: Optional[SpanContext] = None, links=(), **attributes):
+    """Run the body in a span; the parent is ``parent``, else the current span, else a new trace.
+
+    ``links`` are SpanContexts of other traces the span works on behalf of.
+    """
+    enclosing = _current.get()
+    if parent is None and enclosing is not None:
+        parent = enclosing.context
+    trace_id = parent.trace_id if parent is not None else new_trace_id()
+    current = Span(name, kind, SpanContext(trace_id, _new_span_id()),
+                   parent.span_id if parent is not None else None, attributes, links)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.fail(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        _current.reset(token)
+        current.end_ns = time.time_ns()
+        _finish(current, flush=enclosing is None)
+
+
+def traced(name: str, kind: str = 'consumer'):
+    """Decorator running a function entry point in a span that continues the caller's trace.
+
+    A ``(body, status)`` return value with status >= 400 marks the span as failed.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(event, *args, **kwargs):
+            with span(name, kind=kind, parent=from_event(event)) as current:
+                result = func(event, *args, **kwargs)
+                status = result[1] if isinstance(result, tuple) and len(result) > 1 else None
+                if isinstance(status, int):
+                    current.set('http.status_code', status)
+                    if status >= 400:
+                        current.fail(str(result[0])[:200])
+                return result
+        return wrapper
+    return decorate
+
+
+def instrument_logging() -> None:
+    """Give every log record a ``trace_id`` attribute ('-' outside a trace) for use in log formats."""
+    factory = logging.getLogRecordFactory()
+    if getattr(factory, 'adds_trace_id', False):
+        return
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.trace_id = current_trace_id() or '-'
+        return record
+
+    record_factory.adds_trace_id = True
+    logging.setLogRecordFactory(record_factory)
+
+
+def _attribute(key: str, value: Any) -> dict:
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+def _to_otlp(span_: Span) -> dict:
+    return {
+        'traceId': span_.context.trace_id,
+        'spanId': span_.context.span_id,
+        'parentSpanId': span_.parent_span_id or '',
+        'name': span_.name,
+        'kind': SPAN_KINDS.get(span_.kind, 1),
+        'startTimeUnixNano': str(span_.start_ns),
+        'endTimeUnixNano': str(span_.end_ns),
+        'attributes': [_attribute(key, value) for key, value in span_.attributes.items() if value is not None],
+        'links': [{'traceId': link.trace_id, 'spanId': link.span_id or ''} for link in span_.links],
+        'status': {'code': span_.status, 'message': span_.status_message},
+    }
+
+
+def _finish(span_: Span, flush: bool) -> None:
+    with _lock:
+        _buffer.append(_to_otlp(span_))
+        if not (flush or len(_buffer) >= MAX_BUFFERED_SPANS):
+            return
+        spans = _buffer[:]
+        _buffer.clear()
+    export(spans)
+
+
+def export(spans) -> None:
+    """Write ``spans`` (OTLP/JSON span dicts) to the export target as one ``resourceSpans`` document."""
+    if not TRACE_EXPORT_PATH or not spans:
+        return
+    document = {'resourceSpans': [{
+        'resource': {'attributes': [_attribute('service.name', SERVICE_NAME)]},
+        'scopeSpans': [{'scope': {'name': 'strava-etl.tracing'}, 'spans': spans}],
+    }]}
+    line = json.dumps(document) + '\n'
+    try:
+        if TRACE_EXPORT_PATH == '-':
+            with _lock:
+                sys.stdout.write(line)
+                sys.stdout.flush()
+            return
+        with _lock, open(TRACE_EXPORT_PATH, 'a') as f:
+            f.write(line)
+    except OSError as e:
+        # Tracing must never take the pipeline down
+        logger.warning(f"Could not export {len(spans)} spans to {TRACE_EXPORT_PATH}: {str(e)}")
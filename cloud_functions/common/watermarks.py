@@ -0,0 +1,60 @@
+"""High-water marks for incremental jobs, stored in a small BigQuery table."""
+from datetime import datetime
+from typing import Optional
+import logging
+
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+
+logger = logging.getLogger(__name__)
+
+WATERMARK_TABLE = 'strava-etl.strava_data.pipeline_watermarks'
+
+
+def ensure_watermark_table(client: bigquery.Client) -> None:
+    """Create the watermark table if it doesn't exist."""
+    try:
+        client.get_table(WATERMARK_TABLE)
+    except NotFound:
+        schema = [
+            bigquery.SchemaField('name', 'STRING', mode='REQUIRED'),
+            bigquery.SchemaField('watermark', 'TIMESTAMP', mode='NULLABLE'),
+            bigquery.SchemaField('updated_at', 'TIMESTAMP', mode='NULLABLE'),
+        ]
+        client.create_table(bigquery.Table(WATERMARK_TABLE, schema=schema))
+        logger.info(f"Created table {WATERMARK_TABLE}")
+
+
+def get_watermark(client: bigquery.Client, name: str) -> Optional[datetime]:
+    """Return the stored watermark for ``name``, or None if the job has never run."""
+    ensure_watermark_table(client)
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter('name', 'STRING', name)]
+    )
+    rows = list(client.query(
+        f"SELECT watermark FROM `{WATERMARK_TABLE}` WHERE name = @name",
+        job_config=job_config,
+    ).result())
+    return rows[0]['watermark'] if rows else None
+
+
+def set_watermark(client: bigquery.Client, name: str, value: datetime) -> None:
+    """Advance the watermark for ``name``; it never moves backwards."""
+    ensure_watermark_table(client)
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter('name', 'STRING', name),
+            bigquery.ScalarQueryParameter('watermark', 'TIMESTAMP', value),
+        ]
+    )
+    client.query(f"""
+        MERGE `{WATERMARK_TABLE}` T
+        USING (SELECT @name AS name, @watermark AS watermark) S
+        ON T.name = S.name
+        WHEN MATCHED THEN
+            UPDATE SET watermark = GREATEST(IFNULL(T.watermark, S.watermark), S.watermark),
+                       updated_at = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN
+            INSERT (name, watermark, updated_at) VALUES (S.name, S.watermark, CURRENT_TIMESTAMP())
+    """, job_config=job_config).result()
+    logger.info(f"Watermark {name} set to {value}")
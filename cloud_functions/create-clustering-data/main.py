@@ -1,41 +1,128 @@
+from datetime import timedelta
 from google.cloud import bigquery
 from google.api_core.exceptions import NotFound
 import functions_framework
+import feature_store
+import bq_arrow
+import watermarks
+import json
+
+# Runs shorter than this (meters) are excluded from training
+MIN_DISTANCE = 100
+
+WATERMARK_NAME = 'create_clustering_data'
+# Re-read this far behind the watermark so recent edits and late loads are merged again;
+# older activities that were never added are found by an anti-join on id (feature_store.incremental_sql)
+LOOKBACK = timedelta(days=2)
+STAGING_TABLE = 'strava-etl.strava_data.clustering_data_staging'
 
 @functions_framework.http
 def preprocess_data(request):
+    """Refresh the clustering (offline feature) table.
+
+    ``?mode=incremental`` (default) reads the activities from ``LOOKBACK``
+    before the stored watermark on, plus any older activity the table doesn't
+    have yet (late webhooks, imported history), and merges them in. Only the
+    id and start_date columns of older months are scanned to find those;
+    ``?mode=full`` rebuilds the table.
+    """
+    mode = request.args.get('mode', 'incremental')
+    if mode not in ('incremental', 'full'):
+        return f"Unknown mode: {mode}", 400
+
     # Explicitly set the project ID
     client = bigquery.Client(project="strava-etl")
 
-    # Define the table ID
-    table_id = 'strava-etl.strava_data.clustering_data'
+    # The clustering table is the offline feature store
+    table_id = feature_store.OFFLINE_TABLE
 
     # Check if the table exists, and create it if it doesn't
     create_table_if_not_exists(client, table_id)
 
-    # Query to get data from activities table
-    query = """
-        SELECT *
-        FROM `strava-etl.strava_data.activities`
-    """
-    activities = client.query(query).to_dataframe()
+    # Project only the feature columns and push the filters into SQL
+    watermark = watermarks.get_watermark(client, WATERMARK_NAME) if mode == 'incremental' else None
+    training_filter = f"distance > {MIN_DISTANCE}"
+    select, query_parameters, missing = feature_store.select_sql(where=training_filter), [], 0
+    if watermark is not None:
+        select, query_parameters, missing = feature_store.incremental_sql(
+            client, table_id, watermark - LOOKBACK, where=training_filter,
+        )
 
-    # Remove empty columns
-    activities = activities.dropna(axis=1, how='all')
+    clustering_data, query_job = bq_arrow.query_to_frame(
+        client, select, job_config=bigquery.QueryJobConfig(query_parameters=query_parameters),
+    )
+    bytes_processed = {'select': query_job.total_bytes_processed or 0}
+    print(f"Read {len(clustering_data)} new or recent rows, {missing} of them older ones the table lacked "
+          f"(watermark {watermark}, {bytes_processed['select']} bytes processed).")
 
-    # Filter out runs with distance < 100
-    activities = activities[activities['distance'] > 100]
+    if clustering_data.empty:
+        folded = refresh_online_store([])
+        return json.dumps({'mode': mode, 'rows': 0, 'watermark': str(watermark), 'bytes_processed': bytes_processed,
+                           'online_rows_folded': folded}), 200
 
-    # Select relevant columns
-    clustering_data = activities[['id', 'distance', 'moving_time', 'suffer_score']]
+    if watermark is None:
+        # Full rebuild: replace the table
+        job_config = bigquery.LoadJobConfig(
+            write_disposition="WRITE_TRUNCATE",
+            schema=feature_store.offline_schema(),
+        )
+        job = client.load_table_from_dataframe(clustering_data, table_id, job_config=job_config)
+        job.result()  # Wait for the job to complete
+    else:
+        bytes_processed['merge'] = merge_into_table(client, clustering_data, table_id)
+    print("Preprocessed data written to clustering_data table.")
 
-    # Write to BigQuery table
-    job_config = bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE")
-    job = client.load_table_from_dataframe(clustering_data, table_id, job_config=job_config)
-    job.result()  # Wait for the job to complete
+    # Late rows older than the watermark must not move it back
+    new_watermark = clustering_data['start_date'].max().to_pydatetime()
+    if watermark is not None:
+        new_watermark = max(new_watermark, watermark)
+    watermarks.set_watermark(client, WATERMARK_NAME, new_watermark)
 
-    print("Preprocessed data written to clustering_data table.")
-    return 'Data processing complete', 200
+    # Refresh the online store from the same rows
+    rows = [feature_store.build_features(row) for row in clustering_data.to_dict(orient='records')]
+    folded = refresh_online_store(rows)
+
+    summary = {
+        'mode': mode,
+        'rows': len(clustering_data),
+        'watermark': new_watermark.isoformat(),
+        'bytes_processed': bytes_processed,
+        'online_rows_folded': folded,
+    }
+    print(f"Data processing summary: {summary}")
+    return json.dumps(summary), 200
+
+def refresh_online_store(rows):
+    """Publish ``rows`` and the rows fetch-data wrote since the last run as one online snapshot."""
+    from google.cloud import storage
+    storage_client = storage.Client(project="strava-etl")
+    folded = feature_store.get_online_store(storage_client).compact(rows)
+    print(f"Online feature store refreshed with {len(rows)} rows and {folded} pending rows.")
+    return folded
+
+def merge_into_table(client, df, table_id):
+    """Upsert new rows into the clustering table through a staging table."""
+    job_config = bigquery.LoadJobConfig(
+        write_disposition="WRITE_TRUNCATE",
+        schema=feature_store.offline_schema(),
+    )
+    client.load_table_from_dataframe(df, STAGING_TABLE, job_config=job_config).result()
+
+    columns = feature_store.COLUMNS
+    merge_query = f"""
+    MERGE `{table_id}` T
+    USING `{STAGING_TABLE}` S
+    ON T.id = S.id
+    WHEN MATCHED THEN
+        UPDATE SET {', '.join(f'T.{col} = S.{col}' for col in columns if col != 'id')}
+    WHEN NOT MATCHED THEN
+        INSERT ({', '.join(columns)})
+        VALUES ({', '.join(f'S.{col}' for col in columns)})
+    """
+    merge_job = client.query(merge_query)
+    merge_job.result()
+    client.delete_table(STAGING_TABLE, not_found_ok=True)
+    return merge_job.total_bytes_processed or 0
 
 def create_table_if_not_exists(client, table_id):
     """Creates the BigQuery table if it doesn't exist."""
@@ -43,14 +130,7 @@ def create_table_if_not_exists(client, table_id):
         client.get_table(table_id)  # Check if table exists
         print(f"Table {table_id} already exists.")
     except NotFound:
-        # Define the schema
-        schema = [
-            bigquery.SchemaField("id", "STRING", mode="REQUIRED"),
-            bigquery.SchemaField("distance", "FLOAT", mode="NULLABLE"),
-            bigquery.SchemaField("moving_time", "FLOAT", mode="NULLABLE"),
-            bigquery.SchemaField("suffer_score", "FLOAT", mode="NULLABLE"),
-        ]
-        # Create the table with the specified schema
-        table = bigquery.Table(table_id, schema=schema)
+        # Create the table with the feature store schema
+        table = bigquery.Table(table_id, schema=feature_store.offline_schema())
         client.create_table(table)  # Make the API request to create the table
         print(f"Created table {table_id}.")
@@ -0,0 +1 @@
+../common/feature_store.py
\ No newline at end of file
@@ -1,14 +1,16 @@
 import functions_framework
-from google.cloud import storage
-from google.cloud import pubsub_v1
 import json
 import requests
 import base64
 import os
 import logging
+import activity_documents
+import feature_store
+import tracing
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging; every line carries the trace it belongs to
+tracing.instrument_logging()
+logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(name)s:[trace %(trace_id)s] %(message)s')
 logger = logging.getLogger(__name__)
 
 # Environment variables for Strava API credentials
@@ -17,16 +19,32 @@ CLIENT_SECRET = os.getenv('CLIENT_SECRET')
 AUTH_URL = 'https://www.strava.com/oauth/token'
 
 BUCKET_NAME = 'strava-users'
-storage_client = storage.Client()
-bucket = storage_client.bucket(BUCKET_NAME)
-
-# Set up Pub/Sub client
-publisher = pubsub_v1.PublisherClient()
 ETL_TOPIC = 'projects/strava-etl/topics/etl-trigger'
 PREDICT_TOPIC = 'projects/strava-etl/topics/make-prediction'
 
-# Define columns needed for prediction
-PREDICTION_COLUMNS = ['distance', 'moving_time', 'average_heartrate']
+# Columns needed for prediction come from the shared feature definition
+PREDICTION_COLUMNS = feature_store.FEATURE_NAMES
+
+class FeatureWriteError(Exception):
+    """The activity's online feature row could not be written."""
+
+# Clients are created on first use so importing the function stays cheap
+_clients = {}
+
+def get_storage_client():
+    if 'storage' not in _clients:
+        from google.cloud import storage
+        _clients['storage'] = storage.Client()
+    return _clients['storage']
+
+def get_bucket():
+    return get_storage_client().bucket(BUCKET_NAME)
+
+def get_publisher():
+    if 'publisher' not in _clients:
+        from google.cloud import pubsub_v1
+        _clients['publisher'] = pubsub_v1.PublisherClient()
+    return _clients['publisher']
 
 def refresh_access_token(athlete_id, refresh_token):
     """Refresh the access token using the provided refresh token."""
@@ -38,7 +56,9 @@ def refresh_access_token(athlete_id, refresh_token):
     }
     
     logger.info("Requesting new access token...")
-    response = requests.post(AUTH_URL, data=payload)
+    with tracing.span('strava.refresh_token') as call:
+        response = requests.post(AUTH_URL, data=payload)
+        call.set('http.status_code', response.status_code)
     response_data = response.json()
     
     if response.status_code == 200:
@@ -50,8 +70,9 @@ def refresh_access_token(athlete_id, refresh_token):
             'access_token': access_token,
             'refresh_token': new_refresh_token
         }
-        blob = bucket.blob(f'tokens/{athlete_id}.json')
-        blob.upload_from_string(json.dumps(tokens))
+        blob = get_bucket().blob(f'tokens/{athlete_id}.json')
+        with tracing.span('gcs.upload', bucket=BUCKET_NAME, object=blob.name):
+            blob.upload_from_string(json.dumps(tokens))
         
         logger.info(f"Access token refreshed for athlete {athlete_id}")
         return access_token
@@ -61,18 +82,20 @@ def refresh_access_token(athlete_id, refresh_token):
 
 def get_access_token(athlete_id):
     """Retrieve or refresh the access token for a given athlete ID."""
-    blob = bucket.blob(f'tokens/{athlete_id}.json')
-    if not blob.exists():
-        raise ValueError(f"No token found for athlete {athlete_id}")
-    
-    tokens = json.loads(blob.download_as_string())
+    blob = get_bucket().blob(f'tokens/{athlete_id}.json')
+    with tracing.span('gcs.download', bucket=BUCKET_NAME, object=blob.name):
+        if not blob.exists():
+            raise ValueError(f"No token found for athlete {athlete_id}")
+        tokens = json.loads(blob.download_as_string())
     access_token = tokens.get('access_token')
     refresh_token = tokens.get('refresh_token')
 
     # Test the current access token
     headers = {"Authorization": f"Bearer {access_token}"}
     test_url = "https://www.strava.com/api/v3/athlete"
-    test_response = requests.get(test_url, headers=headers)
+    with tracing.span('strava.get_athlete') as call:
+        test_response = requests.get(test_url, headers=headers)
+        call.set('http.status_code', test_response.status_code)
     
     if test_response.status_code == 401:  # Token expired
         logger.info("Access token expired, refreshing...")
@@ -85,15 +108,19 @@ def fetch_and_store_data(url, athlete_id, activity_id, data_type):
     access_token = get_access_token(athlete_id)
     headers = {"Authorization": f"Bearer {access_token}"}
     
-    response = requests.get(url, headers=headers)
+    with tracing.span(f'strava.get_{data_type}', **{'http.url': url}) as call:
+        response = requests.get(url, headers=headers)
+        call.set('http.status_code', response.status_code)
     
     if response.status_code == 200:
         data = response.json()
         logger.info(f"Received {data_type} data for activity {activity_id}")
         
         # Store data
-        blob = bucket.blob(f'{data_type}/athlete_{athlete_id}_activity_{activity_id}_{data_type}.json')
-        blob.upload_from_string(json.dumps(data))
+        # make-predicitons reads the activity document back through activity_documents
+        blob = get_bucket().blob(activity_documents.document_path(athlete_id, activity_id, data_type))
+        with tracing.span('gcs.upload', bucket=BUCKET_NAME, object=blob.name):
+            blob.upload_from_string(json.dumps(data))
         
         logger.info(f"{data_type.capitalize()} data stored for athlete {athlete_id}, activity {activity_id}")
         return True, data
@@ -102,18 +129,26 @@ def fetch_and_store_data(url, athlete_id, activity_id, data_type):
         return False, None
 
 def prepare_prediction_data(activity_data):
-    """Extract only the necessary columns for prediction."""
-    prediction_data = {}
-    for column in PREDICTION_COLUMNS:
-        if column in activity_data:
-            prediction_data[column] = activity_data[column]
-        else:
-            logger.warning(f"Column {column} not found in activity data")
-            logger.info(f"Available columns: {list(activity_data.keys())}")
+    """Build the feature row for an activity and write it to the online feature store."""
+    missing = [column for column in PREDICTION_COLUMNS if column not in activity_data]
+    if missing:
+        logger.warning(f"Columns {missing} not found in activity data")
+        logger.info(f"Available columns: {list(activity_data.keys())}")
+
+    # One small object per activity; a failed write fails the event so it is redelivered
+    features = feature_store.build_features(activity_data)
+    try:
+        with tracing.span('gcs.feature_store_put', bucket=feature_store.FEATURE_BUCKET):
+            feature_store.get_online_store(get_storage_client()).put(features)
+    except Exception as e:
+        raise FeatureWriteError(f"Failed to write online features for activity {activity_data.get('id')}: {str(e)}") from e
+
+    prediction_data = {column: features[column] for column in PREDICTION_COLUMNS if column in activity_data}
     logger.info(f"Prepared prediction data: {prediction_data}")
     return prediction_data
 
 @functions_framework.cloud_event
+@tracing.traced('fetch_activity_data')
 def fetch_activity_data(cloud_event):
     """Cloud Function triggered by Pub/Sub message to fetch activity and laps data."""
     try:
@@ -139,10 +174,9 @@ def fetch_activity_data(cloud_event):
         laps_success, _ = fetch_and_store_data(laps_url, athlete_id, activity_id, 'laps')
 
         if activity_success and activity_data:
+            # Outside the try below: losing the feature row must fail the event, not just the prediction
+            prediction_data = prepare_prediction_data(activity_data)
             try:
-                # Prepare prediction data
-                prediction_data = prepare_prediction_data(activity_data)
-                
                 # Create prediction message
                 predict_message = json.dumps({
                     'athlete_id': athlete_id,
@@ -151,7 +185,8 @@ def fetch_activity_data(cloud_event):
                 }).encode('utf-8')
                 
                 logger.info(f"Publishing prediction message for activity {activity_id}")
-                publisher.publish(PREDICT_TOPIC, predict_message)
+                with tracing.span('pubsub.publish', kind='producer', topic=PREDICT_TOPIC):
+                    get_publisher().publish(PREDICT_TOPIC, predict_message, **tracing.message_attributes())
                 logger.info(f"Prediction trigger sent for athlete {athlete_id}, activity {activity_id}")
                 
             except Exception as e:
@@ -164,11 +199,15 @@ def fetch_activity_data(cloud_event):
                 'activity_id': activity_id,
             }).encode('utf-8')
             
-            publisher.publish(ETL_TOPIC, etl_message)
+            with tracing.span('pubsub.publish', kind='producer', topic=ETL_TOPIC):
+                get_publisher().publish(ETL_TOPIC, etl_message, **tracing.message_attributes())
             logger.info(f"ETL trigger sent for athlete {athlete_id}, activity {activity_id}")
             
         return 'Success', 200
         
     except Exception as e:
         logger.error(f"Error in fetch_activity_data: {str(e)}")
+        if isinstance(e, FeatureWriteError):
+            # Raising makes Pub/Sub redeliver the event (the function is deployed with --retry)
+            raise
         return f'Error: {str(e)}', 500
\ No newline at end of file
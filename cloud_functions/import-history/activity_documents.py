@@ -0,0 +1 @@
+../common/activity_documents.py
\ No newline at end of file
@@ -0,0 +1,477 @@
+import functions_framework
+import requests
+import json
+import base64
+import calendar
+import os
+import re
+import time
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import activity_documents
+import tracing
+
+# Configure logging; every line carries the trace it belongs to
+tracing.instrument_logging()
+logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(name)s:[trace %(trace_id)s] %(message)s')
+logger = logging.getLogger(__name__)
+
+# Environment variables for Strava API credentials
+CLIENT_ID = os.getenv('CLIENT_ID')
+CLIENT_SECRET = os.getenv('CLIENT_SECRET')
+AUTH_URL = 'https://www.strava.com/oauth/token'
+API_URL = 'https://www.strava.com/api/v3'
+
+BUCKET_NAME = 'strava-users'
+IMPORT_TOPIC = 'projects/strava-etl/topics/import-history'
+ETL_TOPIC = 'projects/strava-etl/topics/etl-trigger'
+CHECKPOINT_PREFIX = 'imports'
+
+# Strava returns at most 200 activities per page
+PAGE_SIZE = 200
+# Concurrent activity fetches within one import
+IMPORT_WORKERS = int(os.getenv('IMPORT_WORKERS', '8'))
+# Activities per ETL trigger message
+ETL_BATCH_SIZE = int(os.getenv('ETL_BATCH_SIZE', '100'))
+# Share of each rate-limit window left for live uploads (webhook -> fetch-data)
+RATE_LIMIT_RESERVE = float(os.getenv('RATE_LIMIT_RESERVE', '0.2'))
+# How long one invocation imports before handing over to the next; keep it below the function timeout
+IMPORT_RUN_SECONDS = float(os.getenv('IMPORT_RUN_SECONDS', '480'))
+# Failed activity ids kept in the checkpoint for inspection
+MAX_RECORDED_FAILURES = 100
+
+# Strava's short rate-limit window starts at :00, :15, :30 and :45; the daily one at midnight UTC
+SHORT_WINDOW_SECONDS = 900
+DAY_SECONDS = 86400
+
+# Clients are created on first use so importing the function stays cheap
+_clients = {}
+
+def get_bucket():
+    if 'bucket' not in _clients:
+        from google.cloud import storage
+        _clients['bucket'] = storage.Client().bucket(BUCKET_NAME)
+    return _clients['bucket']
+
+def get_publisher():
+    if 'publisher' not in _clients:
+        from google.cloud import pubsub_v1
+        _clients['publisher'] = pubsub_v1.PublisherClient()
+    return _clients['publisher']
+
+def _next_boundary(now, period):
+    return (int(now) // period + 1) * period
+
+def _header_pair(value):
+    """'600,30000' -> (600, 30000); None if the header is missing or malformed."""
+    try:
+        short, daily = (int(part) for part in value.split(','))
+        return short, daily
+    except (AttributeError, ValueError):
+        return None
+
+class ImportPaused(Exception):
+    """The import has to stop for now; it can continue at ``resume_after`` (epoch seconds)."""
+
+    def __init__(self, reason, resume_after):
+        super().__init__(f"{reason}, resume after {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(resume_after))} UTC")
+        self.reason = reason
+        self.resume_after = resume_after
+
+class RateLimiter:
+    """Budget for the Strava calls of one import, shared by its workers.
+
+    Strava reports the application's limits and usage for the 15-minute window
+    and the day in the X-RateLimit-* headers (X-ReadRateLimit-* for the read
+    limits, where sent). A call is admitted while the stricter of them leaves
+    room after keeping RATE_LIMIT_RESERVE for live uploads. Until the first
+    response arrives, one call at a time probes the headers.
+    """
+
+    def __init__(self, reserve=RATE_LIMIT_RESERVE):
+        self.reserve = reserve
+        self.condition = threading.Condition()
+        self.limits = None  # (15-minute, daily)
+        self.usage = [0, 0]
+        self.window_end = None  # end of the 15-minute window the usage was reported in
+        self.in_flight = 0
+
+    def _headroom(self, now):
+        if now >= self.window_end:
+            # A new window started since the last response
+            self.usage[0] = 0
+            self.window_end = _next_boundary(now, SHORT_WINDOW_SECONDS)
+        return [limit * (1 - self.reserve) - used - self.in_flight for limit, used in zip(self.limits, self.usage)]
+
+    def resume_after(self, now=None):
+        """When calls can be made again once the current budget is used up."""
+        now = now or time.time()
+        if self.limits is not None and self.usage[1] >= self.limits[1] * (1 - self.reserve):
+            return _next_boundary(now, DAY_SECONDS)
+        return _next_boundary(now, SHORT_WINDOW_SECONDS)
+
+    def acquire(self, deadline):
+        """Wait for room for one call; raises ImportPaused if there is none before ``deadline``."""
+        with self.condition:
+            while True:
+                now = time.time()
+                if now >= deadline:
+                    raise ImportPaused('run time used up', now)
+                if self.limits is None:
+                    if self.in_flight == 0:
+                        break
+                    wait = deadline - now
+                else:
+                    short, daily = self._headroom(now)
+                    if short >= 1 and daily >= 1:
+                        break
+                    if self.in_flight:
+                        # Responses in flight bring fresh usage
+                        wait = deadline - now
+                    elif daily < 1:
+                        raise ImportPaused('daily rate limit reached', self.resume_after(now))
+                    elif self.window_end > deadline:
+                        raise ImportPaused('15-minute rate limit reached', self.window_end)
+                    else:
+                        wait = self.window_end - now
+                self.condition.wait(timeout=min(wait, 5.0))
+            self.in_flight += 1
+
+    def release(self, response=None):
+        with self.condition:
+            self.in_flight -= 1
+            if response is not None:
+                self._update(response.headers)
+            self.condition.notify_all()
+
+    def _update(self, headers):
+        limits, usage = None, None
+        for prefix in ('X-RateLimit', 'X-ReadRateLimit'):
+            limit, used = _header_pair(headers.get(f'{prefix}-Limit')), _header_pair(headers.get(f'{prefix}-Usage'))
+            if not (limit and used):
+                continue
+            if limits is None:
+                limits, usage = list(limit), list(used)
+                continue
+            for index in (0, 1):
+                if limit[index] - used[index] < limits[index] - usage[index]:
+                    limits[index], usage[index] = limit[index], used[index]
+        if limits is None:
+            return
+        window_end = _next_boundary(time.time(), SHORT_WINDOW_SECONDS)
+        if self.limits is not None and window_end == self.window_end:
+            # Responses can arrive out of order; usage within a window only grows
+            usage = [max(new, old) for new, old in zip(usage, self.usage)]
+        self.limits, self.usage, self.window_end = tuple(limits), usage, window_end
+
+class StravaClient:
+    """Strava API calls for one athlete over pooled connections, within the rate limiter's budget."""
+
+    def __init__(self, athlete_id, limiter, deadline):
+        self.athlete_id = athlete_id
+        self.limiter = limiter
+        self.deadline = deadline
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=IMPORT_WORKERS))
+        self.token_lock = threading.Lock()
+        self.tokens_blob = get_bucket().blob(f'tokens/{athlete_id}.json')
+        self.tokens = json.loads(self.tokens_blob.download_as_bytes())
+        self.calls = 0
+
+    def _refresh(self, stale_token):
+        with self.token_lock:
+            if self.tokens.get('access_token') != stale_token:
+                return  # another worker refreshed it already
+            payload = {
+                'client_id': CLIENT_ID,
+                'client_secret': CLIENT_SECRET,
+                'refresh_token': self.tokens['refresh_token'],
+                'grant_type': 'refresh_token'
+            }
+            with tracing.span('strava.refresh_token') as call:
+                response = requests.post(AUTH_URL, data=payload)
+                call.set('http.status_code', response.status_code)
+            if response.status_code != 200:
+                raise ValueError(f"Failed to refresh access token: {response.text}")
+            data = response.json()
+            self.tokens = {
+                'access_token': data['access_token'],
+                'refresh_token': data.get('refresh_token', self.tokens['refresh_token']),
+                'expires_at': data.get('expires_at')
+            }
+            self.tokens_blob.upload_from_string(json.dumps(self.tokens))
+            logger.info(f"Refreshed access token for athlete {self.athlete_id}")
+
+    def get(self, path, **params):
+        """GET an API path; refreshes the token once on 401, raises ImportPaused when out of budget."""
+        for attempt in range(2):
+            token = self.tokens.get('access_token')
+            expires_at = self.tokens.get('expires_at')
+            if expires_at and expires_at < time.time() + 60:
+                self._refresh(token)
+                token = self.tokens['access_token']
+
+            self.limiter.acquire(self.deadline)
+            response = None
+            try:
+                with tracing.span('strava.get', **{'http.url': f'{API_URL}{path}'}) as call:
+                    response = self.session.get(f'{API_URL}{path}', params=params, timeout=30,
+                                                headers={'Authorization': f'Bearer {token}'})
+                    call.set('http.status_code', response.status_code)
+            finally:
+                self.limiter.release(response)
+            self.calls += 1
+
+            if response.status_code == 401 and attempt == 0:
+                self._refresh(token)
+                continue
+            if response.status_code == 429:
+                raise ImportPaused('rate limited by Strava', self.limiter.resume_after())
+            response.raise_for_status()
+            return response.json()
+
+class Checkpoint:
+    """Progress of one athlete's import, stored as ``imports/athlete_<id>.json``.
+
+    Writes are conditional on the generation this invocation last read or
+    wrote, so two invocations never import the same athlete at once: the one
+    that writes second gets PreconditionFailed and stops.
+    """
+
+    def __init__(self, athlete_id):
+        self.blob = get_bucket().blob(f'{CHECKPOINT_PREFIX}/athlete_{athlete_id}.json')
+        self.generation = 0
+        self.state = {
+            'athlete_id': athlete_id,
+            'status': 'running',
+            'started_at': time.time(),
+            'updated_at': None,
+            'finished_at': None,
+            'before': None,  # cursor: the next page lists activities that started before this
+            'pages': 0,
+            'listed': 0,
+            'imported': 0,
+            'documents': 0,
+            'estimated_total': None,
+            'failed': [],
+            'unsent': [],
+            'etl_batches': 0,
+            'api_calls': 0,
+            'run_seconds': 0.0,
+            'resume_after': None,
+            'pause_reason': None,
+            'lease_until': 0,
+        }
+
+    def load(self):
+        blob = get_bucket().get_blob(self.blob.name)
+        if blob is not None:
+            self.state.update(json.loads(blob.download_as_bytes(if_generation_match=blob.generation)))
+            self.generation = blob.generation
+        return self.state
+
+    def save(self):
+        self.state['updated_at'] = time.time()
+        self.blob.upload_from_string(json.dumps(self.state), content_type='application/json',
+                                     if_generation_match=self.generation)
+        self.generation = self.blob.generation
+
+def stored_activity_ids(athlete_id):
+    """Ids of the activities whose documents are already stored (by an earlier run or by fetch-data)."""
+    prefix = activity_documents.document_path(athlete_id, '', 'activities').rsplit('_activities.json', 1)[0]
+    pattern = re.compile(rf'^{re.escape(prefix)}(\d+)_activities\.json$')
+    with tracing.span('gcs.list', bucket=BUCKET_NAME, prefix=prefix):
+        names = [blob.name for blob in get_bucket().list_blobs(prefix=prefix)]
+    return {match.group(1) for match in map(pattern.match, names) if match}
+
+def estimate_total(strava, athlete_id):
+    """Number of rides, runs and swims on the athlete's profile (Strava has no count for other types)."""
+    stats = strava.get(f'/athletes/{athlete_id}/stats')
+    return sum((stats.get(f'all_{kind}_totals') or {}).get('count', 0) for kind in ('ride', 'run', 'swim'))
+
+def import_activity(strava, athlete_id, activity_id):
+    """Fetch one activity and store it as fetch-data would, laps first.
+
+    The detailed activity includes its laps, so most activities cost one call.
+    """
+    document = strava.get(f'/activities/{activity_id}', include_all_efforts='false')
+    laps = document.get('laps')
+    if laps is None:
+        laps = strava.get(f'/activities/{activity_id}/laps')
+
+    bucket = get_bucket()
+    # The activity document goes last: once it exists the activity counts as imported
+    for data_type, data in (('laps', laps), ('activities', document)):
+        blob = bucket.blob(activity_documents.document_path(athlete_id, activity_id, data_type))
+        with tracing.span('gcs.upload', bucket=BUCKET_NAME, object=blob.name):
+            blob.upload_from_string(json.dumps(data))
+
+def import_page(strava, athlete_id, activity_ids):
+    """Import activities concurrently; returns {activity_id: None or the exception it raised}."""
+    with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as pool:
+        # Each fetch runs in a copy of this context so its spans join the import's trace
+        futures = {
+            activity_id: pool.submit(contextvars.copy_context().run, import_activity, strava, athlete_id, activity_id)
+            for activity_id in activity_ids
+        }
+    return {activity_id: future.exception() for activity_id, future in futures.items()}
+
+def send_etl_batches(state, flush=False):
+    """Publish imported activities to the ETL in messages of ETL_BATCH_SIZE (and the remainder on flush)."""
+    while state['unsent'] and (flush or len(state['unsent']) >= ETL_BATCH_SIZE):
+        batch, state['unsent'] = state['unsent'][:ETL_BATCH_SIZE], state['unsent'][ETL_BATCH_SIZE:]
+        message = json.dumps({'activity_keys': batch}).encode('utf-8')
+        with tracing.span('pubsub.publish', kind='producer', topic=ETL_TOPIC, activities=len(batch)):
+            get_publisher().publish(ETL_TOPIC, message, **tracing.message_attributes()).result()
+        state['etl_batches'] += 1
+
+def progress(state):
+    """Summary of an import for logs and the resume_imports response."""
+    total = state.get('estimated_total')
+    minutes = state.get('run_seconds', 0) / 60
+    return {
+        'athlete_id': state['athlete_id'],
+        'status': state['status'],
+        'documents': state['documents'],
+        'estimated_total': total,
+        'percent': round(min(100.0, 100 * state['documents'] / total), 1) if total else None,
+        'imported': state['imported'],
+        'failed': len(state['failed']),
+        'etl_batches': state['etl_batches'],
+        'activities_per_minute': round(state['imported'] / minutes, 1) if minutes else None,
+        'resume_after': state['resume_after'],
+        'pause_reason': state['pause_reason'],
+    }
+
+def run_import(athlete_id, deadline):
+    """Import as much of an athlete's history as budget and ``deadline`` allow; returns the state.
+
+    Pages are listed newest first with a ``before`` cursor, so activities
+    uploaded meanwhile don't shift the pages. The checkpoint advances after
+    each page; activities already stored are skipped, so an interrupted page
+    is simply listed again.
+    """
+    checkpoint = Checkpoint(athlete_id)
+    state = checkpoint.load()
+    now = time.time()
+    if state['status'] == 'done' or state['lease_until'] > now or (state['resume_after'] or 0) > now:
+        logger.info(f"Import for athlete {athlete_id} is {state['status']}"
+                    f"{' in another invocation' if state['lease_until'] > now else ''}; nothing to do")
+        return state
+    state.update(status='running', lease_until=deadline + 60, resume_after=None, pause_reason=None)
+    checkpoint.save()
+
+    started = time.time()
+    limiter = RateLimiter()
+    strava = StravaClient(athlete_id, limiter, deadline)
+    stored = stored_activity_ids(athlete_id)
+    try:
+        if state['estimated_total'] is None:
+            state['estimated_total'] = estimate_total(strava, athlete_id)
+        while True:
+            params = {'per_page': PAGE_SIZE}
+            if state['before']:
+                params['before'] = state['before']
+            page = strava.get('/athlete/activities', **params)
+
+            todo = [str(activity['id']) for activity in page if str(activity['id']) not in stored]
+            paused = None
+            for activity_id, error in import_page(strava, athlete_id, todo).items():
+                if error is None:
+                    stored.add(activity_id)
+                    state['imported'] += 1
+                    state['unsent'].append({'athlete_id': str(athlete_id), 'activity_id': activity_id})
+                elif isinstance(error, ImportPaused):
+                    paused = paused or error
+                else:
+                    logger.warning(f"Failed to import activity {activity_id} of athlete {athlete_id}: {str(error)}")
+                    if len(state['failed']) < MAX_RECORDED_FAILURES:
+                        state['failed'].append(activity_id)
+            state['documents'] = len(stored)
+            send_etl_batches(state)
+            if paused:
+                raise paused
+
+            state['pages'] += 1
+            state['listed'] += len(page)
+            if page:
+                state['before'] = min(_epoch(activity['start_date']) for activity in page)
+            if len(page) < PAGE_SIZE:
+                state.update(status='done', finished_at=time.time())
+            state['api_calls'] += strava.calls
+            strava.calls = 0
+            checkpoint.save()
+            logger.info(f"Import for athlete {athlete_id}: {progress(state)}")
+            if state['status'] == 'done':
+                break
+    except ImportPaused as pause:
+        state.update(status='waiting', resume_after=pause.resume_after, pause_reason=pause.reason)
+        logger.info(f"Import for athlete {athlete_id} paused: {str(pause)}")
+    finally:
+        # Whatever was stored goes to the ETL now, even if the run stops early
+        send_etl_batches(state, flush=True)
+        state['api_calls'] += strava.calls
+        state['run_seconds'] += time.time() - started
+        state['lease_until'] = 0
+        checkpoint.save()
+    return state
+
+def _epoch(start_date):
+    return calendar.timegm(time.strptime(start_date, '%Y-%m-%dT%H:%M:%SZ'))
+
+def start_import(athlete_id):
+    """Queue an import (or its continuation) for an athlete."""
+    message = json.dumps({'athlete_id': str(athlete_id)}).encode('utf-8')
+    with tracing.span('pubsub.publish', kind='producer', topic=IMPORT_TOPIC):
+        get_publisher().publish(IMPORT_TOPIC, message, **tracing.message_attributes()).result()
+
+@functions_framework.cloud_event
+@tracing.traced('import_history')
+def import_history(cloud_event):
+    """Import an athlete's activity history, triggered by oauth_flow or resume_imports."""
+    from google.api_core.exceptions import PreconditionFailed
+
+    try:
+        pubsub_message = base64.b64decode(cloud_event.data["message"]["data"]).decode()
+        athlete_id = str(json.loads(pubsub_message)['athlete_id'])
+        logger.info(f"Importing history for athlete {athlete_id}")
+
+        try:
+            state = run_import(athlete_id, time.time() + IMPORT_RUN_SECONDS)
+        except PreconditionFailed:
+            logger.info(f"Another invocation is importing athlete {athlete_id}; stopping")
+            return 'Import already running', 200
+
+        # Out of run time but not of budget: carry on in a fresh invocation right away
+        if state['status'] == 'waiting' and (state['resume_after'] or 0) <= time.time():
+            start_import(athlete_id)
+        return json.dumps(progress(state)), 200
+
+    except Exception as e:
+        logger.error(f"Error in import_history: {str(e)}", exc_info=True)
+        return f'Error: {str(e)}', 500
+
+@functions_framework.http
+@tracing.traced('resume_imports', kind='server')
+def resume_imports(request):
+    """Report the progress of every import and continue those that can (run on a schedule).
+
+    ``?athlete_id=<id>`` starts an import for an athlete who authorized before imports existed.
+    """
+    athlete_id = request.args.get('athlete_id') if request is not None else None
+    if athlete_id:
+        start_import(athlete_id)
+        return json.dumps({'started': athlete_id}), 200
+
+    now = time.time()
+    imports, resumed = [], []
+    for blob in get_bucket().list_blobs(prefix=f'{CHECKPOINT_PREFIX}/'):
+        state = json.loads(blob.download_as_bytes())
+        imports.append(progress(state))
+        if state['status'] != 'done' and (state['resume_after'] or 0) <= now and state['lease_until'] <= now:
+            start_import(state['athlete_id'])
+            resumed.append(state['athlete_id'])
+    logger.info(f"{len(imports)} imports, resumed {resumed}")
+    return json.dumps({'imports': imports, 'resumed': resumed}), 200
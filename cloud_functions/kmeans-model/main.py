@@ -1,52 +1,62 @@
-from google.cloud import bigquery, storage
+from google.cloud import bigquery
 import functions_framework
-import pandas as pd
-from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
-import joblib
-import os
+import model_registry
+import bq_arrow
+
+# Features the model is trained on; recorded in the version manifest
+FEATURES = ['distance', 'moving_time', 'suffer_score']
+N_CLUSTERS = 4
 
 @functions_framework.http  # Change from cloud_event to http
 def train_kmeans(request):
-    # Initialize BigQuery and GCS clients
+    # Initialize BigQuery client
     bq_client = bigquery.Client(project="strava-etl")
-    storage_client = storage.Client(project="strava-etl")
 
     # Read preprocessed data
-    query = """
-        SELECT distance, moving_time, suffer_score
+    query = f"""
+        SELECT {', '.join(FEATURES)}
         FROM `strava-etl.strava_data.clustering_data`
     """
-    df = bq_client.query(query).to_dataframe()
+    df, _ = bq_arrow.query_to_frame(bq_client, query)
+    df = df.dropna()
 
     # Check if data is sufficient
-    if df.empty:
+    if len(df) <= N_CLUSTERS:
         print("No data available for training.")
         return "No data available for training.", 200
 
+    # scikit-learn and the storage client are only needed once there is data to train on
+    from google.cloud import storage
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.cluster import KMeans
+    from sklearn.metrics import silhouette_score
+
     # Standardize features
     scaler = StandardScaler()
     X_scaled = scaler.fit_transform(df)
 
     # Train K-Means model
-    kmeans = KMeans(n_clusters=4, random_state=42)
+    kmeans = KMeans(n_clusters=N_CLUSTERS, random_state=42)
     kmeans.fit(X_scaled)
 
-    # Save scaler and model to GCS
-    bucket_name = 'strava-models'
-    bucket = storage_client.bucket(bucket_name)
+    # Name clusters from their centroids so the label map always matches this model
+    centroids = scaler.inverse_transform(kmeans.cluster_centers_)
+    cluster_labels = model_registry.name_clusters(centroids.tolist(), FEATURES)
 
-    # Save scaler
-    scaler_blob = bucket.blob('models/scaler.joblib')
-    scaler_path = '/tmp/scaler.joblib'
-    joblib.dump(scaler, scaler_path)
-    scaler_blob.upload_from_filename(scaler_path)
+    metrics = {
+        'n_samples': int(len(df)),
+        'inertia': float(kmeans.inertia_),
+        'silhouette': float(silhouette_score(
+            X_scaled, kmeans.labels_, sample_size=min(len(df), 5000), random_state=42
+        )),
+    }
 
-    # Save model
-    model_blob = bucket.blob('models/kmeans_model.joblib')
-    model_path = '/tmp/kmeans_model.joblib'
-    joblib.dump(kmeans, model_path)
-    model_blob.upload_from_filename(model_path)
+    # Publish a new immutable version and promote it to current
+    storage_client = storage.Client(project="strava-etl")
+    bucket = storage_client.bucket(model_registry.MODEL_BUCKET)
+    version = model_registry.publish_version(
+        bucket, scaler, kmeans, FEATURES, cluster_labels, metrics=metrics
+    )
 
-    print("Model and scaler saved to GCS.")
-    return "Model training complete and saved to GCS.", 200
+    print(f"Model version {version} saved to GCS with metrics {metrics}.")
+    return f"Model training complete and saved to GCS as version {version}.", 200
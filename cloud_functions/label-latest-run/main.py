@@ -1,63 +1,74 @@
+from datetime import timedelta
 from google.cloud import bigquery
 from google.cloud import storage
-import joblib
+import pandas as pd
+import model_registry
+import feature_store
+import bq_arrow
+import watermarks
+
+LABELS_TABLE = "strava-etl.strava_data.clustering_labels"
+ACTIVITIES_TABLE = "strava-etl.strava_data.activities"
+WATERMARK_NAME = "label_runs"
+
+# Read recent activities from this far behind the watermark so late loads are labeled; older
+# activities without a label (imported history) are found by an anti-join on id, and the
+# anti-join against the whole labels table keeps the overlap from double-labeling
+LOOKBACK = timedelta(days=2)
+
+LABEL_COLUMNS = ["id", "athlete_id", "start_date", "distance", "moving_time", "average_heartrate", "run_type_str"]
+
+def find_unlabeled_runs(client, since):
+    """Return every activity that has no row in the labels table.
+
+    With ``since``, activities up to it are only looked at by id and start
+    date (``feature_store.incremental_sql``) and their features are read
+    only for those without a label.
+    """
+    select, query_parameters, older = feature_store.select_sql(ACTIVITIES_TABLE), [], 0
+    if since is not None:
+        select, query_parameters, older = feature_store.incremental_sql(client, LABELS_TABLE, since, ACTIVITIES_TABLE)
+
+    query = f"""
+        SELECT F.*
+        FROM ({select}) F
+        LEFT JOIN (SELECT CAST(id AS STRING) AS id FROM `{LABELS_TABLE}`) L
+        ON L.id = F.id
+        WHERE L.id IS NULL
+    """
+    runs, job = bq_arrow.query_to_frame(client, query, job_config=bigquery.QueryJobConfig(query_parameters=query_parameters))
+    print(f"Found {len(runs)} unlabeled runs since {since}, {older} of them older "
+          f"({job.total_bytes_processed} bytes processed)")
+    return runs
 
 def process_new_run(event, context):
+    """Label every run that arrived since the last invocation in one batch."""
     # Initialize BigQuery client
     client = bigquery.Client()
-    table_id = "strava-etl.strava_data.clustering_labels"
-    activities_table = "strava-etl.strava_data.activities"
 
-    # Fetch the latest activity
-    query = f"""
-        SELECT id, start_date, distance, moving_time, average_heartrate
-        FROM `{activities_table}`
-        ORDER BY start_date DESC
-        LIMIT 1
-    """
-    latest_run = client.query(query).to_dataframe()
+    # Load the current model version (cached per version for the life of the instance)
+    storage_client = storage.Client(project="strava-etl")
+    registered = model_registry.load_version(storage_client.bucket(model_registry.MODEL_BUCKET))
+
+    watermark = watermarks.get_watermark(client, WATERMARK_NAME)
+    since = pd.Timestamp(watermark) - LOOKBACK if watermark is not None else None
+    new_runs = find_unlabeled_runs(client, since)
 
-    if latest_run.empty:
+    if new_runs.empty:
         return "No new runs found", 200
 
-    # Load scaler and model from GCS
-    storage_client = storage.Client(project="strava-etl")
-    bucket_name = "strava-models"
-
-    scaler_blob = storage_client.bucket(bucket_name).blob("models/scaler_1.joblib")
-    model_blob = storage_client.bucket(bucket_name).blob("models/kmeans_model_1.joblib")
-
-    scaler_bytes = scaler_blob.download_as_bytes()
-    scaler = joblib.load(io.BytesIO(scaler_bytes))
-
-    model_bytes = model_blob.download_as_bytes()
-    model = joblib.load(io.BytesIO(model_bytes))
-
-    # Predict cluster label for the latest run
-    features = latest_run[["distance", "moving_time", "average_heartrate"]]
-    scaled_features = scaler.transform(features)
-    label = model.predict(scaled_features)[0]
-
-    # Map cluster label to run type
-    cluster_labels = {
-        0: "Marathon Prep",
-        1: "Medium-Distance Steady Run",
-        2: "Low-Intensity Run",
-        3: "Long Tempo Run"
-    }
-    run_type = cluster_labels[label]
-
-    # Insert the new run with the cluster label into the clustering_labels table
-    row_to_insert = {
-        "id": latest_run.iloc[0]["id"],
-        "start_date": latest_run.iloc[0]["start_date"],
-        "distance": latest_run.iloc[0]["distance"],
-        "moving_time": latest_run.iloc[0]["moving_time"],
-        "average_heartrate": latest_run.iloc[0]["average_heartrate"],
-        "run_type": run_type
-    }
-    errors = client.insert_rows_json(table_id, [row_to_insert])
-    if errors:
-        return f"Errors occurred: {errors}", 500
-
-    return "Latest run processed successfully", 200
\ No newline at end of file
+    # Score all new runs at once
+    new_runs["run_type_str"] = model_registry.predict_run_types(registered, new_runs)
+    new_runs["id"] = new_runs["id"].astype("int64")
+
+    # Write them with a single load job instead of per-row streaming inserts
+    job_config = bigquery.LoadJobConfig(
+        write_disposition="WRITE_APPEND",
+        schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION],
+    )
+    client.load_table_from_dataframe(new_runs[LABEL_COLUMNS], LABELS_TABLE, job_config=job_config).result()
+
+    # set_watermark never moves it back, so backfilled older runs leave it where it is
+    watermarks.set_watermark(client, WATERMARK_NAME, pd.Timestamp(new_runs["start_date"].max()).to_pydatetime())
+
+    return f"Labeled {len(new_runs)} runs with model {registered.version}", 200
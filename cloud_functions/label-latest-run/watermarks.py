@@ -0,0 +1 @@
+../common/watermarks.py
\ No newline at end of file
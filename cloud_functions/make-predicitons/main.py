@@ -1,20 +1,19 @@
 import functions_framework
-from google.cloud import storage
-import pandas as pd
-from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
-import joblib
 import json
 import base64
 import logging
 import requests
 import os
-import tempfile
+import activity_documents
+import model_registry
+import feature_store
+import tracing
 
-# Configure logging
+# Configure logging; every line carries the trace it belongs to
+tracing.instrument_logging()
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(levelname)s - [trace %(trace_id)s] %(message)s'
 )
 logger = logging.getLogger(__name__)
 
@@ -23,11 +22,14 @@ CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
 AUTH_URL = 'https://www.strava.com/oauth/token'
 
-def load_model_from_gcs(blob, temp_dir):
-    """Load a joblib model from GCS blob using a temporary file."""
-    temp_path = os.path.join(temp_dir, 'temp_model')
-    blob.download_to_filename(temp_path)
-    return joblib.load(temp_path)
+# The storage client is created on first use and reused by warm invocations
+_clients = {}
+
+def get_storage_client():
+    if 'storage' not in _clients:
+        from google.cloud import storage
+        _clients['storage'] = storage.Client()
+    return _clients['storage']
 
 def refresh_access_token(refresh_token, athlete_id, storage_client):
     """Refresh the access token using the provided refresh token."""
@@ -38,7 +40,9 @@ def refresh_access_token(refresh_token, athlete_id, storage_client):
         'grant_type': 'refresh_token'
     }
     
-    response = requests.post(AUTH_URL, data=payload)
+    with tracing.span('strava.refresh_token') as call:
+        response = requests.post(AUTH_URL, data=payload)
+        call.set('http.status_code', response.status_code)
     response_data = response.json()
     
     if response.status_code == 200:
@@ -52,7 +56,8 @@ def refresh_access_token(refresh_token, athlete_id, storage_client):
         }
         bucket = storage_client.bucket('strava-users')
         blob = bucket.blob(f'tokens/{athlete_id}.json')
-        blob.upload_from_string(json.dumps(tokens))
+        with tracing.span('gcs.upload', bucket=bucket.name, object=blob.name):
+            blob.upload_from_string(json.dumps(tokens))
         
         return access_token
     else:
@@ -62,13 +67,16 @@ def get_access_token(athlete_id, storage_client):
     """Retrieve or refresh the access token for a given athlete ID."""
     bucket = storage_client.bucket('strava-users')
     blob = bucket.blob(f'tokens/{athlete_id}.json')
-    tokens = json.loads(blob.download_as_string())
+    with tracing.span('gcs.download', bucket=bucket.name, object=blob.name):
+        tokens = json.loads(blob.download_as_string())
     access_token = tokens.get('access_token')
     refresh_token = tokens.get('refresh_token')
 
     # Test the current access token
     headers = {"Authorization": f"Bearer {access_token}"}
-    test_response = requests.get("https://www.strava.com/api/v3/athlete", headers=headers)
+    with tracing.span('strava.get_athlete') as call:
+        test_response = requests.get("https://www.strava.com/api/v3/athlete", headers=headers)
+        call.set('http.status_code', test_response.status_code)
     
     if test_response.status_code == 401:  # Token expired
         logger.info("Access token expired, refreshing...")
@@ -76,32 +84,42 @@ def get_access_token(athlete_id, storage_client):
     
     return access_token
 
-def update_activity_description(activity_id: str, run_type: str, access_token: str) -> None:
-    """Update the activity description in Strava with the predicted run type."""
+def update_activity_description(activity_id: str, run_type: str, access_token: str, document=None) -> None:
+    """Update the activity description in Strava with the predicted run type.
+
+    ``document`` is the activity as stored by fetch-data; without it the
+    current description is read from the Strava API first.
+    """
     url = f'https://www.strava.com/api/v3/activities/{activity_id}'
     headers = {'Authorization': f'Bearer {access_token}'}
     
     # First get the current description
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        current_desc = response.json().get('description', '')
-        
-        # Prepare new description
-        if current_desc:
-            new_desc = f'Predicted Run Type: {run_type}\n\n{current_desc}'
-        else:
-            new_desc = f'Predicted Run Type: {run_type}'
-        
-        # Update the activity
-        payload = {'description': new_desc}
-        update_response = requests.put(url, headers=headers, json=payload)
-        
-        if update_response.status_code != 200:
-            raise Exception(f"Failed to update activity description: {update_response.text}")
+    if document is None:
+        with tracing.span('strava.get_activity', **{'http.url': url}) as call:
+            response = requests.get(url, headers=headers)
+            call.set('http.status_code', response.status_code)
+        if response.status_code != 200:
+            raise Exception(f"Failed to get activity details: {response.text}")
+        document = response.json()
+    current_desc = document.get('description') or ''
+    
+    # Prepare new description
+    if current_desc:
+        new_desc = f'Predicted Run Type: {run_type}\n\n{current_desc}'
     else:
-        raise Exception(f"Failed to get activity details: {response.text}")
+        new_desc = f'Predicted Run Type: {run_type}'
+    
+    # Update the activity
+    payload = {'description': new_desc}
+    with tracing.span('strava.update_activity', **{'http.url': url}) as call:
+        update_response = requests.put(url, headers=headers, json=payload)
+        call.set('http.status_code', update_response.status_code)
+    
+    if update_response.status_code != 200:
+        raise Exception(f"Failed to update activity description: {update_response.text}")
 
 @functions_framework.cloud_event
+@tracing.traced('make_predictions')
 def make_predictions(cloud_event):
     """
     Cloud Function to predict run type from activity data and update Strava description.
@@ -125,45 +143,54 @@ def make_predictions(cloud_event):
         if not all([athlete_id, activity_id, prediction_data]):
             raise ValueError("Missing required data in Pub/Sub message")
         
-        # Initialize storage client
-        storage_client = storage.Client()
+        storage_client = get_storage_client()
         
-        # Create DataFrame from prediction data
-        df = pd.DataFrame([prediction_data])
-        X_new = df[['distance', 'moving_time', 'suffer_score']]
+        # Load the current model version (cached per version for the life of the instance)
+        with tracing.span('gcs.load_model', bucket=model_registry.MODEL_BUCKET) as call:
+            registered = model_registry.load_version(storage_client.bucket(model_registry.MODEL_BUCKET))
+            call.set('model.version', registered.version)
+        logger.info(f"Using model version {registered.version}")
+
+        # Prefer the online feature store; fall back to the features carried in the message
+        try:
+            with tracing.span('gcs.feature_store_get', bucket=feature_store.FEATURE_BUCKET):
+                online_features = feature_store.get_online_store(storage_client).get(activity_id)
+        except Exception as e:
+            logger.warning(f"Online feature lookup failed for activity {activity_id}: {str(e)}")
+            online_features = None
+        logger.info(f"Online features {'found' if online_features else 'not found'} for activity {activity_id}")
+
+        # Create DataFrame from prediction data; pandas is imported here so a cold start doesn't pay for it
+        import pandas as pd
+        df = pd.DataFrame([online_features or prediction_data])
+        missing = [f for f in registered.features if f not in df.columns]
+        if missing:
+            raise ValueError(f"Prediction data is missing features {missing} required by model {registered.version}")
+        X_new = df[registered.features]
         logger.info(f"Feature data: {X_new.to_dict()}")
-        
-        # Load models from Cloud Storage
-        bucket = storage_client.bucket('strava-models')
-        
-        # Create temporary directory for model files
-        with tempfile.TemporaryDirectory() as temp_dir:
-            logger.info("Loading models")
-            scaler = load_model_from_gcs(bucket.blob('models/scaler.joblib'), temp_dir)
-            kmeans = load_model_from_gcs(bucket.blob('models/kmeans_model.joblib'), temp_dir)
-            
-            # Make prediction
-            logger.info("Making prediction")
-            X_scaled = scaler.transform(X_new)
-            cluster = kmeans.predict(X_scaled)[0]
-            
-            # Map cluster to run type
-            cluster_labels = {
-                0: "Low-Intensity Run",
-                1: "Medium-Distance Steady Run",
-                2: "Marathon Prep",
-                3: "Long Tempo Run"
-            }
-            run_type = cluster_labels.get(cluster, "Unknown Run Type")
-            logger.info(f"Predicted run type: {run_type}")
-            
-            # Get Strava token and update description
-            access_token = get_access_token(athlete_id, storage_client)
-            update_activity_description(activity_id, run_type, access_token)
-            
-            logger.info(f"Successfully processed activity {activity_id}")
-            return ('Success', 200)
-            
+
+        # Make prediction
+        logger.info("Making prediction")
+        run_type = model_registry.predict_run_types(registered, X_new)[0]
+        logger.info(f"Predicted run type: {run_type}")
+
+        # The activity as fetch-data stored it saves a Strava GET for the current description
+        try:
+            bucket = storage_client.bucket(activity_documents.DOCUMENT_BUCKET)
+            with tracing.span('gcs.activity_document', bucket=bucket.name) as call:
+                document = activity_documents.get(bucket, athlete_id, activity_id)
+                call.set('found', document is not None)
+        except Exception as e:
+            logger.warning(f"Stored document lookup failed for activity {activity_id}: {str(e)}")
+            document = None
+
+        # Get Strava token and update description
+        access_token = get_access_token(athlete_id, storage_client)
+        update_activity_description(activity_id, run_type, access_token, document)
+
+        logger.info(f"Successfully processed activity {activity_id}")
+        return ('Success', 200)
+
     except Exception as e:
         logger.error(f"Error in prediction pipeline: {str(e)}", exc_info=True)
         return (f'Error: {str(e)}', 500)
\ No newline at end of file
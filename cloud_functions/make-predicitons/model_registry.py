@@ -0,0 +1 @@
+../common/model_registry.py
\ No newline at end of file
@@ -1,5 +1,4 @@
 import functions_framework
-from google.cloud import storage
 import requests
 import json
 import os
@@ -11,14 +10,39 @@ REDIRECT_URI = os.environ.get('REDIRECT_URI')
 
 # Cloud Storage settings
 BUCKET_NAME = 'strava-users'
+# A new athlete's activity history is imported by import-history
+IMPORT_TOPIC = 'projects/strava-etl/topics/import-history'
 
-storage_client = storage.Client()
-bucket = storage_client.bucket(BUCKET_NAME)
+# Only the callback writes to Cloud Storage and Pub/Sub, so the clients are created on first use
+_clients = {}
+
+def get_bucket():
+    if 'bucket' not in _clients:
+        from google.cloud import storage
+        _clients['bucket'] = storage.Client().bucket(BUCKET_NAME)
+    return _clients['bucket']
+
+def get_publisher():
+    if 'publisher' not in _clients:
+        from google.cloud import pubsub_v1
+        _clients['publisher'] = pubsub_v1.PublisherClient()
+    return _clients['publisher']
 
 def save_tokens(athlete_id, tokens):
-    blob = bucket.blob(f'tokens/{athlete_id}.json')
+    blob = get_bucket().blob(f'tokens/{athlete_id}.json')
     blob.upload_from_string(json.dumps(tokens))
 
+def start_history_import(athlete_id):
+    """Queue the import of the athlete's existing activities; True if it was queued."""
+    message = json.dumps({'athlete_id': str(athlete_id)}).encode('utf-8')
+    try:
+        get_publisher().publish(IMPORT_TOPIC, message).result()
+        return True
+    except Exception as e:
+        # The tokens are saved, so the import can still be started later (resume_imports?athlete_id=...)
+        print(f"Failed to queue history import for athlete {athlete_id}: {str(e)}")
+        return False
+
 @functions_framework.http
 def oauth_flow(request):
     if 'code' in request.args:
@@ -36,6 +60,8 @@ def oauth_flow(request):
             tokens = response.json()
             athlete_id = tokens['athlete']['id']
             save_tokens(athlete_id, tokens)
+            if start_history_import(athlete_id):
+                return 'Authorization successful. Tokens saved. Your activity history is being imported.'
             return 'Authorization successful. Tokens saved.'
         else:
             return f'Error: {response.status_code}, {response.text}', 400
@@ -0,0 +1 @@
+../common/bq_arrow.py
\ No newline at end of file
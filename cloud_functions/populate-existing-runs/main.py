@@ -1,9 +1,26 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import functions_framework
 from google.cloud import bigquery
 from google.cloud import storage
-import joblib
-import io
+import model_registry
+import feature_store
+import bq_arrow
+import json
+
+# Rows per Arrow record batch read from BigQuery
+CHUNK_ROWS = 10000
+# Chunks scored concurrently; at most 2x this many chunks are held in memory
+MAX_WORKERS = 4
+# Changed rows buffered before they are appended to the temporary table
+FLUSH_ROWS = 50000
+
+def score_chunk(registered, df):
+    """Score one chunk and return only the rows whose run type changed."""
+    new_run_types = pd.Series(model_registry.predict_run_types(registered, df), index=df.index)
+    changed = new_run_types.ne(df["run_type_str"]).fillna(True).astype(bool)
+    return pd.DataFrame({"id": df.loc[changed, "id"], "run_type_str": new_run_types[changed]}), len(df)
 
 @functions_framework.http
 def populate_existing_labels(request):
@@ -11,44 +28,65 @@ def populate_existing_labels(request):
     client = bigquery.Client(project="strava-etl")
     table_id = "strava-etl.strava_data.clustering_labels_1"
     temp_table_id = "strava-etl.strava_data.temp_run_types"
-    
-    # Query the table to fetch existing rows
-    query = "SELECT id, distance, moving_time, average_heartrate FROM `strava-etl.strava_data.clustering_labels_1`"
-    df = client.query(query).to_dataframe()
 
-    # Load scaler and model from GCS
+    # Load the current model version
     storage_client = storage.Client(project="strava-etl")
-    bucket_name = "strava-models"
+    registered = model_registry.load_version(storage_client.bucket(model_registry.MODEL_BUCKET))
 
-    scaler_blob = storage_client.bucket(bucket_name).blob("models/scaler_1.joblib")
-    model_blob = storage_client.bucket(bucket_name).blob("models/kmeans_model_1.joblib")
+    # The labels table only carries some features; the model's own come from the feature definition,
+    # joined on id the way label-latest-run reads them
+    feature_columns = ', '.join(f'F.{name}' for name in registered.features)
+    query = f"""
+        SELECT L.id, L.run_type_str, {feature_columns}
+        FROM `{table_id}` L
+        JOIN ({feature_store.select_sql(feature_store.SOURCE_TABLE)}) F
+        ON F.id = CAST(L.id AS STRING)
+    """
+    # Stream the existing rows as Arrow record batches instead of one big DataFrame
+    chunks = bq_arrow.iter_frames(client, query, page_size=CHUNK_ROWS)
 
-    scaler_bytes = scaler_blob.download_as_bytes()
-    scaler = joblib.load(io.BytesIO(scaler_bytes))
+    stats = {"scanned": 0, "changed": 0}
+    buffer = []
+    buffered_rows = 0
+    write_disposition = "WRITE_TRUNCATE"
 
-    model_bytes = model_blob.download_as_bytes()
-    model = joblib.load(io.BytesIO(model_bytes))
+    def flush():
+        """Append the buffered changed rows to the temporary table."""
+        nonlocal buffer, buffered_rows, write_disposition
+        if not buffer:
+            return
+        job_config = bigquery.LoadJobConfig(write_disposition=write_disposition)
+        client.load_table_from_dataframe(pd.concat(buffer, ignore_index=True), temp_table_id, job_config=job_config).result()
+        write_disposition = "WRITE_APPEND"
+        buffer, buffered_rows = [], 0
 
-    # Prepare data for clustering
-    features = df[["distance", "moving_time", "average_heartrate"]]
-    scaled_features = scaler.transform(features)
-    labels = model.predict(scaled_features)
+    def collect(future):
+        nonlocal buffered_rows
+        changed, scanned = future.result()
+        stats["scanned"] += scanned
+        stats["changed"] += len(changed)
+        if not changed.empty:
+            buffer.append(changed)
+            buffered_rows += len(changed)
+        if buffered_rows >= FLUSH_ROWS:
+            flush()
 
-    # Map cluster labels to run types
-    cluster_labels = {
-        0: "Marathon Prep",
-        1: "Medium-Distance Steady Run",
-        2: "Low-Intensity Run",
-        3: "Long Tempo Run"
-    }
-    df["run_type_str"] = [cluster_labels[label] for label in labels]
+    # Score chunks in parallel while keeping the number of in-flight chunks bounded
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        in_flight = deque()
+        for chunk in chunks:
+            in_flight.append(pool.submit(score_chunk, registered, chunk))
+            if len(in_flight) >= 2 * MAX_WORKERS:
+                collect(in_flight.popleft())
+        while in_flight:
+            collect(in_flight.popleft())
+    flush()
 
-    # Load updated run_type_str values into a temporary table
-    job_config = bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE")
-    load_job = client.load_table_from_dataframe(df[["id", "run_type_str"]], temp_table_id, job_config=job_config)
-    load_job.result()  # Wait for the load job to complete
+    print(f"Rescored {stats['scanned']} rows with model {registered.version}; {stats['changed']} changed.")
+    if stats["changed"] == 0:
+        return json.dumps(stats), 200
 
-    # Use a MERGE statement to update the main table from the temporary table
+    # Use a MERGE statement to update only the changed rows in the main table
     merge_query = f"""
     MERGE `{table_id}` T
     USING `{temp_table_id}` S
@@ -58,5 +96,6 @@ def populate_existing_labels(request):
     """
 
     client.query(merge_query).result()
+    client.delete_table(temp_table_id, not_found_ok=True)
 
-    return "Run types updated successfully", 200
+    return json.dumps(stats), 200
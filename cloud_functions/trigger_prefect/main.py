@@ -4,77 +4,125 @@ import json
 import base64
 import os
 import sys
+import time
+import tracing
 
 PREFECT_API_URL = os.environ.get('PREFECT_API_URL')
 PREFECT_API_KEY = os.environ.get('PREFECT_API_KEY')
 PREFECT_DEPLOYMENT_ID = os.environ.get('PREFECT_DEPLOYMENT_ID')
 
-@functions_framework.cloud_event
-def trigger_prefect_flow(cloud_event):
-    print("Function triggered. Starting execution.")
-    
-    # Check for required environment variables
+# Pull subscription on the etl-trigger topic drained by dispatch_etl_batches
+ETL_TOPIC = os.environ.get('ETL_TOPIC', 'projects/strava-etl/topics/etl-trigger')
+ETL_SUBSCRIPTION = os.environ.get('ETL_SUBSCRIPTION', 'projects/strava-etl/subscriptions/etl-trigger-dispatch')
+# A batch is dispatched once it holds this many messages, or this long after buffering started
+BATCH_MAX_ACTIVITIES = int(os.environ.get('BATCH_MAX_ACTIVITIES', '50'))
+BATCH_MAX_WAIT_SECONDS = float(os.environ.get('BATCH_MAX_WAIT_SECONDS', '20'))
+# How long one dispatcher invocation keeps draining; keep it below the function timeout
+DISPATCH_RUN_SECONDS = float(os.environ.get('DISPATCH_RUN_SECONDS', '240'))
+# Messages Prefect did not accept are redelivered after this long rather than at once
+DISPATCH_RETRY_SECONDS = int(os.environ.get('DISPATCH_RETRY_SECONDS', '60'))
+
+# Clients are created on first use and reused by warm invocations
+_clients = {}
+
+def get_session():
+    """Pooled HTTP session, so warm invocations reuse the connection to the Prefect API."""
+    if 'session' not in _clients:
+        session = requests.Session()
+        session.headers.update({
+            "Authorization": f"Bearer {PREFECT_API_KEY}",
+            "Content-Type": "application/json"
+        })
+        _clients['session'] = session
+    return _clients['session']
+
+def get_subscriber():
+    if 'subscriber' not in _clients:
+        from google.cloud import pubsub_v1
+        _clients['subscriber'] = pubsub_v1.SubscriberClient()
+    return _clients['subscriber']
+
+def get_publisher():
+    if 'publisher' not in _clients:
+        from google.cloud import pubsub_v1
+        _clients['publisher'] = pubsub_v1.PublisherClient()
+    return _clients['publisher']
+
+def check_config():
+    """Error response when the Prefect settings are missing, else None."""
     if not PREFECT_API_KEY:
         print("Error: PREFECT_API_KEY is not set")
         return 'Error: PREFECT_API_KEY is not set', 500
     if not PREFECT_DEPLOYMENT_ID:
         print("Error: PREFECT_DEPLOYMENT_ID is not set")
         return 'Error: PREFECT_DEPLOYMENT_ID is not set', 500
+    return None
+
+def create_flow_run(activity_keys, traceparent=None):
+    """Create one ETL flow run covering ``activity_keys``; raises for an HTTP error response."""
+    url = f"{PREFECT_API_URL}/deployments/{PREFECT_DEPLOYMENT_ID}/create_flow_run"
+    payload = {
+        "parameters": {
+            "activity_keys": activity_keys,
+            # Lets the flow run continue this trace
+            "traceparent": traceparent
+        }
+    }
+
+    with tracing.span('prefect.create_flow_run', activities=len(activity_keys), **{'http.url': url}) as call:
+        response = get_session().post(url, json=payload)
+        call.set('http.status_code', response.status_code)
+
+    print(f"Response status code: {response.status_code}")
+    if response.status_code == 404:
+        print("Error: Deployment not found. Please check the PREFECT_DEPLOYMENT_ID.")
+    response.raise_for_status()
+    return response.json()
+
+def message_keys(message_data, traceparent=None):
+    """Activity keys of an ETL trigger message.
+
+    fetch-data sends one activity (``athlete_id``, ``activity_id``);
+    import-history sends a batch of them as ``activity_keys``.
+    """
+    pairs = message_data['activity_keys'] if 'activity_keys' in message_data else [message_data]
+    return [
+        {"athlete_id": str(pair['athlete_id']), "activity_id": str(pair['activity_id']), "traceparent": traceparent}
+        for pair in pairs
+    ]
+
+@functions_framework.cloud_event
+@tracing.traced('trigger_prefect_flow')
+def trigger_prefect_flow(cloud_event):
+    """Create a flow run for a single ETL trigger message (push subscription)."""
+    print("Function triggered. Starting execution.")
+    error = check_config()
+    if error:
+        return error
 
     try:
         print("Decoding Pub/Sub message.")
         pubsub_message = base64.b64decode(cloud_event.data["message"]["data"]).decode()
         message_data = json.loads(pubsub_message)
-        
+
         print(f"Parsed message data: {message_data}")
-        
-        athlete_id = str(message_data['athlete_id'])
-        activity_id = str(message_data['activity_id'])
-        
-        print(f"Athlete ID: {athlete_id}, Activity ID: {activity_id}")
-        
-        headers = {
-            "Authorization": f"Bearer {PREFECT_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "parameters": {
-                "athlete_id": athlete_id,
-                "activity_id": activity_id
-            }
-        }
-        
-        print("Preparing to send request to Prefect API.")
-        print(f"API URL: {PREFECT_API_URL}")
-        print(f"Deployment ID: {PREFECT_DEPLOYMENT_ID}")
-        
-        url = f"{PREFECT_API_URL}/deployments/{PREFECT_DEPLOYMENT_ID}/create_flow_run"
-        print(f"Full request URL: {url}")
-        
-        response = requests.post(
-            url,
-            headers=headers,
-            json=payload
-        )
-        
-        print(f"Response status code: {response.status_code}")
-        print(f"Response content: {response.text}")
-        
-        if response.status_code == 404:
-            print("Error: Deployment not found. Please check the PREFECT_DEPLOYMENT_ID.")
-            return 'Error: Deployment not found', 404
-        
-        response.raise_for_status()
-        flow_run = response.json()
-        print(f"Triggered Prefect flow run with id: {flow_run.get('id', 'Unknown')}")
+
+        traceparent = tracing.traceparent()
+        keys = message_keys(message_data, traceparent)
+        print(f"Activities: {[(key['athlete_id'], key['activity_id']) for key in keys]}")
+
+        for start in range(0, len(keys), BATCH_MAX_ACTIVITIES):
+            flow_run = create_flow_run(keys[start:start + BATCH_MAX_ACTIVITIES], traceparent)
+            print(f"Triggered Prefect flow run with id: {flow_run.get('id', 'Unknown')} (trace {tracing.current_trace_id()})")
         return 'Prefect flow triggered', 200
     except requests.exceptions.RequestException as e:
         print(f"Request error occurred: {str(e)}")
         print(f"Error type: {type(e).__name__}")
-        if hasattr(e, 'response'):
+        if getattr(e, 'response', None) is not None:
             print(f"Response status code: {e.response.status_code}")
             print(f"Response content: {e.response.text}")
+            if e.response.status_code == 404:
+                return 'Error: Deployment not found', 404
         return f'Error: {str(e)}', 500
     except Exception as e:
         print(f"An unexpected error occurred: {str(e)}")
@@ -84,4 +132,142 @@ def trigger_prefect_flow(cloud_event):
         traceback.print_exc(file=sys.stderr)
         return f'Error: {str(e)}', 500
 
-print("Function definition complete.")
\ No newline at end of file
+def pull_batch(max_messages=None, max_wait=None):
+    """Pull ETL trigger messages until ``max_messages`` are buffered or ``max_wait`` seconds have passed."""
+    from google.api_core.exceptions import DeadlineExceeded
+
+    max_messages = max_messages or BATCH_MAX_ACTIVITIES
+    wait_until = time.monotonic() + (max_wait if max_wait is not None else BATCH_MAX_WAIT_SECONDS)
+    received = []
+    while len(received) < max_messages:
+        remaining = wait_until - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            response = get_subscriber().pull(
+                request={'subscription': ETL_SUBSCRIPTION, 'max_messages': max_messages - len(received)},
+                timeout=remaining,
+            )
+        except DeadlineExceeded:
+            break
+        received.extend(response.received_messages)
+    return received
+
+def requeue_keys(keys, traceparent):
+    """Publish activities back to etl-trigger as one import-history style message."""
+    message = json.dumps({
+        'activity_keys': [{'athlete_id': key['athlete_id'], 'activity_id': key['activity_id']} for key in keys]
+    }).encode('utf-8')
+    attributes = {tracing.TRACEPARENT_ATTRIBUTE: traceparent} if traceparent else {}
+    with tracing.span('pubsub.publish', kind='producer', topic=ETL_TOPIC, activities=len(keys)):
+        get_publisher().publish(ETL_TOPIC, message, **attributes).result()
+
+def dispatch_batch(received):
+    """Create flow runs for a batch of pulled messages, then settle each message.
+
+    The activities are split into flow runs of at most BATCH_MAX_ACTIVITIES
+    (one import-history message can carry more than that). Runs are created
+    in order until Prefect refuses one; the rest are not attempted. A message
+    whose activities are all in accepted runs is acked. A message none of
+    whose activities were accepted is released with a DISPATCH_RETRY_SECONDS
+    ack deadline, so it comes back after a pause instead of at once. A
+    message split across an accepted and a refused run has its remaining
+    activities republished to etl-trigger and is then acked, so the accepted
+    run is not created again. If the instance dies in between, unsettled
+    messages come back once their ack deadline expires and the MERGE makes
+    loading their activities again harmless.
+    """
+    subscriber = get_subscriber()
+    message_ids = [item.message.message_id for item in received]
+    # (pulled message, its activity keys, its traceparent); malformed messages are acked with the batch
+    messages, keys, seen, links = [], [], set(), []
+    for item in received:
+        try:
+            traceparent = item.message.attributes.get(tracing.TRACEPARENT_ATTRIBUTE)
+            batch_keys = message_keys(json.loads(item.message.data.decode()), traceparent)
+        except (ValueError, KeyError, TypeError) as e:
+            # Redelivering a malformed message would never succeed
+            print(f"Dropping malformed ETL message {item.message.message_id}: {str(e)}")
+            messages.append((item, [], None))
+            continue
+        messages.append((item, batch_keys, traceparent))
+        links.append(tracing.parse_traceparent(traceparent))
+        for key in batch_keys:
+            pair = (key['athlete_id'], key['activity_id'])
+            if pair not in seen:  # the same activity can be triggered more than once
+                seen.add(pair)
+                keys.append(key)
+
+    flow_run_ids, accepted, error = [], set(), None
+    with tracing.span('etl_batch', kind='internal', links=links, messages=len(received), activities=len(keys)):
+        for start in range(0, len(keys), BATCH_MAX_ACTIVITIES):
+            chunk = keys[start:start + BATCH_MAX_ACTIVITIES]
+            try:
+                flow_run_ids.append(create_flow_run(chunk, tracing.traceparent()).get('id'))
+            except requests.exceptions.RequestException as e:
+                print(f"Flow run for {len(chunk)} activities was not accepted: {str(e)}")
+                error = str(e)
+                break
+            accepted.update((key['athlete_id'], key['activity_id']) for key in chunk)
+
+    ack_ids, released, requeued = [], [], []
+    for item, batch_keys, traceparent in messages:
+        remaining = [key for key in batch_keys if (key['athlete_id'], key['activity_id']) not in accepted]
+        if remaining and len(remaining) < len(batch_keys):
+            try:
+                requeue_keys(remaining, traceparent)
+                requeued.append(item.message.message_id)
+            except Exception as e:
+                print(f"Could not requeue {len(remaining)} activities of message {item.message.message_id}: {str(e)}")
+                released.append(item)
+                continue
+        elif remaining:
+            released.append(item)
+            continue
+        ack_ids.append(item.ack_id)
+
+    if ack_ids:
+        subscriber.acknowledge(request={'subscription': ETL_SUBSCRIPTION, 'ack_ids': ack_ids})
+    if released:
+        subscriber.modify_ack_deadline(request={
+            'subscription': ETL_SUBSCRIPTION, 'ack_ids': [item.ack_id for item in released],
+            'ack_deadline_seconds': DISPATCH_RETRY_SECONDS,
+        })
+    print(f"Flow runs {flow_run_ids} cover {len(accepted)} activities from messages {message_ids}")
+    summary = {'flow_run_ids': flow_run_ids, 'activities': len(accepted), 'message_ids': message_ids}
+    if error:
+        summary.update(error=error, released=[item.message.message_id for item in released], requeued=requeued)
+    return summary
+
+@functions_framework.http
+@tracing.traced('dispatch_etl_batches', kind='server')
+def dispatch_etl_batches(request):
+    """Drain the ETL trigger subscription into batched flow runs (run on a schedule).
+
+    Each flow run covers up to BATCH_MAX_ACTIVITIES activities, so one run's
+    infrastructure start-up is shared by the whole batch. Returns which
+    messages each flow run covers.
+    """
+    error = check_config()
+    if error:
+        return error
+
+    deadline = time.monotonic() + DISPATCH_RUN_SECONDS
+    batches = []
+    while time.monotonic() < deadline:
+        received = pull_batch()
+        if not received:
+            break
+        batches.append(dispatch_batch(received))
+        if batches[-1].get('error'):
+            # Prefect is refusing runs; pulling on would only cycle messages until the next invocation
+            break
+
+    failed = [batch for batch in batches if batch.get('error')]
+    summary = {
+        'flow_runs': sum(len(batch['flow_run_ids']) for batch in batches),
+        'activities': sum(batch['activities'] for batch in batches),
+        'batches': batches,
+    }
+    print(f"Dispatched {summary['flow_runs']} flow runs for {summary['activities']} activities, {len(failed)} batches failed")
+    return json.dumps(summary), 500 if failed else 200
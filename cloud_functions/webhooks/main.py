@@ -1,21 +1,31 @@
 import functions_framework
 import os
-from google.cloud import storage
-from google.cloud import pubsub_v1
 import json
 from datetime import datetime
+import tracing
 
 VERIFY_TOKEN = os.environ.get('VERIFY_TOKEN')
 BUCKET_NAME = 'strava-users'
 PROJECT_ID = os.environ.get('PROJECT_ID')
 
-storage_client = storage.Client()
-bucket = storage_client.bucket(BUCKET_NAME)
+# Clients are created on first use: the verification GET needs neither, and
+# importing the Cloud client libraries dominates cold start
+_clients = {}
 
-publisher = pubsub_v1.PublisherClient()
-topic_path = publisher.topic_path(PROJECT_ID, 'strava-activity-events')
+def get_bucket():
+    if 'bucket' not in _clients:
+        from google.cloud import storage
+        _clients['bucket'] = storage.Client().bucket(BUCKET_NAME)
+    return _clients['bucket']
+
+def get_publisher():
+    if 'publisher' not in _clients:
+        from google.cloud import pubsub_v1
+        _clients['publisher'] = pubsub_v1.PublisherClient()
+    return _clients['publisher']
 
 @functions_framework.http
+@tracing.traced('webhook', kind='server')
 def webhook(request):
     if request.method == 'GET':
         mode = request.args.get('hub.mode')
@@ -44,10 +54,11 @@ def store_event(event):
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"event_{athlete_id}_{event_id}_{timestamp}.json"
 
-    blob = bucket.blob(f'raw_events/{filename}')
-    blob.upload_from_string(json.dumps(event), content_type='application/json')
+    blob = get_bucket().blob(f'raw_events/{filename}')
+    with tracing.span('gcs.upload', bucket=BUCKET_NAME, object=blob.name):
+        blob.upload_from_string(json.dumps(event), content_type='application/json')
 
-    print(f"Event stored as {filename}")
+    print(f"Event stored as {filename} (trace {tracing.current_trace_id()})")
 
     if event.get('object_type') == 'activity':
         # Include athlete_id in the message
@@ -55,5 +66,9 @@ def store_event(event):
             'event': event,
             'athlete_id': athlete_id
         }).encode('utf-8')
-        publisher.publish(topic_path, message_data)
+        publisher = get_publisher()
+        topic_path = publisher.topic_path(PROJECT_ID, 'strava-activity-events')
+        with tracing.span('pubsub.publish', kind='producer', topic=topic_path):
+            # The trace travels with the message so downstream functions continue it
+            publisher.publish(topic_path, message_data, **tracing.message_attributes())
         print(f"Published event for athlete {athlete_id} to Pub/Sub")
\ No newline at end of file
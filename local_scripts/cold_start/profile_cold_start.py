@@ -0,0 +1,157 @@
+"""Measure the cold-start import cost of each cloud function and check it against budgets.
+
+Every function is imported in a fresh interpreter (``--runs`` times), with its
+own directory on ``sys.path`` as in the deployed container. The time from the
+start of ``import main`` to the entry point being resolved is what an instance
+spends before it can serve its first request; it excludes interpreter startup,
+which is the same for every function.
+
+Absolute times depend on the machine and its load, so every function import
+is paired with an import of a reference (``functions_framework`` and
+``requests``, which the functions load) timed the same way just before it,
+and budgets are ratios to the reference. Budgets live in ``budgets.json``
+next to this script (function directory -> entry point and ``budget_ratio``).
+The script exits with status 1 when the median of a function's per-pair
+ratios is over its budget, or when its import fails (for example because it
+now creates a client that needs credentials).
+
+    python local_scripts/cold_start/profile_cold_start.py
+    python local_scripts/cold_start/profile_cold_start.py --only webhooks --top 15
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+FUNCTIONS_DIR = os.path.join(REPO_ROOT, 'cloud_functions')
+BUDGETS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'budgets.json')
+
+# Placeholder configuration so module-level reads of the environment succeed
+FUNCTION_ENV = {
+    'PROJECT_ID': 'strava-etl', 'CLIENT_ID': 'cold-start', 'CLIENT_SECRET': 'cold-start',
+    'VERIFY_TOKEN': 'cold-start', 'REDIRECT_URI': 'http://localhost', 'PREFECT_API_URL': 'http://localhost',
+    'PREFECT_API_KEY': 'cold-start', 'PREFECT_DEPLOYMENT_ID': 'cold-start', 'TRACE_EXPORT_PATH': '',
+}
+
+# Imported by every function; timing it in the same run makes budgets independent of the machine
+REFERENCE_IMPORTS = 'import functions_framework, requests'
+
+# Runs in the child interpreter: import main.py, resolve the entry point, report the elapsed time
+CHILD = """
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+started = time.perf_counter()
+import main
+getattr(main, sys.argv[2])
+print(json.dumps({'ms': (time.perf_counter() - started) * 1000}))
+"""
+
+# Runs in the child interpreter: time the reference imports alone
+REFERENCE_CHILD = f"""
+import json, time
+started = time.perf_counter()
+{REFERENCE_IMPORTS}
+print(json.dumps({{'ms': (time.perf_counter() - started) * 1000}}))
+"""
+
+
+def run_child(directory: str, entry_point: str, importtime: bool = False) -> subprocess.CompletedProcess:
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', CHILD, directory, entry_point]
+    env = {**os.environ, **FUNCTION_ENV}
+    return subprocess.run(command, cwd=directory, env=env, capture_output=True, text=True)
+
+
+def run_reference() -> float:
+    result = subprocess.run([sys.executable, '-c', REFERENCE_CHILD], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])['ms']
+
+
+def measure(name: str, entry_point: str, runs: int) -> dict:
+    """Import times over ``runs`` fresh interpreters and the median ratio to the reference, or the import error."""
+    directory = os.path.join(FUNCTIONS_DIR, name)
+    timings, ratios = [], []
+    for _ in range(runs):
+        reference_ms = run_reference()
+        result = run_child(directory, entry_point)
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()
+            return {'error': error[-1] if error else f'exit status {result.returncode}'}
+        timings.append(json.loads(result.stdout.strip().splitlines()[-1])['ms'])
+        ratios.append(timings[-1] / reference_ms)
+    return {'median_ms': statistics.median(timings), 'min_ms': min(timings), 'max_ms': max(timings),
+            'ratio': statistics.median(ratios)}
+
+
+def top_imports(name: str, entry_point: str, count: int):
+    """The ``count`` packages imported directly by main.py with the largest cumulative import time (-X importtime)."""
+    result = run_child(os.path.join(FUNCTIONS_DIR, name), entry_point, importtime=True)
+    children, cumulative = [], {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or line.count('|') != 2:
+            continue
+        _, cumulative_us, module = line[len('import time:'):].split('|')
+        if not cumulative_us.strip().isdigit():
+            continue
+        # Output is post-order with two spaces of indent per level: main's direct imports precede it at depth 1
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        if depth == 1:
+            children.append((module.strip(), int(cumulative_us)))
+        elif depth == 0:
+            if module.strip() == 'main':
+                for child, microseconds in children:
+                    root = child.split('.')[0]
+                    cumulative[root] = cumulative.get(root, 0) + microseconds
+            children = []
+    return sorted(cumulative.items(), key=lambda item: -item[1])[:count]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per function')
+    parser.add_argument('--only', action='append', help='function directory to profile (repeatable)')
+    parser.add_argument('--top', type=int, default=0, help='also list the N slowest top-level imports')
+    parser.add_argument('--update-budgets', type=float, metavar='FACTOR',
+                        help='rewrite budgets.json as FACTOR x the measured ratios (after an intended change)')
+    args = parser.parse_args()
+
+    with open(BUDGETS_PATH) as f:
+        budgets = json.load(f)
+
+    print(f"Ratios are to the reference imports: {REFERENCE_IMPORTS}")
+    failures = []
+    print(f"{'function':<26} {'median ms':>10} {'min':>8} {'max':>8} {'ratio':>7} {'budget':>7}  status")
+    for name, config in budgets.items():
+        if args.only and name not in args.only:
+            continue
+        result = measure(name, config['entry_point'], args.runs)
+        if 'error' in result:
+            failures.append(name)
+            print(f"{name:<26} {'-':>10} {'-':>8} {'-':>8} {'-':>7} {config['budget_ratio']:>7}  "
+                  f"IMPORT FAILED: {result['error']}")
+            continue
+        ratio = result['ratio']
+        over = ratio > config['budget_ratio']
+        if over:
+            failures.append(name)
+        print(f"{name:<26} {result['median_ms']:>10.0f} {result['min_ms']:>8.0f} {result['max_ms']:>8.0f} "
+              f"{ratio:>7.2f} {config['budget_ratio']:>7}  {'OVER BUDGET' if over else 'ok'}")
+        if args.update_budgets:
+            config['budget_ratio'] = round(ratio * args.update_budgets, 1)
+        for module, microseconds in top_imports(name, config['entry_point'], args.top) if args.top else []:
+            print(f"    {module:<30} {microseconds / 1000:>8.1f} ms")
+
+    if args.update_budgets:
+        with open(BUDGETS_PATH, 'w') as f:
+            json.dump(budgets, f, indent=2)
+            f.write('\n')
+        print(f"Budgets written to {BUDGETS_PATH}")
+    elif failures:
+        print(f"\nCold-start budget exceeded or import failed: {', '.join(failures)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,869 @@
+"""In-memory stand-ins for the services the pipeline talks to.
+
+- ``FakeStorageClient``: Cloud Storage buckets as directories on disk, with
+  object generations and ``if_generation_match`` preconditions.
+- ``PubSubBroker`` / ``FakePublisher`` / ``FakeSubscriber``: topics as
+  in-process queues, delivered to a subscribed function by a pool of worker
+  threads (push) or pulled, acked and nacked through the subscriber (pull).
+- ``HttpRouter``: intercepts ``requests`` at the transport level and routes
+  Strava and Prefect API calls to ``FakeStrava`` / ``FakePrefect``. Any other
+  host is refused, so a run never reaches the real services.
+- ``Warehouse`` / ``FakeBigQueryClient``: BigQuery tables in SQLite. Loads,
+  plain SELECTs and the MERGE statements generated by the ETL flow run
+  locally; statements SQLite can't execute (BigQuery-only functions) are
+  recorded as skipped instead of failing the caller.
+"""
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import SimpleNamespace
+from urllib.parse import urlsplit, parse_qs
+import base64
+import itertools
+import json
+import math
+import os
+import queue
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import requests
+from cloudevents.http import CloudEvent
+from google.api_core.exceptions import DeadlineExceeded, NotFound, PreconditionFailed
+from google.cloud import bigquery
+
+
+class StageRecorder:
+    """Thread-safe collection of (stage, seconds, ok) samples and per-key timestamps."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)  # stage -> [(started, seconds, ok)]
+        self.marks = defaultdict(dict)  # key -> {event: timestamp}
+
+    def record(self, stage: str, started: float, seconds: float, ok: bool = True) -> None:
+        with self.lock:
+            self.samples[stage].append((started, seconds, ok))
+
+    def mark(self, key, event: str, at: float = None) -> None:
+        with self.lock:
+            self.marks[str(key)].setdefault(event, at if at is not None else time.perf_counter())
+
+
+# ---------------------------------------------------------------------------
+# Cloud Storage
+# ---------------------------------------------------------------------------
+
+class _StorageState:
+    def __init__(self, root: str):
+        self.root = root
+        self.lock = threading.RLock()
+        self.generations = {}  # (bucket, name) -> int
+        self.counter = itertools.count(1)
+
+
+class FakeBlob:
+    def __init__(self, bucket: 'FakeBucket', name: str):
+        self.bucket = bucket
+        self.name = name
+        self.cache_control = None
+        self.content_type = None
+
+    @property
+    def _path(self) -> str:
+        return os.path.join(self.bucket._root, self.name)
+
+    @property
+    def generation(self):
+        return self.bucket._state.generations.get((self.bucket.name, self.name))
+
+    def _check(self, if_generation_match) -> None:
+        if if_generation_match is not None and (self.generation or 0) != if_generation_match:
+            raise PreconditionFailed(f"{self.bucket.name}/{self.name}: generation {self.generation} != {if_generation_match}")
+
+    def exists(self, *args, **kwargs) -> bool:
+        return self.generation is not None
+
+    def reload(self, *args, **kwargs) -> None:
+        if not self.exists():
+            raise NotFound(f"{self.bucket.name}/{self.name}")
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None, **kwargs) -> None:
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        state = self.bucket._state
+        with state.lock:
+            self._check(if_generation_match)
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(self._path, 'wb') as f:
+                f.write(data)
+            state.generations[(self.bucket.name, self.name)] = next(state.counter)
+        self.content_type = content_type
+
+    def upload_from_filename(self, filename, content_type=None, if_generation_match=None, **kwargs) -> None:
+        with open(filename, 'rb') as f:
+            self.upload_from_string(f.read(), content_type=content_type, if_generation_match=if_generation_match)
+
+    def download_as_bytes(self, if_generation_match=None, **kwargs) -> bytes:
+        with self.bucket._state.lock:
+            if not self.exists():
+                raise NotFound(f"{self.bucket.name}/{self.name}")
+            self._check(if_generation_match)
+            with open(self._path, 'rb') as f:
+                return f.read()
+
+    download_as_string = download_as_bytes
+
+    def download_as_text(self, encoding='utf-8', **kwargs) -> str:
+        return self.download_as_bytes(**kwargs).decode(encoding)
+
+    def download_to_filename(self, filename, if_generation_match=None, **kwargs) -> None:
+        data = self.download_as_bytes(if_generation_match=if_generation_match)
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    def delete(self, *args, if_generation_match=None, **kwargs) -> None:
+        with self.bucket._state.lock:
+            self._check(if_generation_match)
+            if self.bucket._state.generations.pop((self.bucket.name, self.name), None) is None:
+                raise NotFound(f"{self.bucket.name}/{self.name}")
+            os.remove(self._path)
+
+
+class FakeBucket:
+    def __init__(self, state: _StorageState, name: str):
+        self._state = state
+        self.name = name
+        self._root = os.path.join(state.root, name)
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str, *args, **kwargs):
+        blob = FakeBlob(self, name)
+        return blob if blob.exists() else None
+
+    def list_blobs(self, prefix: str = '', **kwargs):
+        with self._state.lock:
+            names = sorted(name for bucket, name in self._state.generations
+                           if bucket == self.name and name.startswith(prefix or ''))
+        return [FakeBlob(self, name) for name in names]
+
+    def exists(self, *args, **kwargs) -> bool:
+        return True
+
+
+class FakeStorageClient:
+    """Drop-in for ``storage.Client``; every instance sees the same directory tree."""
+
+    def __init__(self, state: _StorageState):
+        self._state = state
+
+    @classmethod
+    def factory(cls, root: str):
+        state = _StorageState(root)
+        return lambda *args, **kwargs: cls(state)
+
+    def bucket(self, name: str) -> FakeBucket:
+        return FakeBucket(self._state, name)
+
+    get_bucket = bucket
+
+    def list_blobs(self, bucket_or_name, prefix: str = '', **kwargs):
+        bucket = bucket_or_name if isinstance(bucket_or_name, FakeBucket) else self.bucket(bucket_or_name)
+        return bucket.list_blobs(prefix=prefix)
+
+
+# ---------------------------------------------------------------------------
+# Pub/Sub
+# ---------------------------------------------------------------------------
+
+class PubSubBroker:
+    """Topics as queues; a push subscription is served by ``workers`` threads, a pull one by ``FakeSubscriber``."""
+
+    def __init__(self, recorder: StageRecorder):
+        self.recorder = recorder
+        self.queues = {}
+        self.pull_topics = {}  # subscription path -> topic
+        self.outstanding = {}  # ack_id -> pulled message
+        self.threads = []
+        self.pending = 0
+        self.idle = threading.Condition()
+        self.ids = itertools.count(1)
+        self.dropped = defaultdict(int)
+
+    def publish(self, topic: str, data: bytes, **attributes) -> Future:
+        message_id = str(next(self.ids))
+        future = Future()
+        future.set_result(message_id)
+        if topic not in self.queues:
+            self.dropped[topic] += 1
+            return future
+        with self.idle:
+            self.pending += 1
+        self.queues[topic].put((message_id, data, attributes, time.perf_counter()))
+        return future
+
+    def subscribe(self, topic: str, handler, workers: int = 1) -> None:
+        """Deliver messages on ``topic`` to ``handler(cloud_event)``."""
+        self.queues[topic] = queue.Queue()
+        for _ in range(workers):
+            thread = threading.Thread(target=self._serve, args=(topic, handler), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def add_pull_subscription(self, topic: str, subscription: str) -> None:
+        self.queues[topic] = queue.Queue()
+        self.pull_topics[subscription] = topic
+
+    def _done(self, count: int = 1) -> None:
+        with self.idle:
+            self.pending -= count
+            self.idle.notify_all()
+
+    def _serve(self, topic: str, handler) -> None:
+        name = topic.rsplit('/', 1)[-1]
+        while True:
+            item = self.queues[topic].get()
+            if item is None:
+                return
+            message_id, data, attributes, published = item
+            started = time.perf_counter()
+            self.recorder.record(f"pubsub wait: {name}", published, started - published)
+            event = CloudEvent(
+                {'type': 'google.cloud.pubsub.topic.v1.messagePublished', 'source': f'//pubsub.googleapis.com/{topic}'},
+                {'message': {'data': base64.b64encode(data).decode(), 'attributes': attributes,
+                             'messageId': message_id}},
+            )
+            try:
+                handler(event)
+            finally:
+                self._done()
+
+    def wait_idle(self, timeout: float) -> bool:
+        with self.idle:
+            return self.idle.wait_for(lambda: self.pending == 0, timeout=timeout)
+
+    def stop(self) -> None:
+        pulled = set(self.pull_topics.values())
+        for topic, topic_queue in self.queues.items():
+            if topic not in pulled:
+                for _ in self.threads:
+                    topic_queue.put(None)
+
+
+class FakePublisher:
+    """Drop-in for ``pubsub_v1.PublisherClient``."""
+
+    def __init__(self, broker: PubSubBroker):
+        self.broker = broker
+
+    @classmethod
+    def factory(cls, broker: PubSubBroker):
+        return lambda *args, **kwargs: cls(broker)
+
+    @staticmethod
+    def topic_path(project: str, topic: str) -> str:
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic: str, data: bytes, **attributes) -> Future:
+        return self.broker.publish(topic, data, **attributes)
+
+
+class FakeSubscriber:
+    """Drop-in for ``pubsub_v1.SubscriberClient`` on pull subscriptions added to the broker."""
+
+    def __init__(self, broker: PubSubBroker):
+        self.broker = broker
+        self.lock = threading.Lock()
+
+    @classmethod
+    def factory(cls, broker: PubSubBroker):
+        return lambda *args, **kwargs: cls(broker)
+
+    def pull(self, request: dict, timeout: float = None, **kwargs):
+        """Wait up to ``timeout`` for a first message, then take what is queued, up to ``max_messages``."""
+        topic = self.broker.pull_topics[request['subscription']]
+        topic_queue = self.broker.queues[topic]
+        items = []
+        try:
+            items.append(topic_queue.get(timeout=timeout))
+            while len(items) < request.get('max_messages', 1):
+                items.append(topic_queue.get_nowait())
+        except queue.Empty:
+            if not items:
+                raise DeadlineExceeded(f"No messages on {request['subscription']}")
+
+        received = []
+        pulled = time.perf_counter()
+        name = topic.rsplit('/', 1)[-1]
+        for item in items:
+            message_id, data, attributes, published = item
+            self.broker.recorder.record(f"pubsub wait: {name}", published, pulled - published)
+            ack_id = f"{request['subscription']}:{message_id}"
+            with self.lock:
+                self.broker.outstanding[ack_id] = (topic, item)
+            message = SimpleNamespace(data=data, attributes=dict(attributes), message_id=message_id)
+            received.append(SimpleNamespace(ack_id=ack_id, message=message))
+        return SimpleNamespace(received_messages=received)
+
+    def acknowledge(self, request: dict, **kwargs) -> None:
+        with self.lock:
+            acked = [self.broker.outstanding.pop(ack_id, None) for ack_id in request['ack_ids']]
+        self.broker._done(sum(1 for item in acked if item is not None))
+
+    def modify_ack_deadline(self, request: dict, **kwargs) -> None:
+        """Put the messages back on the queue once the new deadline passes (right away for zero, a nack)."""
+        deadline = request.get('ack_deadline_seconds') or 0
+        if deadline:
+            timer = threading.Timer(deadline, self._release, args=(request['ack_ids'],))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._release(request['ack_ids'])
+
+    def _release(self, ack_ids) -> None:
+        with self.lock:
+            released = [self.broker.outstanding.pop(ack_id, None) for ack_id in ack_ids]
+        for topic, item in filter(None, released):
+            self.broker.queues[topic].put(item)
+
+
+# ---------------------------------------------------------------------------
+# HTTP APIs
+# ---------------------------------------------------------------------------
+
+class HttpRouter:
+    """Routes ``requests`` calls by host to fake services, with a simulated network latency."""
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency = latency_ms / 1000
+        self.routes = {}
+        self._original_send = None
+
+    def add(self, host: str, service) -> None:
+        self.routes[host] = service
+
+    def install(self) -> None:
+        router = self
+        self._original_send = requests.adapters.HTTPAdapter.send
+
+        def send(adapter, request, **kwargs):
+            return router.send(request)
+
+        requests.adapters.HTTPAdapter.send = send
+
+    def uninstall(self) -> None:
+        if self._original_send is not None:
+            requests.adapters.HTTPAdapter.send = self._original_send
+
+    def send(self, request: requests.PreparedRequest) -> requests.Response:
+        url = urlsplit(request.url)
+        service = self.routes.get(url.netloc)
+        if service is None:
+            raise requests.exceptions.ConnectionError(f"Harness refuses outbound request to {url.netloc}")
+        if self.latency:
+            time.sleep(self.latency)
+        body = None
+        if request.body:
+            raw = request.body.decode() if isinstance(request.body, bytes) else request.body
+            try:
+                body = json.loads(raw)
+            except ValueError:
+                body = {key: values[0] for key, values in parse_qs(raw).items()}
+        status, payload, headers = service.handle(request.method, url.path, parse_qs(url.query), body,
+                                                  headers=request.headers)
+
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(payload).encode()
+        response.headers['Content-Type'] = 'application/json'
+        response.headers.update(headers or {})
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+
+def encode_polyline(points) -> str:
+    """Google encoded polyline of (lat, lng) points, as Strava's ``map.summary_polyline``."""
+    encoded, previous = [], (0, 0)
+    for point in points:
+        current = tuple(int(round(value * 1e5)) for value in point)
+        for delta in (current[0] - previous[0], current[1] - previous[1]):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                encoded.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            encoded.append(chr(value + 63))
+        previous = current
+    return ''.join(encoded)
+
+
+class FakeStrava:
+    """Strava API serving synthetic activities and laps.
+
+    With ``rate_limit`` (15-minute, daily) API calls are counted per window,
+    reported in the X-RateLimit-* headers and refused with 429 past the limit.
+    """
+
+    HOST = 'www.strava.com'
+
+    def __init__(self, recorder: StageRecorder, seed: int = 0, rate_limit: tuple = None):
+        self.recorder = recorder
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.activities = {}  # activity_id -> activity
+        self.descriptions = {}
+        self.calls = Counter()  # 'METHOD /route' -> requests served
+        self.tokens = {}  # access or refresh token -> athlete id, for tokens issued by /oauth/token
+        self.rate_limit = rate_limit
+        self.usage = Counter()  # (window, start) -> calls
+        self.rate_limited = 0
+
+    def _count(self, method: str, path: str) -> None:
+        route = re.sub(r'/\d+', '/{id}', path)
+        with self.lock:
+            self.calls[f"{method} {route}"] += 1
+
+    def _rate_limit_headers(self):
+        """Count a call against the limits; returns (headers, whether it is refused)."""
+        if self.rate_limit is None:
+            return None, False
+        now = int(time.time())
+        windows = (('short', now - now % 900), ('daily', now - now % 86400))
+        with self.lock:
+            refused = any(self.usage[window] >= limit for window, limit in zip(windows, self.rate_limit))
+            if refused:
+                self.rate_limited += 1
+            else:
+                for window in windows:
+                    self.usage[window] += 1
+            usage = [self.usage[window] for window in windows]
+        headers = {'X-RateLimit-Limit': ','.join(map(str, self.rate_limit)),
+                   'X-RateLimit-Usage': ','.join(map(str, usage))}
+        return headers, refused
+
+    def _issue_tokens(self, athlete_id) -> dict:
+        tokens = {'access_token': uuid.uuid4().hex, 'refresh_token': uuid.uuid4().hex,
+                  'expires_at': int(time.time()) + 21600}
+        if athlete_id is not None:
+            with self.lock:
+                self.tokens[tokens['access_token']] = self.tokens[tokens['refresh_token']] = athlete_id
+        return tokens
+
+    def register(self, athlete_id: int, activity_id: int, start: pd.Timestamp) -> dict:
+        """Create a synthetic run for ``athlete_id`` starting at ``start`` (UTC)."""
+        with self.lock:
+            rng = self.random
+            distance = rng.choice([5000, 8000, 10000, 16000, 21100, 30000]) * rng.uniform(0.9, 1.1)
+            speed = rng.uniform(2.5, 4.2)
+            moving_time = int(distance / speed)
+            heartrate = rng.uniform(125, 175)
+            # An out-and-back loop from one of a few start points near each other
+            origin = (40.71 + rng.choice([0.0, 0.003, 0.02]), -74.0 + rng.choice([0.0, 0.004, -0.03]))
+            bearing = rng.uniform(0, 2 * math.pi)
+        local = start + pd.Timedelta(hours=-5)
+        reach = distance / 2 / 111_320
+        route = [(origin[0] + reach * math.sin(math.pi * step / 40) * math.sin(bearing),
+                  origin[1] + reach * math.sin(math.pi * step / 40) * math.cos(bearing))
+                 for step in range(41)]
+        activity = {
+            'resource_state': 3, 'name': 'Morning Run', 'distance': round(distance, 1),
+            'moving_time': moving_time, 'elapsed_time': moving_time + 120,
+            'total_elevation_gain': round(distance / 200, 1), 'type': 'Run', 'sport_type': 'Run',
+            'workout_type': 0, 'id': activity_id,
+            'start_date': start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'start_date_local': local.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'timezone': '(GMT-05:00) America/New_York', 'achievement_count': 0, 'kudos_count': 3,
+            'comment_count': 0, 'athlete_count': 1, 'photo_count': 0, 'trainer': False, 'commute': False,
+            'manual': False, 'private': False, 'visibility': 'everyone', 'flagged': False,
+            'gear_id': 'g1', 'gear': {'primary': True, 'name': 'Trainers', 'distance': 512000.0},
+            'start_latlng': [round(route[0][0], 6), round(route[0][1], 6)],
+            'end_latlng': [round(route[-1][0], 6), round(route[-1][1], 6)],
+            'map': {'id': f'a{activity_id}', 'summary_polyline': encode_polyline(route), 'resource_state': 2},
+            'average_speed': round(speed, 3), 'max_speed': round(speed * 1.4, 3), 'average_cadence': 84.0,
+            'average_watts': None, 'max_watts': None, 'weighted_average_watts': None, 'kilojoules': None,
+            'device_watts': False, 'has_heartrate': True, 'average_heartrate': round(heartrate, 1),
+            'max_heartrate': round(heartrate + 15, 1), 'elev_high': 30.0, 'elev_low': 5.0,
+            'upload_id': activity_id + 1, 'upload_id_str': str(activity_id + 1), 'external_id': f'{activity_id}.fit',
+            'pr_count': 0, 'total_photo_count': 0, 'suffer_score': round(moving_time / 60 * (heartrate - 100) / 40, 1),
+            'calories': round(distance * 0.065, 1), 'perceived_exertion': None, 'prefer_perceived_exertion': False,
+            'device_name': 'Garmin Forerunner', 'embed_token': uuid.uuid4().hex, 'description': '',
+            'athlete': {'id': athlete_id, 'resource_state': 1},
+        }
+        with self.lock:
+            self.activities[activity_id] = activity
+        return activity
+
+    def laps(self, activity: dict) -> list:
+        laps, start_index = [], 0
+        count = max(1, int(activity['distance'] // 1000))
+        for index in range(count):
+            distance = activity['distance'] / count
+            moving_time = int(activity['moving_time'] / count)
+            laps.append({
+                'id': activity['id'] * 100 + index, 'resource_state': 2, 'name': f'Lap {index + 1}',
+                'activity': {'id': activity['id']}, 'athlete': {'id': activity['athlete']['id']},
+                'elapsed_time': moving_time + 5, 'moving_time': moving_time,
+                'start_date': activity['start_date'], 'start_date_local': activity['start_date_local'],
+                'distance': round(distance, 1), 'start_index': start_index, 'end_index': start_index + moving_time,
+                'total_elevation_gain': round(activity['total_elevation_gain'] / count, 1),
+                'average_speed': activity['average_speed'], 'max_speed': activity['max_speed'],
+                'average_cadence': 84.0, 'device_watts': False, 'average_watts': None,
+                'average_heartrate': activity['average_heartrate'], 'max_heartrate': activity['max_heartrate'],
+                'lap_index': index + 1, 'split': index + 1, 'pace_zone': 2,
+            })
+            start_index += moving_time
+        return laps
+
+    def list_activities(self, athlete_id, before: int = None, per_page: int = 30) -> list:
+        """The athlete's activities newest first, as summaries, starting before ``before`` (epoch seconds)."""
+        with self.lock:
+            owned = [a for a in self.activities.values() if a['athlete']['id'] == athlete_id]
+        if before is not None:
+            owned = [a for a in owned if pd.Timestamp(a['start_date']).timestamp() < before]
+        owned.sort(key=lambda a: a['start_date'], reverse=True)
+        return [{**a, 'resource_state': 2} for a in owned[:per_page]]
+
+    def handle(self, method: str, path: str, query: dict, body, headers=None):
+        self._count(method, path)
+        if method == 'POST' and path == '/oauth/token':
+            body = body or {}
+            if body.get('grant_type') == 'authorization_code':
+                # Harness authorization codes are 'athlete-<id>'
+                athlete_id = int(body['code'].rsplit('-', 1)[-1])
+                return 200, {**self._issue_tokens(athlete_id), 'athlete': {'id': athlete_id}}, None
+            return 200, self._issue_tokens(self.tokens.get(body.get('refresh_token'))), None
+
+        limit_headers, refused = self._rate_limit_headers()
+        if refused:
+            return 429, {'message': 'Rate Limit Exceeded'}, limit_headers
+        status, payload = self._api(method, path, query, body, headers or {})
+        return status, payload, limit_headers
+
+    def _api(self, method: str, path: str, query: dict, body, headers):
+        if method == 'GET' and path == '/api/v3/athlete':
+            return 200, {'id': 0, 'resource_state': 2}
+        if method == 'GET' and path == '/api/v3/athlete/activities':
+            athlete_id = self.tokens.get(headers.get('Authorization', '').replace('Bearer ', ''))
+            if athlete_id is None:
+                return 401, {'message': 'Authorization Error'}
+            before = int(query['before'][0]) if 'before' in query else None
+            return 200, self.list_activities(athlete_id, before, int(query.get('per_page', ['30'])[0]))
+        match = re.fullmatch(r'/api/v3/athletes/(\d+)/stats', path)
+        if method == 'GET' and match:
+            count = len(self.list_activities(int(match.group(1)), per_page=None))
+            return 200, {'all_run_totals': {'count': count}, 'all_ride_totals': {'count': 0},
+                         'all_swim_totals': {'count': 0}}
+        match = re.fullmatch(r'/api/v3/activities/(\d+)(/laps)?', path)
+        if not match:
+            return 404, {'message': 'Record Not Found'}
+        activity = self.activities.get(int(match.group(1)))
+        if activity is None:
+            return 404, {'message': 'Record Not Found'}
+        if match.group(2):
+            return (200, self.laps(activity)) if method == 'GET' else (405, {})
+        if method == 'GET':
+            # Detailed activities include their laps
+            return 200, {**activity, 'laps': self.laps(activity)}
+        if method == 'PUT':
+            with self.lock:
+                activity.update(body or {})
+            self.recorder.mark(activity['id'], 'description_updated')
+            return 200, activity
+        return 405, {}
+
+
+class FakePrefect:
+    """Prefect API that runs accepted flow runs on a local worker pool."""
+
+    HOST = 'prefect.local'
+    API_URL = f'http://{HOST}/api'
+
+    def __init__(self, recorder: StageRecorder, flow_fn, workers: int = 1):
+        self.recorder = recorder
+        self.flow_fn = flow_fn
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='flow-run')
+        self.pending = 0
+        self.idle = threading.Condition()
+        self.run_sizes = []  # activities covered by each flow run
+
+    def handle(self, method: str, path: str, query: dict, body, headers=None):
+        if method == 'POST' and re.fullmatch(r'/api/deployments/[^/]+/create_flow_run', path):
+            parameters = (body or {}).get('parameters', {})
+            flow_run_id = str(uuid.uuid4())
+            with self.idle:
+                self.pending += 1
+            self.pool.submit(self._run, parameters, time.perf_counter())
+            return 201, {'id': flow_run_id, 'state': {'type': 'SCHEDULED'}, 'parameters': parameters}, None
+        return 404, {'detail': 'Not Found'}, None
+
+    def _run(self, parameters: dict, accepted: float) -> None:
+        started = time.perf_counter()
+        self.recorder.record('prefect wait: flow run', accepted, started - accepted)
+        keys = parameters.get('activity_keys') or [parameters]
+        with self.idle:
+            self.run_sizes.append(len(keys))
+        ok = True
+        try:
+            self.flow_fn(**parameters)
+        except Exception:
+            ok = False
+        finally:
+            finished = time.perf_counter()
+            self.recorder.record('etl_flow', started, finished - started, ok)
+            for key in keys if ok else []:
+                self.recorder.mark(key['activity_id'], 'loaded', finished)
+            with self.idle:
+                self.pending -= 1
+                self.idle.notify_all()
+
+    def wait_idle(self, timeout: float) -> bool:
+        with self.idle:
+            return self.idle.wait_for(lambda: self.pending == 0, timeout=timeout)
+
+
+# ---------------------------------------------------------------------------
+# BigQuery
+# ---------------------------------------------------------------------------
+
+_SQLITE_TYPES = {'INTEGER': 'INTEGER', 'INT64': 'INTEGER', 'FLOAT': 'REAL', 'FLOAT64': 'REAL',
+                 'BOOLEAN': 'INTEGER', 'BOOL': 'INTEGER', 'BYTES': 'BLOB'}
+
+_MERGE_RE = re.compile(
+    r"MERGE\s+`(?P<target>[^`]+)`\s+T\s+USING\s+`(?P<source>[^`]+)`\s+S\s+ON\s+(?P<on>.+?)\s+"
+    r"WHEN MATCHED THEN.+?WHEN NOT MATCHED THEN\s+INSERT\s*\((?P<columns>[^)]+)\)",
+    re.DOTALL | re.IGNORECASE,
+)
+
+
+class FakeRow(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeRowIterator:
+    def __init__(self, frame: pd.DataFrame, page_size: int = None):
+        self.frame = frame
+        self.page_size = page_size or 10000
+        self.total_rows = len(frame)
+
+    def __iter__(self):
+        for record in self.frame.to_dict(orient='records'):
+            yield FakeRow(record)
+
+    def to_dataframe(self, *args, **kwargs) -> pd.DataFrame:
+        return self.frame.copy()
+
+    def to_arrow(self, *args, **kwargs) -> pa.Table:
+        return pa.Table.from_pandas(self.frame, preserve_index=False)
+
+    def to_arrow_iterable(self, *args, **kwargs):
+        for start in range(0, len(self.frame), self.page_size):
+            yield pa.RecordBatch.from_pandas(self.frame.iloc[start:start + self.page_size], preserve_index=False)
+
+
+class FakeJob:
+    def __init__(self, frame: pd.DataFrame = None, affected_rows: int = 0, skipped: bool = False):
+        self.frame = frame if frame is not None else pd.DataFrame()
+        self.num_dml_affected_rows = affected_rows
+        self.total_bytes_processed = 0
+        self.skipped = skipped
+        self.job_id = uuid.uuid4().hex
+
+    def result(self, page_size: int = None, **kwargs) -> FakeRowIterator:
+        return FakeRowIterator(self.frame, page_size)
+
+
+class Warehouse:
+    """SQLite database holding the fake BigQuery tables, keyed by full table id."""
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.schemas = {}  # table_id -> [SchemaField]
+        self.layouts = {}  # table_id -> (time_partitioning, clustering_fields), as created
+        self.skipped = defaultdict(int)  # first line of each statement SQLite could not run
+
+    def _create(self, table_id: str, schema) -> None:
+        columns = ', '.join(f'"{field.name}" {_SQLITE_TYPES.get(field.field_type, "TEXT")}' for field in schema)
+        self.conn.execute(f'DROP TABLE IF EXISTS "{table_id}"')
+        if columns:
+            self.conn.execute(f'CREATE TABLE "{table_id}" ({columns})')
+        self.schemas[table_id] = list(schema)
+
+    def set_schema(self, table_id: str, schema) -> None:
+        with self.lock:
+            current = {field.name for field in self.schemas.get(table_id, [])}
+            if not current:
+                self._create(table_id, schema)
+                return
+            for field in schema:
+                if field.name not in current:
+                    self.conn.execute(f'ALTER TABLE "{table_id}" ADD COLUMN "{field.name}" '
+                                      f'{_SQLITE_TYPES.get(field.field_type, "TEXT")}')
+            self.schemas[table_id] = list(schema)
+
+    def write(self, df: pd.DataFrame, table_id: str, schema=None, truncate: bool = False) -> int:
+        if not schema:
+            schema = self.schemas.get(table_id) or [bigquery.SchemaField(c, _infer_type(df[c])) for c in df.columns]
+        names = [field.name for field in schema]
+        rows = _sqlite_rows(df.reindex(columns=names))
+        with self.lock:
+            if truncate or table_id not in self.schemas:
+                self._create(table_id, schema)
+            placeholders = ', '.join('?' for _ in names)
+            column_list = ', '.join(f'"{name}"' for name in names)
+            self.conn.executemany(f'INSERT INTO "{table_id}" ({column_list}) VALUES ({placeholders})', rows)
+            self.conn.commit()
+        return len(rows)
+
+    def drop(self, table_id: str) -> bool:
+        with self.lock:
+            existed = self.schemas.pop(table_id, None) is not None
+            self.layouts.pop(table_id, None)
+            self.conn.execute(f'DROP TABLE IF EXISTS "{table_id}"')
+            return existed
+
+    def merge(self, target: str, source: str, on: str, columns) -> int:
+        keys = re.findall(r'T\.(\w+)\s*=\s*S\.\1', on)
+        with self.lock:
+            index = re.sub(r'\W', '_', f'{target}_{"_".join(keys)}_key')
+            self.conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS "{index}" ON "{target}" '
+                              f'({", ".join(f"{k!r}".replace(chr(39), chr(34)) for k in keys)})')
+            column_list = ', '.join(f'"{c}"' for c in columns)
+            updates = ', '.join(f'"{c}" = excluded."{c}"' for c in columns if c not in keys)
+            cursor = self.conn.execute(
+                f'INSERT INTO "{target}" ({column_list}) SELECT {column_list} FROM "{source}" WHERE true '
+                f'ON CONFLICT ({", ".join(chr(34) + k + chr(34) for k in keys)}) DO UPDATE SET {updates}'
+            )
+            self.conn.commit()
+            return cursor.rowcount
+
+    def execute(self, sql: str, params: dict) -> FakeJob:
+        """Run ``sql`` in SQLite if it can; otherwise record it as skipped and return an empty result."""
+        translated = re.sub(r'`([^`]+)`', r'"\1"', sql)
+        translated = re.sub(r'@(\w+)', r':\1', translated)
+        with self.lock:
+            try:
+                frame = pd.read_sql_query(translated, self.conn, params=params)
+            except (pd.errors.DatabaseError, sqlite3.Error, TypeError):
+                try:
+                    cursor = self.conn.execute(translated, params)
+                    self.conn.commit()
+                    return FakeJob(affected_rows=cursor.rowcount)
+                except sqlite3.Error:
+                    self.skipped[sql.strip().splitlines()[0][:80]] += 1
+                    return FakeJob(skipped=True)
+        return FakeJob(frame)
+
+    def count(self, table_id: str) -> int:
+        with self.lock:
+            if table_id not in self.schemas or not self.schemas[table_id]:
+                return 0
+            return self.conn.execute(f'SELECT COUNT(*) FROM "{table_id}"').fetchone()[0]
+
+
+def _infer_type(series: pd.Series) -> str:
+    if pd.api.types.is_bool_dtype(series):
+        return 'BOOLEAN'
+    if pd.api.types.is_integer_dtype(series):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(series):
+        return 'FLOAT'
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return 'TIMESTAMP'
+    return 'STRING'
+
+
+def _sqlite_value(value):
+    if value is None or value is pd.NA or value is pd.NaT:
+        return None
+    if isinstance(value, float) and value != value:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if hasattr(value, 'item'):  # numpy scalars
+        return value.item()
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def _sqlite_rows(df: pd.DataFrame):
+    return [tuple(_sqlite_value(value) for value in row) for row in df.astype(object).itertuples(index=False)]
+
+
+class FakeBigQueryClient:
+    """Drop-in for ``bigquery.Client`` backed by a ``Warehouse``."""
+
+    def __init__(self, warehouse: Warehouse, project: str = 'strava-etl'):
+        self.warehouse = warehouse
+        self.project = project
+
+    @classmethod
+    def factory(cls, warehouse: Warehouse):
+        return lambda *args, project='strava-etl', **kwargs: cls(warehouse, project or 'strava-etl')
+
+    @staticmethod
+    def _table_id(table) -> str:
+        if isinstance(table, bigquery.Table):
+            return f"{table.project}.{table.dataset_id}.{table.table_id}"
+        return str(table)
+
+    def get_table(self, table) -> bigquery.Table:
+        table_id = self._table_id(table)
+        if table_id not in self.warehouse.schemas:
+            raise NotFound(f"Table {table_id}")
+        table = bigquery.Table(table_id, schema=self.warehouse.schemas[table_id])
+        table.time_partitioning, table.clustering_fields = self.warehouse.layouts.get(table_id, (None, None))
+        return table
+
+    def create_table(self, table, exists_ok: bool = False) -> bigquery.Table:
+        table_id = self._table_id(table)
+        if table_id not in self.warehouse.schemas or not exists_ok:
+            self.warehouse.set_schema(table_id, table.schema)
+            self.warehouse.layouts[table_id] = (table.time_partitioning, table.clustering_fields)
+        return self.get_table(table_id)
+
+    def update_table(self, table, fields) -> bigquery.Table:
+        self.warehouse.set_schema(self._table_id(table), table.schema)
+        return self.get_table(table)
+
+    def delete_table(self, table, not_found_ok: bool = False) -> None:
+        if not self.warehouse.drop(self._table_id(table)) and not not_found_ok:
+            raise NotFound(f"Table {self._table_id(table)}")
+
+    def load_table_from_dataframe(self, df: pd.DataFrame, destination, job_config=None, **kwargs) -> FakeJob:
+        table_id = self._table_id(destination)
+        schema = list(getattr(job_config, 'schema', None) or [])
+        truncate = getattr(job_config, 'write_disposition', None) == 'WRITE_TRUNCATE'
+        rows = self.warehouse.write(df, table_id, schema=schema, truncate=truncate)
+        return FakeJob(affected_rows=rows)
+
+    def load_table_from_file(self, file_obj, destination, job_config=None, **kwargs) -> FakeJob:
+        """Parquet loads only, which is what the ETL flow sends."""
+        return self.load_table_from_dataframe(pd.read_parquet(file_obj), destination, job_config=job_config)
+
+    def query(self, sql: str, job_config=None, **kwargs) -> FakeJob:
+        merge = _MERGE_RE.search(sql)
+        if merge:
+            columns = [c.strip() for c in merge.group('columns').split(',')]
+            affected = self.warehouse.merge(merge.group('target'), merge.group('source'), merge.group('on'), columns)
+            return FakeJob(affected_rows=affected)
+        params = {}
+        for parameter in getattr(job_config, 'query_parameters', None) or []:
+            value = getattr(parameter, 'value', None)
+            params[parameter.name] = _sqlite_value(value) if value is not None else None
+        return self.warehouse.execute(sql, params)
@@ -0,0 +1,475 @@
+"""Drive synthetic uploads through the whole pipeline in one process.
+
+The real entry points are wired together exactly as they are deployed:
+
+    webhook -> strava-activity-events -> fetch_activity_data
+        -> etl-trigger -> trigger_prefect_flow -> Prefect API -> etl_flow
+        -> make-prediction -> make_predictions -> Strava description
+
+with Cloud Storage, Pub/Sub, BigQuery, the Strava API and the Prefect API
+replaced by the stand-ins in ``fakes.py``. Before the run a model is trained
+by the real ``train_kmeans`` on synthetic clustering data, so predictions go
+through the model registry as well.
+
+Each stage's latency is reported as p50/p95/p99 with its throughput, along
+with queue waits and end-to-end times from upload to warehouse and from upload
+to the updated Strava description. Spans from ``tracing`` are exported to
+``traces.otlp.jsonl`` in the work directory, and the summary counts the uploads
+whose trace reached every entry point.
+
+With ``--batch N`` the etl-trigger topic is drained by ``dispatch_etl_batches``
+instead, as a pull subscription, so each flow run covers up to N activities.
+
+With ``--history N`` a new athlete with N past activities authorizes through
+``oauth_flow`` as the uploads start, and ``import_history`` imports them
+alongside; ``--strava-rate-limit`` makes the fake Strava API enforce limits.
+
+Usage (from the repository root, with the functions' and flows' requirements installed):
+
+    python local_scripts/pipeline_harness/run_harness.py --uploads 200 --athletes 5 --rate 20
+    python local_scripts/pipeline_harness/run_harness.py --uploads 200 --batch 25 --batch-wait 2
+    python local_scripts/pipeline_harness/run_harness.py --uploads 50 --history 500 --strava-rate-limit 600,30000
+"""
+from collections import defaultdict
+from contextlib import redirect_stdout
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import fakes
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+FUNCTIONS_DIR = os.path.join(REPO_ROOT, 'cloud_functions')
+FLOWS_DIR = os.path.join(REPO_ROOT, 'prefect', 'flows')
+
+PROJECT_ID = 'strava-etl'
+EVENTS_TOPIC = f'projects/{PROJECT_ID}/topics/strava-activity-events'
+ETL_TOPIC = f'projects/{PROJECT_ID}/topics/etl-trigger'
+ETL_SUBSCRIPTION = f'projects/{PROJECT_ID}/subscriptions/etl-trigger-dispatch'
+PREDICT_TOPIC = f'projects/{PROJECT_ID}/topics/make-prediction'
+IMPORT_TOPIC = f'projects/{PROJECT_ID}/topics/import-history'
+ACTIVITIES_TABLE = 'strava-etl.strava_data.activities'
+LAPS_TABLE = 'strava-etl.strava_data.laps'
+ROUTE_CELLS_TABLE = 'strava-etl.strava_data.route_cells'
+
+FIRST_ACTIVITY_ID = 10_000_000_000
+FIRST_ATHLETE_ID = 1000
+TRAINING_ROWS = 400
+IDLE_TIMEOUT_SECONDS = 600
+
+# Stages in pipeline order, then the end-to-end measurements
+STAGE_ORDER = [
+    'webhook',
+    'pubsub wait: strava-activity-events', 'fetch-data',
+    'pubsub wait: etl-trigger', 'trigger_prefect', 'dispatch_etl_batches',
+    'prefect wait: flow run', 'etl_flow',
+    'pubsub wait: make-prediction', 'make-predictions',
+    'oauth', 'pubsub wait: import-history', 'import-history',
+    'end-to-end: upload -> warehouse', 'end-to-end: upload -> description',
+]
+# Entry point spans every upload's trace should contain, and the spans that hand it to the ETL
+# flow (one of them: the push trigger, or a dispatcher batch linking to the trace)
+TRACED_ENTRY_POINTS = {'webhook', 'fetch_activity_data', 'etl_flow', 'make_predictions'}
+TRACED_HANDOFFS = {'trigger_prefect_flow', 'etl_batch'}
+
+
+def load_module(name: str):
+    """Import ``cloud_functions/<name>/main.py`` as its own module."""
+    directory = os.path.join(FUNCTIONS_DIR, name)
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    spec = importlib.util.spec_from_file_location(f"{name.replace('-', '_')}_main", os.path.join(directory, 'main.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_function(name: str, entry_point: str):
+    """Import ``cloud_functions/<name>/main.py`` and return the entry point."""
+    return getattr(load_module(name), entry_point)
+
+
+def load_trigger_prefect(args):
+    """Import trigger_prefect pointed at the fake Prefect API.
+
+    It reads its settings at import; they are set only while it loads so the
+    Prefect client used by the flow module is not pointed at the fake API.
+    """
+    settings = dict(PREFECT_API_URL=fakes.FakePrefect.API_URL, PREFECT_API_KEY='local',
+                    PREFECT_DEPLOYMENT_ID='local-deployment')
+    if args.batch:
+        settings.update(ETL_SUBSCRIPTION=ETL_SUBSCRIPTION, BATCH_MAX_ACTIVITIES=str(args.batch),
+                        BATCH_MAX_WAIT_SECONDS=str(args.batch_wait), DISPATCH_RUN_SECONDS='1')
+    saved = {key: os.environ.get(key) for key in settings}
+    os.environ.update(settings)
+    try:
+        return load_module('trigger_prefect')
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+def load_etl_flow():
+    """Import the ETL flow and return a plain callable that runs it without a Prefect server.
+
+    Tasks are swapped for their underlying functions so the flow body runs as ordinary
+    Python, and the credentials block is replaced because the clients are fakes anyway.
+    """
+    sys.path.insert(0, FLOWS_DIR)
+    from prefect.tasks import Task
+    import etl_flow
+
+    for name, value in list(vars(etl_flow).items()):
+        if isinstance(value, Task):
+            setattr(etl_flow, name, value.fn)
+
+    class LocalCredentials:
+        def get_credentials_from_service_account(self):
+            return None
+
+    etl_flow.get_gcp_creds = LocalCredentials
+    return etl_flow, etl_flow.etl_flow.fn
+
+
+def serialize_online_store(feature_store, bucket, local_path: str) -> None:
+    """Install a process-wide online store whose methods are serialized.
+
+    Deployed functions each have their own instance; here they share one process,
+    and the store keeps a single SQLite connection that ``put_many`` closes.
+    """
+    store = feature_store.OnlineFeatureStore(bucket, local_path=local_path)
+    lock = threading.RLock()
+    for name in ('get', 'get_many', 'put', 'put_many', 'compact', 'refresh'):
+        method = getattr(store, name)
+
+        def locked(*args, _method=method, **kwargs):
+            with lock:
+                return _method(*args, **kwargs)
+        setattr(store, name, locked)
+    feature_store._online_stores[feature_store.FEATURE_BUCKET] = store
+
+
+def timed(recorder: fakes.StageRecorder, stage: str, handler):
+    """Wrap a cloud event handler so its duration and outcome are recorded under ``stage``."""
+    def wrapper(cloud_event):
+        started = time.perf_counter()
+        ok = False
+        try:
+            result = handler(cloud_event)
+            ok = not (isinstance(result, tuple) and len(result) > 1 and result[1] >= 400)
+            return result
+        except Exception:
+            logging.getLogger('harness').exception(f"{stage} raised")
+        finally:
+            recorder.record(stage, started, time.perf_counter() - started, ok)
+    return wrapper
+
+
+def seed_tables(warehouse: fakes.Warehouse, etl_flow, feature_store) -> None:
+    """Create the warehouse tables as the flow would on a new project, and the offline feature table."""
+    from google.cloud import bigquery
+
+    client = bigquery.Client()
+    for table_id in (ACTIVITIES_TABLE, LAPS_TABLE, ROUTE_CELLS_TABLE):
+        etl_flow.warehouse_schema.ensure_table(client, etl_flow.schema_registry.for_table(table_id))
+
+    rng = np.random.default_rng(0)
+    distance = rng.choice([5000, 10000, 21100, 30000], TRAINING_ROWS) * rng.uniform(0.8, 1.2, TRAINING_ROWS)
+    moving_time = distance / rng.uniform(2.5, 4.2, TRAINING_ROWS)
+    training = pd.DataFrame({
+        'id': [str(i) for i in range(TRAINING_ROWS)],
+        'athlete_id': FIRST_ATHLETE_ID,
+        'start_date': pd.Timestamp('2024-01-01T07:00:00Z'),
+        'distance': distance,
+        'moving_time': moving_time,
+        'average_heartrate': rng.uniform(125, 175, TRAINING_ROWS),
+        'suffer_score': moving_time / 60 * rng.uniform(0.5, 1.5, TRAINING_ROWS),
+    })
+    warehouse.write(training, feature_store.OFFLINE_TABLE, schema=feature_store.offline_schema())
+
+
+def seed_tokens(storage_client, athletes: int) -> None:
+    bucket = storage_client.bucket('strava-users')
+    for index in range(athletes):
+        bucket.blob(f'tokens/{FIRST_ATHLETE_ID + index}.json').upload_from_string(
+            json.dumps({'access_token': 'local-access', 'refresh_token': 'local-refresh'})
+        )
+
+
+def drive_uploads(webhook, recorder: fakes.StageRecorder, strava: fakes.FakeStrava, args) -> None:
+    """POST one webhook event per synthetic upload, at ``args.rate`` uploads per second (0 = unthrottled)."""
+    from flask import Flask, request
+
+    app = Flask('harness')
+    rng = random.Random(args.seed)
+    interval = 1.0 / args.rate if args.rate else 0.0
+    next_at = time.perf_counter()
+    for index in range(args.uploads):
+        activity_id = FIRST_ACTIVITY_ID + index
+        athlete_id = FIRST_ATHLETE_ID + rng.randrange(args.athletes)
+        start = pd.Timestamp('2024-01-01T06:00:00Z') + pd.Timedelta(days=index // 2, hours=rng.randrange(12))
+        strava.register(athlete_id, activity_id, start)
+        event = {
+            'aspect_type': 'create', 'event_time': int(time.time()), 'object_id': activity_id,
+            'object_type': 'activity', 'owner_id': athlete_id, 'subscription_id': 1, 'updates': {},
+        }
+
+        if interval:
+            time.sleep(max(0.0, next_at - time.perf_counter()))
+            next_at += interval
+        started = time.perf_counter()
+        recorder.mark(activity_id, 'uploaded', started)
+        ok = False
+        try:
+            with app.test_request_context('/webhook', method='POST', json=event):
+                result = webhook(request)
+            ok = isinstance(result, tuple) and result[1] == 200
+        except Exception:
+            logging.getLogger('harness').exception(f"webhook raised for activity {activity_id}")
+        finally:
+            recorder.record('webhook', started, time.perf_counter() - started, ok)
+
+
+def onboard_athlete(oauth_flow, recorder: fakes.StageRecorder, strava: fakes.FakeStrava, args) -> int:
+    """Give a new athlete ``args.history`` past activities and run them through the OAuth callback."""
+    from flask import Flask, request
+
+    athlete_id = FIRST_ATHLETE_ID + args.athletes
+    for index in range(args.history):
+        start = pd.Timestamp('2023-12-31T07:00:00Z') - pd.Timedelta(days=index, hours=index % 5)
+        strava.register(athlete_id, FIRST_ACTIVITY_ID - 1 - index, start)
+
+    started = time.perf_counter()
+    with Flask('harness').test_request_context(f'/?code=athlete-{athlete_id}'):
+        result = oauth_flow(request)
+    recorder.record('oauth', started, time.perf_counter() - started, 'being imported' in str(result))
+    return athlete_id
+
+
+def import_progress(import_history_module, storage_client, athlete_id: int) -> dict:
+    """Progress of the athlete's import from its checkpoint, as resume_imports reports it."""
+    blob = storage_client.bucket('strava-users').get_blob(f'imports/athlete_{athlete_id}.json')
+    if blob is None:
+        return {'status': 'not started'}
+    return import_history_module.progress(json.loads(blob.download_as_bytes()))
+
+
+def run_dispatcher(dispatch_etl_batches, recorder: fakes.StageRecorder, stop: threading.Event) -> None:
+    """Invoke the dispatcher back to back, as Cloud Scheduler would on a much longer period."""
+    while not stop.is_set():
+        started = time.perf_counter()
+        body, status = dispatch_etl_batches(None)
+        # Invocations that found nothing to dispatch would only dilute the latencies
+        if status != 200 or json.loads(body)['flow_runs']:
+            recorder.record('dispatch_etl_batches', started, time.perf_counter() - started, status == 200)
+
+
+def wait_until_idle(broker: fakes.PubSubBroker, prefect: fakes.FakePrefect, timeout: float) -> bool:
+    """Wait until no message or flow run is in flight (a flow run can publish nothing, and vice versa)."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if broker.wait_idle(timeout=1.0) and prefect.wait_idle(timeout=1.0) and broker.pending == 0:
+            return True
+    return False
+
+
+def summarize(recorder: fakes.StageRecorder) -> dict:
+    """Per-stage count, errors, latency percentiles (ms) and throughput (per second)."""
+    samples = dict(recorder.samples)
+    for name, event in (('end-to-end: upload -> warehouse', 'loaded'),
+                        ('end-to-end: upload -> description', 'description_updated')):
+        samples[name] = [(marks['uploaded'], marks[event] - marks['uploaded'], True)
+                         for marks in recorder.marks.values() if 'uploaded' in marks and event in marks]
+
+    report = {}
+    for stage in STAGE_ORDER + sorted(set(samples) - set(STAGE_ORDER)):
+        rows = samples.get(stage)
+        if not rows:
+            continue
+        seconds = np.array([row[1] for row in rows]) * 1000
+        window = max(row[0] + row[1] for row in rows) - min(row[0] for row in rows)
+        report[stage] = {
+            'count': len(rows),
+            'errors': sum(1 for row in rows if not row[2]),
+            'p50_ms': float(np.percentile(seconds, 50)),
+            'p95_ms': float(np.percentile(seconds, 95)),
+            'p99_ms': float(np.percentile(seconds, 99)),
+            'mean_ms': float(seconds.mean()),
+            'throughput_per_s': len(rows) / window if window > 0 else None,
+        }
+    return report
+
+
+def complete_traces(path: str) -> int:
+    """Number of traces in the OTLP/JSON export that contain every entry point span.
+
+    A span linking to a trace (a batched flow run) counts towards that trace too.
+    """
+    if not os.path.exists(path):
+        return 0
+    names = defaultdict(set)
+    with open(path) as f:
+        for line in f:
+            for resource in json.loads(line)['resourceSpans']:
+                for scope in resource['scopeSpans']:
+                    for span in scope['spans']:
+                        names[span['traceId']].add(span['name'])
+                        for link in span.get('links', []):
+                            names[link['traceId']].add(span['name'])
+    return sum(1 for found in names.values() if TRACED_ENTRY_POINTS <= found and found & TRACED_HANDOFFS)
+
+
+def print_report(report: dict, summary: dict, out) -> None:
+    header = f"{'stage':<36} {'count':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'mean ms':>9} {'per s':>8}"
+    print(header, file=out)
+    print('-' * len(header), file=out)
+    for stage, row in report.items():
+        throughput = f"{row['throughput_per_s']:.1f}" if row['throughput_per_s'] else '-'
+        print(f"{stage:<36} {row['count']:>6} {row['errors']:>6} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} "
+              f"{row['p99_ms']:>9.1f} {row['mean_ms']:>9.1f} {throughput:>8}", file=out)
+    print('', file=out)
+    for key, value in summary.items():
+        print(f"{key}: {value}", file=out)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--uploads', type=int, default=100, help='number of synthetic uploads')
+    parser.add_argument('--athletes', type=int, default=3, help='number of athletes the uploads are spread over')
+    parser.add_argument('--rate', type=float, default=0, help='uploads per second (0 = as fast as possible)')
+    parser.add_argument('--workers', type=int, default=4, help='concurrent instances per Pub/Sub-triggered function')
+    parser.add_argument('--flow-workers', type=int, default=2, help='concurrent ETL flow runs')
+    parser.add_argument('--batch', type=int, default=0,
+                        help='dispatch ETL triggers in batches of up to N activities per flow run (0 = one each)')
+    parser.add_argument('--batch-wait', type=float, default=2.0,
+                        help='seconds the dispatcher buffers a batch before dispatching it anyway')
+    parser.add_argument('--history', type=int, default=0,
+                        help='past activities of a new athlete onboarded through oauth_flow as the uploads start')
+    parser.add_argument('--strava-rate-limit', default=None,
+                        help="Strava API limits as '15-minute,daily' (e.g. 600,30000; default: unlimited)")
+    parser.add_argument('--api-latency-ms', type=float, default=20, help='simulated latency of each HTTP call')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='directory for the fake bucket, warehouse and logs (default: a temp dir)')
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--verbose', action='store_true', help='show function output instead of logging it to a file')
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='pipeline_harness_')
+    os.makedirs(workdir, exist_ok=True)
+    log_path = os.path.join(workdir, 'functions.log')
+    log_file = sys.stdout if args.verbose else open(log_path, 'w')
+    logging.basicConfig(level=logging.INFO, stream=log_file,
+                        format='%(asctime)s %(threadName)s %(name)s %(levelname)s %(message)s')
+    out = sys.stdout
+
+    trace_path = os.path.join(workdir, 'traces.otlp.jsonl')
+    os.environ.update(PROJECT_ID=PROJECT_ID, CLIENT_ID='local', CLIENT_SECRET='local', VERIFY_TOKEN='local',
+                      TRACE_EXPORT_PATH=trace_path)
+
+    recorder = fakes.StageRecorder()
+    warehouse = fakes.Warehouse(os.path.join(workdir, 'warehouse.sqlite'))
+    broker = fakes.PubSubBroker(recorder)
+    router = fakes.HttpRouter(latency_ms=args.api_latency_ms)
+    rate_limit = tuple(int(part) for part in args.strava_rate_limit.split(',')) if args.strava_rate_limit else None
+    strava = fakes.FakeStrava(recorder, seed=args.seed, rate_limit=rate_limit)
+    router.add(fakes.FakeStrava.HOST, strava)
+
+    from google.cloud import bigquery, pubsub_v1, storage
+    storage.Client = fakes.FakeStorageClient.factory(os.path.join(workdir, 'gcs'))
+    pubsub_v1.PublisherClient = fakes.FakePublisher.factory(broker)
+    pubsub_v1.SubscriberClient = fakes.FakeSubscriber.factory(broker)
+    bigquery.Client = fakes.FakeBigQueryClient.factory(warehouse)
+    router.install()
+
+    with redirect_stdout(log_file):
+        etl_flow, run_flow = load_etl_flow()
+        prefect = fakes.FakePrefect(recorder, run_flow, workers=args.flow_workers)
+        router.add(fakes.FakePrefect.HOST, prefect)
+
+        trigger_prefect = load_trigger_prefect(args)
+        webhook = load_function('webhooks', 'webhook')
+        fetch_activity_data = load_function('fetch-data', 'fetch_activity_data')
+        make_predictions = load_function('make-predicitons', 'make_predictions')
+        train_kmeans = load_function('kmeans-model', 'train_kmeans')
+        oauth_flow = load_function('oauth', 'oauth_flow')
+        import_history = load_module('import-history')
+
+        import bq_arrow
+        import feature_store
+        bq_arrow._read_client['checked'] = True  # read results through the fake client only
+        storage_client = storage.Client()
+        serialize_online_store(feature_store, storage_client.bucket(feature_store.FEATURE_BUCKET),
+                               os.path.join(workdir, 'online_features.sqlite'))
+
+        seed_tables(warehouse, etl_flow, feature_store)
+        seed_tokens(storage_client, args.athletes)
+        print(train_kmeans(None))
+
+        broker.subscribe(EVENTS_TOPIC, timed(recorder, 'fetch-data', fetch_activity_data), workers=args.workers)
+        broker.subscribe(PREDICT_TOPIC, timed(recorder, 'make-predictions', make_predictions), workers=args.workers)
+        broker.subscribe(IMPORT_TOPIC, timed(recorder, 'import-history', import_history.import_history))
+        stop_dispatcher = threading.Event()
+        if args.batch:
+            broker.add_pull_subscription(ETL_TOPIC, ETL_SUBSCRIPTION)
+            dispatcher = threading.Thread(target=run_dispatcher, name='dispatcher', daemon=True,
+                                          args=(trigger_prefect.dispatch_etl_batches, recorder, stop_dispatcher))
+            dispatcher.start()
+        else:
+            broker.subscribe(ETL_TOPIC, timed(recorder, 'trigger_prefect', trigger_prefect.trigger_prefect_flow),
+                             workers=args.workers)
+
+        started = time.perf_counter()
+        history_athlete = onboard_athlete(oauth_flow, recorder, strava, args) if args.history else None
+        drive_uploads(webhook, recorder, strava, args)
+        idle = wait_until_idle(broker, prefect, IDLE_TIMEOUT_SECONDS)
+        elapsed = time.perf_counter() - started
+        stop_dispatcher.set()
+        broker.stop()
+        router.uninstall()
+        history = import_progress(import_history, storage_client, history_athlete) if args.history else None
+
+    report = summarize(recorder)
+    summary = {
+        'uploads': args.uploads,
+        'wall time (s)': round(elapsed, 2),
+        'overall throughput (uploads/s)': round(args.uploads / elapsed, 2) if elapsed else None,
+        'drained': idle,
+        'activities rows': warehouse.count(ACTIVITIES_TABLE),
+        'laps rows': warehouse.count(LAPS_TABLE),
+        'route cell rows': warehouse.count(ROUTE_CELLS_TABLE),
+        'flow runs': len(prefect.run_sizes),
+        'activities per flow run (mean)': round(float(np.mean(prefect.run_sizes)), 1) if prefect.run_sizes else None,
+        'descriptions updated': sum(1 for a in strava.activities.values()
+                                    if a['description'].startswith('Predicted Run Type')),
+        'uploads traced through every function': complete_traces(trace_path),
+        'Strava API calls': dict(sorted(strava.calls.items())),
+        'Strava calls refused (429)': strava.rate_limited,
+        'statements skipped by the local warehouse': dict(warehouse.skipped),
+        'workdir': workdir,
+    }
+    if history is not None:
+        summary['history import'] = history
+    print_report(report, summary, out)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'stages': report, 'summary': summary}, f, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()
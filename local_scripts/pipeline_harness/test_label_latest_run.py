@@ -0,0 +1,67 @@
+"""label-latest-run against the local warehouse: runs older than the watermark still get labeled.
+
+    python -m pytest local_scripts/pipeline_harness/test_label_latest_run.py
+"""
+from datetime import datetime, timezone
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakes  # noqa: E402
+import run_harness  # noqa: E402
+
+WATERMARK = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def label_latest_run(tmp_path, monkeypatch):
+    """The function's module wired to a SQLite warehouse and a bucket directory holding a trained model."""
+    from google.cloud import bigquery, storage
+    from sklearn.cluster import KMeans
+    from sklearn.preprocessing import StandardScaler
+
+    warehouse = fakes.Warehouse(str(tmp_path / 'warehouse.sqlite'))
+    monkeypatch.setattr(bigquery, 'Client', fakes.FakeBigQueryClient.factory(warehouse))
+    monkeypatch.setattr(storage, 'Client', fakes.FakeStorageClient.factory(str(tmp_path / 'gcs')))
+    module = run_harness.load_module('label-latest-run')
+    monkeypatch.setitem(module.bq_arrow._read_client, 'checked', True)
+
+    features = module.feature_store.FEATURE_NAMES
+    training = np.random.default_rng(0).uniform(1, 100, (40, len(features)))
+    scaler = StandardScaler().fit(training)
+    model = KMeans(n_clusters=4, n_init=1, random_state=0).fit(scaler.transform(training))
+    registry = module.model_registry
+    registry.publish_version(storage.Client().bucket(registry.MODEL_BUCKET), scaler, model, features,
+                             registry.name_clusters(scaler.inverse_transform(model.cluster_centers_), features))
+    return module, warehouse
+
+
+def activity(activity_id: int, start_date: str) -> dict:
+    return {'id': activity_id, 'athlete_id': 1, 'start_date': pd.Timestamp(start_date), 'distance': 5000.0 + activity_id,
+            'moving_time': 1500.0, 'average_heartrate': 150.0, 'suffer_score': 40.0}
+
+
+def test_activity_older_than_watermark_is_labeled(label_latest_run):
+    module, warehouse = label_latest_run
+    warehouse.write(pd.DataFrame([
+        activity(1, '2024-05-30T08:00:00Z'),  # labeled before
+        activity(2, '2023-03-01T08:00:00Z'),  # imported history, older than watermark and lookback
+        activity(3, '2024-06-02T08:00:00Z'),  # new
+    ]), module.ACTIVITIES_TABLE)
+    warehouse.write(pd.DataFrame([{**activity(1, '2024-05-30T08:00:00Z'), 'run_type_str': 'Long Tempo Run'}])
+                    [module.LABEL_COLUMNS], module.LABELS_TABLE)
+    warehouse.write(pd.DataFrame([{'name': module.WATERMARK_NAME, 'watermark': pd.Timestamp(WATERMARK),
+                                   'updated_at': pd.Timestamp(WATERMARK)}]), module.watermarks.WATERMARK_TABLE)
+
+    message, status = module.process_new_run(None, None)
+
+    assert status == 200, message
+    labels = pd.read_sql_query(f'SELECT id, run_type_str FROM "{module.LABELS_TABLE}"', warehouse.conn)
+    assert sorted(labels['id']) == [1, 2, 3]
+    assert labels['run_type_str'].notna().all()
+    # Labeling again finds nothing: the anti-join covers the whole labels table
+    assert module.process_new_run(None, None) == ("No new runs found", 200)
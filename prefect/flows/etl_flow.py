@@ -2,40 +2,86 @@ from prefect import flow, task
 from prefect_gcp import GcpCredentials
 from google.cloud import storage
 from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import io
 import json
 import pandas as pd
-from typing import Dict, Any, List
+import pyarrow.parquet as pq
+from typing import Dict, Any, List, Optional, Union
 import logging
+import uuid
+import geo
+import rollups
+import schema_registry
+import tracing
+import warehouse_schema
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Configure logging; every line carries the trace it belongs to
+tracing.instrument_logging()
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [trace %(trace_id)s] %(message)s')
 logger = logging.getLogger(__name__)
 
+# Concurrent document downloads when extracting a batch of activities
+EXTRACT_WORKERS = 16
+
 @task
 def get_gcp_creds():
     return GcpCredentials.load("gcp-creds")
 
-@task
-def extract_data(gcp_credentials: GcpCredentials, athlete_id: str, activity_id: str) -> Dict[str, Any]:
-    logger.info(f"Extracting data for athlete {athlete_id} and activity {activity_id}")
-    storage_client = storage.Client(credentials=gcp_credentials.get_credentials_from_service_account())
-    bucket = storage_client.bucket('strava-users')
+def download_documents(bucket, athlete_id: str, activity_id: str):
+    """The stored activity and laps documents of one activity."""
     activity_blob = bucket.blob(f'activities/athlete_{athlete_id}_activity_{activity_id}_activities.json')
     laps_blob = bucket.blob(f'laps/athlete_{athlete_id}_activity_{activity_id}_laps.json')
     
-    activity_data = json.loads(activity_blob.download_as_string())
-    laps_data = json.loads(laps_blob.download_as_string())
-    
-    logger.info(f"Extracted activity data with {len(activity_data)} fields")
-    logger.info(f"Extracted laps data with {len(laps_data)} laps")
+    with tracing.span('gcs.download', bucket=bucket.name, object=activity_blob.name):
+        activity_data = json.loads(activity_blob.download_as_string())
+    with tracing.span('gcs.download', bucket=bucket.name, object=laps_blob.name):
+        laps_data = json.loads(laps_blob.download_as_string())
     
+    return activity_data, laps_data
+
+@task
+def extract_batch(gcp_credentials: GcpCredentials, activity_keys: List[Dict[str, str]]) -> Dict[str, Any]:
+    """Download the documents of a batch of activities concurrently.
+
+    Activities whose documents are missing are logged and left out, so one bad
+    key doesn't fail the batch; a batch with nothing to load raises.
+    """
+    logger.info(f"Extracting data for {len(activity_keys)} activities")
+    storage_client = storage.Client(credentials=gcp_credentials.get_credentials_from_service_account())
+    bucket = storage_client.bucket('strava-users')
+
+    with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as pool:
+        # Each download runs in a copy of this context so its spans join the flow's trace
+        futures = [
+            pool.submit(contextvars.copy_context().run, download_documents, bucket, key['athlete_id'], key['activity_id'])
+            for key in activity_keys
+        ]
+
+    activities, laps, missing = [], [], []
+    for key, future in zip(activity_keys, futures):
+        try:
+            activity_data, laps_data = future.result()
+        except NotFound as e:
+            logger.warning(f"Skipping activity {key['activity_id']} of athlete {key['athlete_id']}: {str(e)}")
+            missing.append(key['activity_id'])
+            continue
+        activities.append(activity_data)
+        laps.extend(laps_data)
+    if not activities:
+        raise ValueError(f"No stored documents for any of activities {missing}")
+
+    logger.info(f"Extracted {len(activities)} activities and {len(laps)} laps ({len(missing)} missing)")
     return {
-        'activity': activity_data,
-        'laps': laps_data
+        'activities': activities,
+        'laps': laps,
+        'missing': missing
     }
 
 @task
-def transform_activity_data(activity_data: Dict[str, Any]) -> pd.DataFrame:
+def transform_activity_data(activity_data: Union[Dict[str, Any], List[Dict[str, Any]]]) -> pd.DataFrame:
     logger.info("Transforming activity data")
     
     columns_to_keep = [
@@ -54,54 +100,57 @@ def transform_activity_data(activity_data: Dict[str, Any]) -> pd.DataFrame:
         'device_name', 'embed_token', 'athlete_id'
     ]
     
-    df = pd.json_normalize(activity_data, sep='_')[columns_to_keep]
+    df = pd.json_normalize(activity_data, sep='_')
+    # Manual and trainer activities have no route
+    polylines = df['map_summary_polyline'] if 'map_summary_polyline' in df.columns else pd.Series(None, index=df.index)
+    df = df[columns_to_keep]
 
+    # Dates are parsed here for the derived columns; every other type comes from the schema registry at load
     date_columns = ['start_date', 'start_date_local']
     for col in date_columns:
         df[col] = pd.to_datetime(df[col])
 
-    int_columns = ['resource_state', 'moving_time', 'elapsed_time', 
-                   'workout_type', 'id', 'achievement_count', 'kudos_count', 
-                   'comment_count', 'athlete_count', 'photo_count', 
-                   'trainer', 'commute', 'manual', 'private', 'flagged', 
-                   'upload_id', 'upload_id_str', 'pr_count', 
-                   'total_photo_count', 'prefer_perceived_exertion']
-
-    for col in int_columns:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce', downcast='integer')
-
     df['elevation_change'] = df['elev_high'] - df['elev_low']
 
     df['day_of_week'] = df['start_date_local'].dt.day_name()
     df['hour'] = df['start_date_local'].dt.hour
     df['month'] = df['start_date_local'].dt.month_name()
 
-    if 'start_latlng' in df.columns and 'end_latlng' in df.columns:
-        df['start_latlng'] = df['start_latlng'].apply(
-            lambda x: ','.join(map(str, x)) if isinstance(x, list) else x
-        )
-        df['end_latlng'] = df['end_latlng'].apply(
-            lambda x: ','.join(map(str, x)) if isinstance(x, list) else x
-        )
+    # Numeric start/end coordinates, the decoded route and its start geohash
+    df = geo.add_geometry(df, polylines)
 
     logger.info(f"Transformed activity data into DataFrame with shape {df.shape}")
     return df
 
+@task
+def transform_route_cells(activities: pd.DataFrame) -> pd.DataFrame:
+    """Rows of the route_cells index for transformed activities."""
+    cells = geo.route_cells(activities)
+    logger.info(f"Indexed {len(cells)} route cells for {cells['activity_id'].nunique()} activities")
+    return cells
+
+@task
+def clear_route_cells(gcp_credentials: GcpCredentials, df: pd.DataFrame, stored: pd.DataFrame) -> None:
+    """Delete the route cells of activities loaded before, so cells an edited route left don't stay behind."""
+    bounds = warehouse_schema.merge_range((), stored['start_date'])
+    if bounds is None:
+        return  # none of the activities was stored before
+    client = bigquery.Client(credentials=gcp_credentials.get_credentials_from_service_account())
+    sql, parameters = geo.delete_cells_query(df['athlete_id'].dropna(), df['id'], bounds)
+    try:
+        with tracing.span('bigquery.delete_route_cells', table=geo.ROUTE_CELLS_TABLE):
+            client.query(sql, job_config=bigquery.QueryJobConfig(query_parameters=parameters)).result()
+    except NotFound:
+        pass  # the first load creates the table
+
 @task
 def transform_laps_data(laps_data: List[Dict[str, Any]]) -> pd.DataFrame:
     logger.info("Transforming laps data")
     
-    # Extract activity_id and athlete_id before normalizing
-    activity_id = laps_data[0]['activity']['id']
-    athlete_id = laps_data[0]['athlete']['id']
-    
+    # Laps of several activities can be transformed together: each lap carries
+    # its activity and athlete, which normalize to activity_id and athlete_id
     df = pd.json_normalize(laps_data, sep='_')
     
-    # Add IDs as new columns
-    df['activity_id'] = activity_id
-    df['athlete_id'] = athlete_id
-    
     # Group columns logically
     identifier_columns = [
         'id',                    # Lap ID
@@ -161,29 +210,12 @@ def transform_laps_data(laps_data: List[Dict[str, Any]]) -> pd.DataFrame:
     # Keep only the columns we want
     df = df[columns_to_keep]
     
-    # Handle dates
+    # Handle dates (other column types come from the schema registry at load)
     date_columns = ['start_date', 'start_date_local']
     for col in date_columns:
         if col in df.columns:
             df[col] = pd.to_datetime(df[col])
     
-    # Convert numeric columns to appropriate types
-    int_columns = identifier_columns + ['elapsed_time', 'moving_time', 
-                                      'device_watts', 'pace_zone', 'split',
-                                      'start_index', 'end_index']
-    
-    float_columns = ['distance', 'average_speed', 'max_speed', 
-                    'total_elevation_gain', 'average_cadence', 
-                    'average_watts', 'average_heartrate', 'max_heartrate']
-    
-    for col in int_columns:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce', downcast='integer')
-    
-    for col in float_columns:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-    
     # Add time-based columns for analysis
     if 'start_date_local' in df.columns:
         df['start_day'] = df['start_date_local'].dt.day
@@ -191,7 +223,7 @@ def transform_laps_data(laps_data: List[Dict[str, Any]]) -> pd.DataFrame:
         df['start_weekday'] = df['start_date_local'].dt.weekday
     
     logger.info(f"Transformed laps data into DataFrame with shape {df.shape}")
-    logger.info(f"Sample of IDs - activity_id: {activity_id}, athlete_id: {athlete_id}")
+    logger.info(f"Laps cover {df['activity_id'].nunique()} activities")
     
     return df
 
@@ -207,120 +239,122 @@ def transform_laps_data(laps_data: List[Dict[str, Any]]) -> pd.DataFrame:
 #     logger.info(f"Successfully loaded {len(df)} rows into {table_id}")
 
 @task
-def load_to_bigquery(gcp_credentials: GcpCredentials, df: pd.DataFrame, table_id: str) -> None:
+def load_to_bigquery(gcp_credentials: GcpCredentials, df: pd.DataFrame, table_id: str,
+                     stored_start_dates: Optional[pd.Series] = None) -> None:
+    """MERGE ``df`` into ``table_id``.
+
+    ``stored_start_dates`` are the start dates the batch's activities were
+    stored under before this load; rows still stored there are updated rather
+    than inserted again when an activity was edited into another month.
+    """
     logger.info(f"Loading {len(df)} rows into BigQuery table {table_id}")
     client = bigquery.Client(credentials=gcp_credentials.get_credentials_from_service_account())
     
-    # Define unique key combinations based on table
-    if table_id.endswith('activities'):
-        unique_keys = ['athlete_id', 'id']  # id here is activity_id
-    elif table_id.endswith('laps'):
-        unique_keys = ['athlete_id', 'activity_id', 'id']
-    else:
-        raise ValueError(f"Unknown table type: {table_id}")
-        
-    logger.info(f"Using composite key: {unique_keys}")
-    
-    # Get the destination table schema
-    table = client.get_table(table_id)
-    schema_fields = {field.name: field.field_type for field in table.schema}
-    
-    # Check for new columns in the data that aren't in BigQuery
-    new_columns = set(df.columns) - set(schema_fields.keys())
-    if new_columns:
-        logger.info(f"Found new columns in data: {new_columns}")
-        
-        # Infer schema for new columns
-        new_schema_fields = []
-        for col in new_columns:
-            if pd.api.types.is_integer_dtype(df[col]):
-                field_type = 'INTEGER'
-            elif pd.api.types.is_float_dtype(df[col]):
-                field_type = 'FLOAT'
-            elif pd.api.types.is_datetime64_any_dtype(df[col]):
-                field_type = 'TIMESTAMP'
-            else:
-                field_type = 'STRING'
-            
-            new_schema_fields.append(
-                bigquery.SchemaField(col, field_type, mode='NULLABLE')
-            )
-            schema_fields[col] = field_type
-            
-        # Update table schema
-        if new_schema_fields:
-            new_schema = table.schema + new_schema_fields
-            table.schema = new_schema
-            table = client.update_table(table, ['schema'])
-            logger.info(f"Updated BigQuery schema with new columns: {new_columns}")
-    
-    # Add missing columns from BigQuery schema to DataFrame
-    for field_name, field_type in schema_fields.items():
-        if field_name not in df.columns:
-            logger.info(f"Adding missing column {field_name} with NULL values")
-            if field_type == 'INTEGER':
-                df[field_name] = pd.NA
-            elif field_type == 'FLOAT':
-                df[field_name] = pd.NA
-            elif field_type == 'STRING':
-                df[field_name] = None
-            elif field_type == 'TIMESTAMP':
-                df[field_name] = pd.NaT
-            else:
-                df[field_name] = None
+    # One cast of the whole batch to the registered schema; raises listing every column that doesn't fit
+    schema = schema_registry.for_table(table_id)
+    batch = schema_registry.conform(schema, df)
+    logger.info(f"Validated {batch.num_rows} rows against the {schema.name} schema, composite key {schema.merge_keys}")
+    warehouse_schema.ensure_table(client, schema)
     
-    # Configure the load job to use a temporary table
+    # Load the batch into a temporary table, unique per load so concurrent flow runs don't share one
+    temp_table_id = f"{table_id}_temp_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
     job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
         create_disposition=bigquery.CreateDisposition.CREATE_IF_NEEDED,
         write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
-        schema=table.schema
+        schema=schema.fields
+    )
+    parquet = io.BytesIO()
+    pq.write_table(batch, parquet)
+    parquet.seek(0)
+    
+    with tracing.span('bigquery.load', table=temp_table_id, rows=batch.num_rows):
+        job = client.load_table_from_file(parquet, temp_table_id, job_config=job_config)
+        job.result()
+    
+    # MERGE on the composite key; the batch's date range (and where it was stored before) limits the target scan
+    bounds = warehouse_schema.merge_range(batch.column(schema.partition_field).to_pandas(),
+                                          stored_start_dates if stored_start_dates is not None else ())
+    merge_query = warehouse_schema.merge_sql(schema, temp_table_id, pruned=bounds is not None)
+    merge_config = bigquery.QueryJobConfig(
+        query_parameters=warehouse_schema.range_parameters(bounds) if bounds else []
     )
-    
-    # Create a temporary table name
-    temp_table_id = f"{table_id}_temp_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}"
-    
-    # Load data into temporary table
-    job = client.load_table_from_dataframe(df, temp_table_id, job_config=job_config)
-    job.result()
-    
-    # Build the composite key matching condition
-    match_condition = ' AND '.join([f'T.{key} = S.{key}' for key in unique_keys])
-    
-    # Perform MERGE operation with composite key
-    merge_query = f"""
-    MERGE `{table_id}` T
-    USING `{temp_table_id}` S
-    ON {match_condition}
-    WHEN MATCHED THEN
-        UPDATE SET {', '.join([f'T.{col.name} = S.{col.name}' for col in table.schema if col.name not in unique_keys])}
-    WHEN NOT MATCHED THEN
-        INSERT ({', '.join([col.name for col in table.schema])})
-        VALUES ({', '.join([f'S.{col.name}' for col in table.schema])})
-    """
     
     # Execute merge query
-    merge_job = client.query(merge_query)
-    merge_job.result()
+    with tracing.span('bigquery.merge', table=table_id) as call:
+        merge_job = client.query(merge_query, job_config=merge_config)
+        merge_job.result()
+        call.set('bytes_processed', merge_job.total_bytes_processed)
+    scanned = f"months {bounds[0]:%Y-%m} up to {bounds[1]:%Y-%m}" if bounds else "the whole table"
+    logger.info(f"MERGE into {table_id} processed {merge_job.total_bytes_processed} bytes (target scan: {scanned})")
     
     # Clean up temporary table
-    client.delete_table(temp_table_id)
+    with tracing.span('bigquery.delete_table', table=temp_table_id):
+        client.delete_table(temp_table_id)
     
     logger.info(f"Successfully loaded/updated data in {table_id}")
 
-@flow
-def etl_flow(athlete_id: str, activity_id: str):
-    logger.info(f"Starting ETL flow for athlete {athlete_id} and activity {activity_id}")
+@task
+def read_stored_dates(gcp_credentials: GcpCredentials, df: pd.DataFrame) -> pd.DataFrame:
+    """Dates the batch's activities are stored under before this load (empty for new activities)."""
+    client = bigquery.Client(credentials=gcp_credentials.get_credentials_from_service_account())
     try:
-        gcp_creds = get_gcp_creds()
-        data = extract_data(gcp_creds, athlete_id, activity_id)
-        transformed_activity = transform_activity_data(data['activity'])
-        transformed_laps = transform_laps_data(data['laps'])
-        load_to_bigquery(gcp_creds, transformed_activity, "strava-etl.strava_data.activities")
-        load_to_bigquery(gcp_creds, transformed_laps, "strava-etl.strava_data.laps")
-        logger.info("ETL flow completed successfully")
-    except Exception as e:
-        logger.error(f"An error occurred during the ETL flow: {str(e)}")
-        raise
+        with tracing.span('bigquery.stored_dates'):
+            stored = rollups.stored_dates(client, df['athlete_id'].dropna(), df['id'])
+    except NotFound:
+        stored = []  # first load into a new project
+    return pd.DataFrame(stored, columns=['athlete_id', 'start_date', 'start_date_local'])
+
+# One rollup transaction at a time: concurrent DML on the same tables conflicts, and a conflict is retried
+@task(tags=[rollups.ROLLUP_CONCURRENCY_TAG], retries=3, retry_delay_seconds=10)
+def update_athlete_rollups(gcp_credentials: GcpCredentials, df: pd.DataFrame, stored: pd.DataFrame) -> None:
+    """Recompute the KPI rollup buckets touched by the loaded activities, old and new dates alike."""
+    client = bigquery.Client(credentials=gcp_credentials.get_credentials_from_service_account())
+    touched = pd.concat([df[stored.columns], stored], ignore_index=True)
+    with tracing.span('bigquery.update_rollups') as call:
+        bytes_processed = rollups.update_rollups(
+            client,
+            athlete_ids=touched['athlete_id'].dropna(),
+            days=pd.to_datetime(touched['start_date_local'], utc=True).dt.date,
+            start_dates=pd.to_datetime(touched['start_date'], utc=True),
+        )
+        call.set('bytes_processed', bytes_processed)
+    logger.info(f"Rollups updated ({bytes_processed} bytes processed)")
+
+@flow
+def etl_flow(athlete_id: Optional[str] = None, activity_id: Optional[str] = None,
+             traceparent: Optional[str] = None, activity_keys: Optional[List[Dict[str, str]]] = None):
+    """Load one activity, or a batch of them given as ``activity_keys``.
+
+    ``activity_keys`` ({'athlete_id', 'activity_id', 'traceparent'} dicts) come from
+    the trigger_prefect dispatcher, which creates one flow run per batch.
+    """
+    keys = activity_keys or [{'athlete_id': athlete_id, 'activity_id': activity_id}]
+    # traceparent continues the trigger's trace; each key links back to the trace of its webhook event
+    links = [tracing.parse_traceparent(key.get('traceparent')) for key in keys]
+    with tracing.span('etl_flow', kind='consumer', parent=tracing.parse_traceparent(traceparent),
+                      links=links, activities=len(keys)):
+        logger.info(f"Starting ETL flow for {len(keys)} activities: {[key['activity_id'] for key in keys]}")
+        try:
+            gcp_creds = get_gcp_creds()
+            data = extract_batch(gcp_creds, keys)
+            transformed_activity = transform_activity_data(data['activities'])
+            stored_dates = read_stored_dates(gcp_creds, transformed_activity)
+            load_to_bigquery(gcp_creds, transformed_activity, "strava-etl.strava_data.activities",
+                             stored_dates['start_date'])
+            route_cells = transform_route_cells(transformed_activity)
+            clear_route_cells(gcp_creds, transformed_activity, stored_dates)
+            if not route_cells.empty:
+                load_to_bigquery(gcp_creds, route_cells, geo.ROUTE_CELLS_TABLE, stored_dates['start_date'])
+            if data['laps']:
+                transformed_laps = transform_laps_data(data['laps'])
+                load_to_bigquery(gcp_creds, transformed_laps, "strava-etl.strava_data.laps",
+                                 stored_dates['start_date'])
+            update_athlete_rollups(gcp_creds, transformed_activity, stored_dates)
+            logger.info("ETL flow completed successfully")
+        except Exception as e:
+            logger.error(f"An error occurred during the ETL flow: {str(e)}")
+            raise
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,285 @@
+"""Route geometry for the activities table and the ``route_cells`` index.
+
+The ETL flow stores, per activity:
+
+* ``start_lat``/``start_lng``/``end_lat``/``end_lng`` as numbers,
+* the decoded ``map.summary_polyline`` as packed little-endian float32
+  (lat, lng) pairs in ``route_coordinates`` (8 bytes a point; read it back
+  with ``unpack_coordinates``),
+* ``start_geohash``, the start point's geohash.
+
+and one ``route_cells`` row per geohash cell an activity starts in
+(``kind = 'start'``, 6 characters, about 1.2 x 0.6 km) or passes through
+(``kind = 'route'``, 7 characters, about 150 x 150 m). Each row repeats the
+few activity columns the lookups return, and the table is clustered by cell,
+so "runs starting within 500 m of here" and "runs passing this cell" read
+only the blocks of the cells they ask for and never touch the activities
+table (``starts_near_query``, ``passing_query``).
+
+A segment longer than ``MAX_SEGMENT_METERS`` (a GPS glitch, or a gap in the
+recording) is not filled in, and a route that would still need more than
+``MAX_ROUTE_POINTS`` points is indexed at its polyline points only, so one
+bad polyline can't add millions of rows.
+
+Decoding, densifying and hashing a route are NumPy over its whole array,
+with no per-character or per-point Python loop. What still loops in Python
+runs once per activity: reading the ``[lat, lng]`` lists in ``split_latlng``
+and decoding and hashing each route (one route at a time, so memory stays
+bounded by ``MAX_ROUTE_POINTS``). The start cells of a batch are hashed in
+one call.
+"""
+from typing import List, Optional, Tuple
+import math
+
+from google.cloud import bigquery
+import numpy as np
+import pandas as pd
+
+ROUTE_CELLS_TABLE = 'strava-etl.strava_data.route_cells'
+
+GEOHASH_ALPHABET = np.frombuffer(b'0123456789bcdefghjkmnpqrstuvwxyz', dtype=np.uint8)
+START_CELL_PRECISION = 6
+ROUTE_CELL_PRECISION = 7
+START_GEOHASH_PRECISION = 7
+
+METERS_PER_DEGREE = 111_320.0
+# Longest segment densify fills in, and the most points it produces for one route
+MAX_SEGMENT_METERS = 5_000
+MAX_ROUTE_POINTS = 100_000
+EARTH_RADIUS_METERS = 6_371_008.8
+
+
+def decode_polyline(encoded: Optional[str]) -> np.ndarray:
+    """(n, 2) float32 lat/lng of a Google encoded polyline (5 decimal places, as Strava sends)."""
+    if not isinstance(encoded, str) or not encoded:
+        return np.empty((0, 2), dtype=np.float32)
+    chunks = np.frombuffer(encoded.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    # Each value is a run of 5-bit chunks, least significant first; the last one lacks the 0x20 flag
+    ends = np.flatnonzero(chunks < 0x20)
+    if len(ends) < 2:
+        return np.empty((0, 2), dtype=np.float32)
+    chunks = chunks[:ends[-1] + 1]
+    lengths = np.diff(ends, prepend=-1)
+    value_index = np.repeat(np.arange(len(ends)), lengths)
+    shift = 5 * (np.arange(len(chunks)) - np.repeat(ends - lengths + 1, lengths))
+    # bincount sums in float64, exact for values this small
+    values = np.bincount(value_index, weights=(chunks & 0x1f) << shift, minlength=len(ends)).astype(np.int64)
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1)
+    deltas = deltas[:len(deltas) // 2 * 2].reshape(-1, 2)
+    return (np.cumsum(deltas, axis=0) / 1e5).astype(np.float32)
+
+
+def pack_coordinates(coordinates: np.ndarray) -> Optional[bytes]:
+    """``route_coordinates`` value of decoded coordinates (None for no route)."""
+    return coordinates.astype('<f4').tobytes() if len(coordinates) else None
+
+
+def unpack_coordinates(packed: Optional[bytes]) -> np.ndarray:
+    """(n, 2) float32 lat/lng from a ``route_coordinates`` value, without copying."""
+    if not packed:
+        return np.empty((0, 2), dtype=np.float32)
+    return np.frombuffer(packed, dtype='<f4').reshape(-1, 2)
+
+
+def split_latlng(values: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """Latitude and longitude arrays of a column of Strava ``[lat, lng]`` lists (NaN where missing)."""
+    pairs = np.array([value if isinstance(value, (list, tuple)) and len(value) == 2 else (np.nan, np.nan)
+                      for value in values], dtype=np.float64).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def geohash(lat, lng, precision: int) -> np.ndarray:
+    """Geohashes of ``precision`` characters for arrays of coordinates (None where a coordinate is missing)."""
+    lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+    lng = np.atleast_1d(np.asarray(lng, dtype=np.float64))
+    valid = ~(np.isnan(lat) | np.isnan(lng))
+    bits = 5 * precision
+    lng_bits, lat_bits = (bits + 1) // 2, bits // 2
+    lat_cells = np.clip(np.floor((np.where(valid, lat, 0) + 90) / 180 * (1 << lat_bits)), 0, (1 << lat_bits) - 1)
+    lng_cells = np.clip(np.floor((np.where(valid, lng, 0) + 180) / 360 * (1 << lng_bits)), 0, (1 << lng_bits) - 1)
+    lat_cells, lng_cells = lat_cells.astype(np.int64), lng_cells.astype(np.int64)
+
+    # Interleave the bits, longitude first
+    code = np.zeros(lat.shape, dtype=np.int64)
+    for bit in range(bits):
+        source, width = (lng_cells, lng_bits) if bit % 2 == 0 else (lat_cells, lat_bits)
+        code = (code << 1) | ((source >> (width - 1 - bit // 2)) & 1)
+
+    shifts = 5 * np.arange(precision - 1, -1, -1)
+    characters = GEOHASH_ALPHABET[(code[:, None] >> shifts) & 31]
+    hashes = np.ascontiguousarray(characters).view(f'S{precision}').ravel().astype(str).astype(object)
+    hashes[~valid] = None
+    return hashes
+
+
+def cell_size_degrees(precision: int) -> Tuple[float, float]:
+    """(height, width) in degrees of a geohash cell of ``precision`` characters."""
+    bits = 5 * precision
+    return 180 / (1 << (bits // 2)), 360 / (1 << ((bits + 1) // 2))
+
+
+def densify(coordinates: np.ndarray, step_degrees: float,
+            max_segment_degrees: float = MAX_SEGMENT_METERS / METERS_PER_DEGREE,
+            max_points: int = MAX_ROUTE_POINTS) -> np.ndarray:
+    """``coordinates`` with points added along each segment so none is longer than ``step_degrees``.
+
+    Polyline points can be far apart on straight stretches; without this a
+    route would skip the cells between them. Segments longer than
+    ``max_segment_degrees`` are left as they are, and if the route would
+    still exceed ``max_points`` the coordinates are returned unchanged.
+    """
+    if len(coordinates) < 2:
+        return coordinates
+    start, end = coordinates[:-1].astype(np.float64), coordinates[1:].astype(np.float64)
+    lengths = np.abs(end - start).max(axis=1)
+    steps = np.where(lengths > max_segment_degrees, 1, np.maximum(1, np.ceil(lengths / step_degrees))).astype(np.int64)
+    if steps.sum() + 1 > max_points:
+        return coordinates
+    segment = np.repeat(np.arange(len(steps)), steps)
+    fraction = (np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)) / np.repeat(steps, steps)
+    points = start[segment] + (end[segment] - start[segment]) * fraction[:, None]
+    return np.vstack([points, coordinates[-1:]])
+
+
+def add_geometry(df: pd.DataFrame, polylines: pd.Series) -> pd.DataFrame:
+    """Replace ``start_latlng``/``end_latlng`` lists with numeric columns and add the route columns."""
+    for prefix in ('start', 'end'):
+        lat, lng = split_latlng(df[f'{prefix}_latlng'])
+        df[f'{prefix}_lat'], df[f'{prefix}_lng'] = lat, lng
+        # The string form stays for existing readers; built from the numbers, not row by row
+        text = pd.Series(lat, index=df.index).astype(str) + ',' + pd.Series(lng, index=df.index).astype(str)
+        df[f'{prefix}_latlng'] = text.where(~np.isnan(lat), None)
+
+    routes = [decode_polyline(polyline) for polyline in polylines]
+    df['route_coordinates'] = [pack_coordinates(route) for route in routes]
+    df['route_points'] = [len(route) for route in routes]
+    df['start_geohash'] = geohash(df['start_lat'].to_numpy(), df['start_lng'].to_numpy(), START_GEOHASH_PRECISION)
+    return df
+
+
+# Activity columns repeated on every route_cells row, so lookups don't join the activities table
+CELL_ACTIVITY_COLUMNS = ['name', 'distance', 'start_lat', 'start_lng']
+
+
+def route_cells(df: pd.DataFrame) -> pd.DataFrame:
+    """``route_cells`` rows of transformed activities: the start cell and every cell the route passes."""
+    height, width = cell_size_degrees(ROUTE_CELL_PRECISION)
+    df = df.reset_index(drop=True)
+    start_lat, start_lng = df['start_lat'].to_numpy(np.float64), df['start_lng'].to_numpy(np.float64)
+    has_start = np.flatnonzero(~np.isnan(start_lat))
+
+    # Routes one at a time; each is densified and hashed as a whole
+    route_rows, route_cell_arrays = [], []
+    for row, packed in enumerate(df['route_coordinates']):
+        route = unpack_coordinates(packed)
+        if len(route):
+            points = densify(route, min(height, width) / 2)
+            cells = np.unique(geohash(points[:, 0], points[:, 1], ROUTE_CELL_PRECISION).astype(str))
+            route_rows.append(np.full(len(cells), row))
+            route_cell_arrays.append(cells)
+
+    rows = np.concatenate([has_start] + route_rows).astype(np.int64)
+    cells = np.concatenate([geohash(start_lat[has_start], start_lng[has_start], START_CELL_PRECISION).astype(str)]
+                           + route_cell_arrays).astype(object)
+    kinds = np.repeat(['start', 'route'], [len(has_start), len(rows) - len(has_start)]).astype(object)
+    # Each activity's start cell first, then its route cells in order
+    order = np.argsort(rows, kind='stable')
+    rows = rows[order]
+    activities = df.iloc[rows]
+    return pd.DataFrame({
+        'athlete_id': activities['athlete_id'].array, 'activity_id': activities['id'].array,
+        'start_date': activities['start_date'].array, 'kind': kinds[order], 'cell': cells[order],
+        **{column: activities[column].array for column in CELL_ACTIVITY_COLUMNS},
+    })
+
+
+def delete_cells_query(athlete_ids, activity_ids, bounds) -> Tuple[str, list]:
+    """DELETE of the activities' ``route_cells`` rows stored within ``bounds`` ([from, to) start dates).
+
+    Run before an activity's cells are merged again, so cells its edited route
+    no longer passes don't stay behind.
+    """
+    parameters = [
+        bigquery.ArrayQueryParameter('athletes', 'INT64', sorted({int(a) for a in athlete_ids})),
+        bigquery.ArrayQueryParameter('ids', 'INT64', sorted({int(a) for a in activity_ids})),
+        bigquery.ScalarQueryParameter('merge_from', 'TIMESTAMP', bounds[0]),
+        bigquery.ScalarQueryParameter('merge_to', 'TIMESTAMP', bounds[1]),
+    ]
+    sql = f"""
+    DELETE FROM `{ROUTE_CELLS_TABLE}`
+    WHERE start_date >= @merge_from AND start_date < @merge_to
+      AND athlete_id IN UNNEST(@athletes) AND activity_id IN UNNEST(@ids)
+    """
+    return sql, parameters
+
+
+def covering_cells(lat: float, lng: float, radius_m: float, precision: int) -> List[str]:
+    """Cells of ``precision`` that together cover the circle of ``radius_m`` around (lat, lng)."""
+    height, width = cell_size_degrees(precision)
+    dlat = radius_m / METERS_PER_DEGREE
+    dlng = dlat / max(math.cos(math.radians(lat)), 1e-6)
+    # Sample the circle's bounding box more finely than a cell, edges included
+    lats = np.append(np.arange(lat - dlat, lat + dlat, height / 2), lat + dlat)
+    lngs = np.append(np.arange(lng - dlng, lng + dlng, width / 2), lng + dlng)
+    grid_lat, grid_lng = np.meshgrid(lats, lngs)
+    return sorted(set(geohash(grid_lat.ravel(), grid_lng.ravel(), precision)))
+
+
+def distance_meters(lat, lng, to_lat: float, to_lng: float) -> np.ndarray:
+    """Great-circle distances from arrays of points to one point."""
+    lat1, lng1 = np.radians(np.asarray(lat, dtype=np.float64)), np.radians(np.asarray(lng, dtype=np.float64))
+    lat2, lng2 = math.radians(to_lat), math.radians(to_lng)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * math.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(a))
+
+
+def _athlete_filter(athlete_id, parameters: list) -> str:
+    if athlete_id is None:
+        return ''
+    parameters.append(bigquery.ScalarQueryParameter('athlete_id', 'INT64', int(athlete_id)))
+    return 'AND c.athlete_id = @athlete_id'
+
+
+def starts_near_query(lat: float, lng: float, radius_m: float = 500,
+                      athlete_id=None) -> Tuple[str, List[bigquery.ScalarQueryParameter]]:
+    """Activities starting within ``radius_m`` of (lat, lng), nearest first.
+
+    The start cells covering the circle select the candidates from
+    ``route_cells``; the exact distance filters them. Only ``route_cells`` is read.
+    """
+    parameters = [
+        bigquery.ArrayQueryParameter('cells', 'STRING', covering_cells(lat, lng, radius_m, START_CELL_PRECISION)),
+        bigquery.ScalarQueryParameter('lat', 'FLOAT64', lat),
+        bigquery.ScalarQueryParameter('lng', 'FLOAT64', lng),
+        bigquery.ScalarQueryParameter('radius', 'FLOAT64', radius_m),
+    ]
+    athlete_filter = _athlete_filter(athlete_id, parameters)
+    sql = f"""
+    SELECT c.athlete_id, c.activity_id AS id, c.name, c.start_date, c.distance, c.start_lat, c.start_lng,
+           ST_DISTANCE(ST_GEOGPOINT(c.start_lng, c.start_lat), ST_GEOGPOINT(@lng, @lat)) AS meters_away
+    FROM `{ROUTE_CELLS_TABLE}` c
+    WHERE c.kind = 'start' AND c.cell IN UNNEST(@cells) {athlete_filter}
+      AND ST_DISTANCE(ST_GEOGPOINT(c.start_lng, c.start_lat), ST_GEOGPOINT(@lng, @lat)) <= @radius
+    ORDER BY meters_away
+    """
+    return sql, parameters
+
+
+def passing_query(lat: float, lng: float, athlete_id=None) -> Tuple[str, List[bigquery.ScalarQueryParameter]]:
+    """Activities whose route passes through the ~150 m cell containing (lat, lng), newest first (``route_cells`` only)."""
+    cell = geohash(lat, lng, ROUTE_CELL_PRECISION)[0]
+    parameters = [bigquery.ScalarQueryParameter('cell', 'STRING', cell)]
+    athlete_filter = _athlete_filter(athlete_id, parameters)
+    sql = f"""
+    SELECT c.athlete_id, c.activity_id AS id, c.name, c.start_date, c.distance
+    FROM `{ROUTE_CELLS_TABLE}` c
+    WHERE c.kind = 'route' AND c.cell = @cell {athlete_filter}
+    ORDER BY c.start_date DESC
+    """
+    return sql, parameters
+
+
+def run_query(client: bigquery.Client, query: Tuple[str, list]) -> pd.DataFrame:
+    """Run one of the queries above."""
+    sql, parameters = query
+    return client.query(sql, job_config=bigquery.QueryJobConfig(query_parameters=parameters)).to_dataframe()
@@ -0,0 +1,236 @@
+"""Per-athlete rollup tables for dashboard KPIs.
+
+The ETL flow calls ``update_rollups`` after each activities load. Only the
+buckets touched by the batch are recomputed:
+
+* daily buckets from the activities of the affected days,
+* weekly buckets from the (small) daily table,
+* the all-time row from the daily table.
+
+Each affected bucket is deleted and re-inserted from its source inside one
+transaction, so re-processed activities are not double counted and a bucket
+whose last activity moved to another day disappears instead of going stale.
+The ETL flow passes the days an activity was stored under before the load
+(``stored_dates``) along with its new ones. Averages are stored as sum/count
+pairs so they can be combined across buckets exactly.
+
+The daily and weekly tables are partitioned by month of their bucket date and
+clustered by athlete, so an update rewrites only the partitions it touches.
+Concurrent transactions on the same table conflict in BigQuery; the flow runs
+the rollup step under the ``ROLLUP_CONCURRENCY_TAG`` concurrency limit (1)
+and retries it on conflict.
+"""
+from datetime import timedelta
+from typing import Iterable, List, Tuple
+import logging
+
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+
+logger = logging.getLogger(__name__)
+
+ACTIVITIES_TABLE = 'strava-etl.strava_data.activities'
+DAILY_TABLE = 'strava-etl.strava_data.athlete_rollups_daily'
+WEEKLY_TABLE = 'strava-etl.strava_data.athlete_rollups_weekly'
+ALL_TIME_TABLE = 'strava-etl.strava_data.athlete_rollups_all_time'
+
+# Measures shared by every rollup level: (name, type, expression over activities, expression over daily rows)
+MEASURES = [
+    ('activities', 'INTEGER', 'COUNT(*)', 'SUM(activities)'),
+    ('total_distance', 'FLOAT', 'SUM(IFNULL(distance, 0))', 'SUM(total_distance)'),
+    ('total_calories', 'FLOAT', 'SUM(IFNULL(calories, 0))', 'SUM(total_calories)'),
+    ('total_moving_time', 'INTEGER', 'SUM(IFNULL(moving_time, 0))', 'SUM(total_moving_time)'),
+    ('speed_sum', 'FLOAT', 'SUM(average_speed)', 'SUM(speed_sum)'),
+    ('speed_count', 'INTEGER', 'COUNT(average_speed)', 'SUM(speed_count)'),
+    ('max_average_speed', 'FLOAT', 'MAX(average_speed)', 'MAX(max_average_speed)'),
+    ('max_calories', 'FLOAT', 'MAX(calories)', 'MAX(max_calories)'),
+    ('heartrate_sum', 'FLOAT', 'SUM(average_heartrate)', 'SUM(heartrate_sum)'),
+    ('heartrate_count', 'INTEGER', 'COUNT(average_heartrate)', 'SUM(heartrate_count)'),
+]
+
+LEVELS = {
+    DAILY_TABLE: [('athlete_id', 'INTEGER'), ('day', 'DATE')],
+    WEEKLY_TABLE: [('athlete_id', 'INTEGER'), ('week', 'DATE')],
+    ALL_TIME_TABLE: [('athlete_id', 'INTEGER')],
+}
+ALL_TIME_EXTRA = [('first_day', 'DATE', 'MIN(day)'), ('last_day', 'DATE', 'MAX(day)')]
+# Bucket date column each table is partitioned by (monthly); the all-time table has none
+PARTITION_FIELDS = {DAILY_TABLE: 'day', WEEKLY_TABLE: 'week'}
+
+# Prefect tag of the rollup task; create a concurrency limit of 1 for it (see docs/setup/prefect_setup.md)
+ROLLUP_CONCURRENCY_TAG = 'rollups'
+
+_tables_checked = False
+
+
+def _rollup_table(table_id: str) -> bigquery.Table:
+    keys = LEVELS[table_id]
+    schema = [bigquery.SchemaField(name, field_type, mode='REQUIRED') for name, field_type in keys]
+    schema += [bigquery.SchemaField(name, field_type) for name, field_type, _, _ in MEASURES]
+    if table_id == ALL_TIME_TABLE:
+        schema += [bigquery.SchemaField(name, field_type) for name, field_type, _ in ALL_TIME_EXTRA]
+    schema.append(bigquery.SchemaField('updated_at', 'TIMESTAMP'))
+    table = bigquery.Table(table_id, schema=schema)
+    if table_id in PARTITION_FIELDS:
+        table.time_partitioning = bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.MONTH, field=PARTITION_FIELDS[table_id]
+        )
+    table.clustering_fields = ['athlete_id']
+    return table
+
+
+def ensure_rollup_tables(client: bigquery.Client) -> None:
+    """Create the rollup tables if they don't exist (checked once per process)."""
+    global _tables_checked
+    if _tables_checked:
+        return
+    for table_id in LEVELS:
+        try:
+            table = client.get_table(table_id)
+        except NotFound:
+            client.create_table(_rollup_table(table_id))
+            logger.info(f"Created rollup table {table_id}")
+            continue
+        if table_id in PARTITION_FIELDS and table.time_partitioning is None:
+            logger.warning(f"{table_id} is not partitioned; run rollups.rebuild_rollups(client) to recreate it")
+    _tables_checked = True
+
+
+def _replace_sql(target: str, source_sql: str, bucket_filter: str, columns: List[str]) -> str:
+    """Delete the target's affected buckets and insert them again from ``source_sql``."""
+    return f"""
+    DELETE FROM `{target}` WHERE {bucket_filter};
+    INSERT INTO `{target}` ({', '.join(columns)}, updated_at)
+    SELECT {', '.join(columns)}, CURRENT_TIMESTAMP() FROM ({source_sql});
+    """
+
+
+def _measures(source: str) -> str:
+    index = 2 if source == 'activities' else 3
+    return ',\n          '.join(f'{measure[index]} AS {measure[0]}' for measure in MEASURES)
+
+
+def _week(day):
+    return day - timedelta(days=day.weekday())
+
+
+def stored_dates(client: bigquery.Client, athlete_ids: Iterable[int], activity_ids: Iterable[int]) -> List[Tuple]:
+    """``(athlete_id, start_date, start_date_local)`` of the given activities as currently stored.
+
+    Read before a load, so the buckets an edited activity moves out of are
+    recomputed along with the ones it moves into.
+    """
+    athlete_ids = sorted({int(a) for a in athlete_ids})
+    activity_ids = sorted({int(a) for a in activity_ids})
+    if not athlete_ids or not activity_ids:
+        return []
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter('athletes', 'INT64', athlete_ids),
+        bigquery.ArrayQueryParameter('ids', 'INT64', activity_ids),
+    ])
+    rows = client.query(f"""
+        SELECT athlete_id, start_date, start_date_local
+        FROM `{ACTIVITIES_TABLE}`
+        WHERE athlete_id IN UNNEST(@athletes) AND id IN UNNEST(@ids)
+    """, job_config=job_config).result()
+    return [(row['athlete_id'], row['start_date'], row['start_date_local']) for row in rows]
+
+
+def update_rollups(client: bigquery.Client, athlete_ids: Iterable[int], days: Iterable, start_dates: Iterable) -> int:
+    """Recompute the daily, weekly and all-time buckets touched by a batch of activities.
+
+    ``days`` are the local calendar days of the batch, ``start_dates`` the UTC
+    start timestamps (used to bound the activities scan); both include the
+    stored dates of activities that moved. Returns bytes processed.
+    """
+    ensure_rollup_tables(client)
+    athlete_ids = sorted({int(a) for a in athlete_ids})
+    days = sorted(set(days))
+    start_dates = list(start_dates)
+    if not athlete_ids or not days:
+        return 0
+    weeks = sorted({_week(day) for day in days})
+
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter('athletes', 'INT64', athlete_ids),
+        bigquery.ArrayQueryParameter('days', 'DATE', days),
+        bigquery.ArrayQueryParameter('weeks', 'DATE', weeks),
+        bigquery.ScalarQueryParameter('min_day', 'DATE', days[0]),
+        bigquery.ScalarQueryParameter('max_day', 'DATE', days[-1]),
+        bigquery.ScalarQueryParameter('min_week', 'DATE', weeks[0]),
+        bigquery.ScalarQueryParameter('max_week', 'DATE', weeks[-1]),
+        bigquery.ScalarQueryParameter('min_start', 'TIMESTAMP', min(start_dates)),
+        bigquery.ScalarQueryParameter('max_start', 'TIMESTAMP', max(start_dates)),
+    ])
+    measure_names = [measure[0] for measure in MEASURES]
+
+    # Local days can be up to a day away from the UTC start_date; the range keeps the scan bounded
+    daily_source = f"""
+        SELECT athlete_id, DATE(start_date_local) AS day,
+          {_measures('activities')}
+        FROM `{ACTIVITIES_TABLE}`
+        WHERE athlete_id IN UNNEST(@athletes)
+          AND start_date BETWEEN TIMESTAMP_SUB(@min_start, INTERVAL 1 DAY) AND TIMESTAMP_ADD(@max_start, INTERVAL 1 DAY)
+          AND DATE(start_date_local) IN UNNEST(@days)
+        GROUP BY athlete_id, day
+    """
+    weekly_source = f"""
+        SELECT athlete_id, DATE_TRUNC(day, WEEK(MONDAY)) AS week,
+          {_measures('daily')}
+        FROM `{DAILY_TABLE}`
+        WHERE athlete_id IN UNNEST(@athletes)
+          AND day BETWEEN @min_week AND DATE_ADD(@max_week, INTERVAL 6 DAY)
+          AND DATE_TRUNC(day, WEEK(MONDAY)) IN UNNEST(@weeks)
+        GROUP BY athlete_id, week
+    """
+    all_time_source = f"""
+        SELECT athlete_id,
+          {_measures('daily')},
+          {', '.join(f'{expr} AS {name}' for name, _, expr in ALL_TIME_EXTRA)}
+        FROM `{DAILY_TABLE}`
+        WHERE athlete_id IN UNNEST(@athletes)
+        GROUP BY athlete_id
+    """
+
+    # The weekly and all-time statements read the daily rows this transaction just wrote
+    script = 'BEGIN TRANSACTION;' + ''.join([
+        _replace_sql(DAILY_TABLE, daily_source,
+                     "athlete_id IN UNNEST(@athletes) AND day BETWEEN @min_day AND @max_day AND day IN UNNEST(@days)",
+                     ['athlete_id', 'day'] + measure_names),
+        _replace_sql(WEEKLY_TABLE, weekly_source,
+                     "athlete_id IN UNNEST(@athletes) AND week BETWEEN @min_week AND @max_week AND week IN UNNEST(@weeks)",
+                     ['athlete_id', 'week'] + measure_names),
+        _replace_sql(ALL_TIME_TABLE, all_time_source, "athlete_id IN UNNEST(@athletes)",
+                     ['athlete_id'] + measure_names + [name for name, _, _ in ALL_TIME_EXTRA]),
+    ]) + 'COMMIT TRANSACTION;'
+    job = client.query(script, job_config=job_config)
+    job.result()
+    bytes_processed = job.total_bytes_processed or 0
+
+    logger.info(f"Updated rollups for athletes {athlete_ids} on {len(days)} day(s) ({bytes_processed} bytes processed)")
+    return bytes_processed
+
+
+def rebuild_rollups(client: bigquery.Client) -> None:
+    """Recreate every rollup table and fill it from the full activities history.
+
+    Use it for the one-off backfill, to move tables created before partitioning
+    to the current layout, and after deleting activities by hand. The
+    dashboard's KPIs are empty until it finishes; pause the ETL deployment
+    while it runs.
+    """
+    global _tables_checked
+    for table_id in LEVELS:
+        client.delete_table(table_id, not_found_ok=True)
+    _tables_checked = False
+    ensure_rollup_tables(client)
+    rows = client.query(f"""
+        SELECT ARRAY_AGG(DISTINCT athlete_id) AS athletes,
+               ARRAY_AGG(DISTINCT DATE(start_date_local)) AS days,
+               MIN(start_date) AS min_start, MAX(start_date) AS max_start
+        FROM `{ACTIVITIES_TABLE}`
+        WHERE athlete_id IS NOT NULL
+    """).result()
+    row = list(rows)[0]
+    if row['athletes']:
+        update_rollups(client, row['athletes'], row['days'], [row['min_start'], row['max_start']])
@@ -0,0 +1,129 @@
+"""Table schemas for the ETL flow, defined once in ``schemas/<table>.json``.
+
+Each file holds a table's BigQuery fields (the ``bq`` schema format) along
+with its merge keys, partitioning field and clustering fields. A schema is
+compiled to:
+
+* the BigQuery schema used to create and load the table,
+* an Arrow schema: each transformed batch is converted and cast to it in one
+  pass (``conform``), which is also where the batch is validated,
+* the column list of the load MERGE.
+
+Adding a column means adding it to the JSON file; the flow adds it to the
+live table on its next load.
+"""
+from functools import lru_cache
+from typing import Dict, List, NamedTuple
+import json
+import os
+
+from google.cloud import bigquery
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+SCHEMAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas')
+
+ARROW_TYPES = {
+    'INTEGER': pa.int64(),
+    'FLOAT': pa.float64(),
+    'NUMERIC': pa.decimal128(38, 9),
+    'BOOLEAN': pa.bool_(),
+    'STRING': pa.string(),
+    'BYTES': pa.binary(),
+    'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+    'DATE': pa.date32(),
+}
+# Standard SQL names the API can return for the legacy ones above
+TYPE_ALIASES = {'INT64': 'INTEGER', 'FLOAT64': 'FLOAT', 'BOOL': 'BOOLEAN'}
+
+
+class SchemaValidationError(ValueError):
+    """A batch doesn't fit its table's schema; the message lists every problem found."""
+
+
+class TableSchema(NamedTuple):
+    name: str
+    table_id: str
+    merge_keys: List[str]
+    partition_field: str
+    clustering_fields: List[str]
+    fields: List[bigquery.SchemaField]
+    arrow: pa.Schema
+
+    @property
+    def columns(self) -> List[str]:
+        return [field.name for field in self.fields]
+
+
+def normalize_type(field_type: str) -> str:
+    return TYPE_ALIASES.get(field_type.upper(), field_type.upper())
+
+
+@lru_cache(maxsize=None)
+def get(name: str) -> TableSchema:
+    """Compiled schema of table ``name`` (``activities``, ``laps``), loaded once per process."""
+    with open(os.path.join(SCHEMAS_DIR, f'{name}.json')) as f:
+        spec = json.load(f)
+    fields = [bigquery.SchemaField.from_api_repr(field) for field in spec['fields']]
+    arrow = pa.schema([
+        pa.field(field.name, ARROW_TYPES[normalize_type(field.field_type)], nullable=field.mode != 'REQUIRED')
+        for field in fields
+    ])
+    return TableSchema(name, spec['table'], spec['merge_keys'], spec['partition_field'],
+                       spec['clustering_fields'], fields, arrow)
+
+
+def names() -> List[str]:
+    return sorted(entry[:-len('.json')] for entry in os.listdir(SCHEMAS_DIR) if entry.endswith('.json'))
+
+
+def for_table(table_id: str) -> TableSchema:
+    """Compiled schema of the table with the full ID ``table_id``."""
+    for name in names():
+        if get(name).table_id == table_id:
+            return get(name)
+    raise ValueError(f"No schema registered for table {table_id}")
+
+
+def conform(schema: TableSchema, df: pd.DataFrame) -> pa.Table:
+    """Cast a transformed batch to ``schema`` in one pass, validating it on the way.
+
+    Columns the batch doesn't have are all-null. Raises SchemaValidationError
+    listing every column that is unknown, can't be cast, or is null where the
+    schema (or a merge key) requires a value.
+    """
+    problems = []
+    unknown = [column for column in df.columns if column not in schema.arrow.names]
+    if unknown:
+        problems.append(f"columns not in the {schema.name} schema: {unknown}")
+
+    arrays = []
+    for field in schema.arrow:
+        if field.name not in df.columns:
+            arrays.append(pa.nulls(len(df), field.type))
+            continue
+        try:
+            arrays.append(pc.cast(pa.array(df[field.name], from_pandas=True), field.type))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError) as e:
+            problems.append(f"{field.name}: {str(e)}")
+            arrays.append(pa.nulls(len(df), field.type))
+
+    for index, field in enumerate(schema.arrow):
+        if (not field.nullable or field.name in schema.merge_keys) and arrays[index].null_count:
+            problems.append(f"{field.name}: {arrays[index].null_count} null value(s) in a required column")
+
+    if problems:
+        raise SchemaValidationError(f"Batch of {len(df)} rows doesn't fit {schema.table_id}: " + '; '.join(problems))
+    return pa.Table.from_arrays(arrays, schema=schema.arrow)
+
+
+def missing_and_mismatched(schema: TableSchema, table: bigquery.Table) -> Dict[str, list]:
+    """Registry fields the live ``table`` lacks, and those it has with a different type."""
+    live = {field.name: normalize_type(field.field_type) for field in table.schema}
+    return {
+        'missing': [field for field in schema.fields if field.name not in live],
+        'mismatched': [f"{field.name} is {live[field.name]}, registry says {normalize_type(field.field_type)}"
+                       for field in schema.fields
+                       if field.name in live and live[field.name] != normalize_type(field.field_type)],
+    }
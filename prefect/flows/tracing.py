@@ -0,0 +1 @@
+../../cloud_functions/common/tracing.py
\ No newline at end of file
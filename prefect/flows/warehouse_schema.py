@@ -0,0 +1,286 @@
+"""Partitioning and clustering of the activities and laps tables.
+
+Both tables are partitioned by month of ``start_date`` and clustered by their
+merge keys, as declared in their ``schema_registry`` files, so a query filtered on ``start_date`` (the dashboard,
+``label-latest-run``'s watermark) reads only the months it asks for, and the
+ETL flow's MERGE reads only the months of the batch it loads.
+
+Monthly rather than daily partitions: one athlete's history is small, and a
+long Strava history would run into BigQuery's limit on partitions per table
+with daily ones.
+
+Partitioning can't be added to an existing table, and neither can a column's
+type be changed, so tables created before this layout (or by the old ETL,
+which wrote booleans and mixed-type columns as STRING) are migrated once by
+copying them into a partitioned table, casting columns to the registry types:
+
+    python prefect/flows/warehouse_schema.py report
+    python prefect/flows/warehouse_schema.py migrate
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+import argparse
+import logging
+
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+import pandas as pd
+
+import schema_registry
+
+logger = logging.getLogger(__name__)
+
+PARTITIONED_TABLES = ['activities', 'laps']
+PARTITION_TYPE = bigquery.TimePartitioningType.MONTH
+# How long after its activity's start a lap or route cell can be dated
+MOVED_ROW_SPAN = timedelta(days=1)
+
+# Registry types under the names CAST accepts
+CAST_TYPES = {'BOOLEAN': 'BOOL', 'FLOAT': 'FLOAT64', 'INTEGER': 'INT64'}
+# The table a migration replaces is kept under this suffix
+BACKUP_SUFFIX = '_premigration'
+
+_tables_checked = set()
+
+
+def has_layout(table: bigquery.Table, schema: schema_registry.TableSchema) -> bool:
+    """Whether ``table`` is partitioned and clustered as its schema declares."""
+    partitioning = table.time_partitioning
+    return (partitioning is not None and partitioning.field == schema.partition_field
+            and partitioning.type_ == PARTITION_TYPE
+            and list(table.clustering_fields or []) == schema.clustering_fields)
+
+
+def ensure_table(client: bigquery.Client, schema: schema_registry.TableSchema) -> None:
+    """Create the table with its schema and layout, or add the columns it lacks (once per process).
+
+    An existing table without the layout is left as it is, with a warning to
+    migrate it. A column whose live type differs from the registry is an error
+    until ``migrate`` has cast it.
+    """
+    if schema.table_id in _tables_checked:
+        return
+    try:
+        table = client.get_table(schema.table_id)
+    except NotFound:
+        table = bigquery.Table(schema.table_id, schema=schema.fields)
+        table.time_partitioning = bigquery.TimePartitioning(type_=PARTITION_TYPE, field=schema.partition_field)
+        table.clustering_fields = schema.clustering_fields
+        # Concurrent flow runs can both find the table missing
+        client.create_table(table, exists_ok=True)
+        logger.info(f"Created {schema.table_id} partitioned by month of {schema.partition_field}, "
+                    f"clustered by {schema.clustering_fields}")
+        _tables_checked.add(schema.table_id)
+        return
+
+    if not has_layout(table, schema):
+        logger.warning(f"{schema.table_id} is not partitioned by {schema.partition_field}; MERGEs scan the whole "
+                       f"table until it is migrated (python prefect/flows/warehouse_schema.py migrate)")
+    differences = schema_registry.missing_and_mismatched(schema, table)
+    if differences['mismatched']:
+        raise schema_registry.SchemaValidationError(
+            f"{schema.table_id} doesn't match the registry: {'; '.join(differences['mismatched'])}. "
+            f"Cast the columns with python prefect/flows/warehouse_schema.py migrate"
+        )
+    if differences['missing']:
+        table.schema = list(table.schema) + differences['missing']
+        client.update_table(table, ['schema'])
+        logger.info(f"Added columns {[field.name for field in differences['missing']]} to {schema.table_id}")
+    _tables_checked.add(schema.table_id)
+
+
+def _month_start(value: pd.Timestamp) -> datetime:
+    return datetime(value.year, value.month, 1, tzinfo=timezone.utc)
+
+
+def merge_range(start_dates: Iterable, stored_start_dates: Iterable = ()) -> Optional[Tuple[datetime, datetime]]:
+    """[from, to) bounds of the months a batch's ``start_date`` values fall in, or None if there are none.
+
+    Whole months match the partitions, so widening the range to them costs
+    nothing, and an activity whose start time is edited within the month
+    still matches its existing row. ``stored_start_dates`` are the start dates
+    the batch's activities are stored under now; covering them too lets the
+    MERGE update an activity edited into another month instead of inserting
+    it again. Laps and route cells start within ``MOVED_ROW_SPAN`` of their
+    activity, so that much after each stored date is covered as well.
+    """
+    stored = pd.to_datetime(pd.Series(list(stored_start_dates), dtype=object), utc=True)
+    start_dates = pd.concat([
+        pd.to_datetime(pd.Series(list(start_dates), dtype=object), utc=True), stored, stored + MOVED_ROW_SPAN,
+    ]).dropna()
+    if start_dates.empty:
+        return None
+    last = _month_start(start_dates.max())
+    after_last = datetime(last.year + last.month // 12, last.month % 12 + 1, 1, tzinfo=timezone.utc)
+    return _month_start(start_dates.min()), after_last
+
+
+def range_predicate(schema: schema_registry.TableSchema, alias: str = 'T') -> str:
+    """Condition on the ``@merge_from``/``@merge_to`` parameters that prunes the target's partitions."""
+    field = f"{alias}.{schema.partition_field}"
+    return f"{field} >= @merge_from AND {field} < @merge_to"
+
+
+def range_parameters(bounds: Tuple[datetime, datetime]) -> List[bigquery.ScalarQueryParameter]:
+    return [
+        bigquery.ScalarQueryParameter('merge_from', 'TIMESTAMP', bounds[0]),
+        bigquery.ScalarQueryParameter('merge_to', 'TIMESTAMP', bounds[1]),
+    ]
+
+
+def merge_sql(schema: schema_registry.TableSchema, source_table_id: str, pruned: bool = True) -> str:
+    """MERGE of ``source_table_id`` into the table on its merge keys, over the registry's columns.
+
+    With ``pruned`` the target side is restricted to the batch's months, which
+    needs the ``range_parameters`` of the batch.
+    """
+    keys, columns = schema.merge_keys, schema.columns
+    match_condition = ' AND '.join(f'T.{key} = S.{key}' for key in keys)
+    if pruned:
+        match_condition += f' AND {range_predicate(schema)}'
+    return f"""
+    MERGE `{schema.table_id}` T
+    USING `{source_table_id}` S
+    ON {match_condition}
+    WHEN MATCHED THEN
+        UPDATE SET {', '.join(f'T.{col} = S.{col}' for col in columns if col not in keys)}
+    WHEN NOT MATCHED THEN
+        INSERT ({', '.join(columns)})
+        VALUES ({', '.join(f'S.{col}' for col in columns)})
+    """
+
+
+def retyped_columns(schema: schema_registry.TableSchema, table: bigquery.Table) -> Dict[str, str]:
+    """Live columns whose type differs from the registry -> the registry type."""
+    registered = {field.name: schema_registry.normalize_type(field.field_type) for field in schema.fields}
+    return {
+        field.name: registered[field.name] for field in table.schema
+        if field.name in registered and schema_registry.normalize_type(field.field_type) != registered[field.name]
+    }
+
+
+def _select_list(table: bigquery.Table, retyped: Dict[str, str]) -> str:
+    """Every column of ``table``, SAFE_CAST to the registry type where ``retyped`` says so."""
+    return ', '.join(
+        f"SAFE_CAST({field.name} AS {CAST_TYPES.get(retyped[field.name], retyped[field.name])}) AS {field.name}"
+        if field.name in retyped else field.name
+        for field in table.schema
+    )
+
+
+def _uncastable_counts(client: bigquery.Client, table_id: str, retyped: Dict[str, str]) -> Dict[str, int]:
+    """Per retyped column, how many non-null values SAFE_CAST would turn into NULL."""
+    counts = ', '.join(
+        f"COUNTIF({name} IS NOT NULL AND SAFE_CAST({name} AS {CAST_TYPES.get(field_type, field_type)}) IS NULL) "
+        f"AS {name}"
+        for name, field_type in retyped.items()
+    )
+    return dict(list(client.query(f"SELECT {counts} FROM `{table_id}`").result())[0].items())
+
+
+def _dry_run_bytes(client: bigquery.Client, sql: str, parameters=()) -> int:
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False, query_parameters=list(parameters))
+    return client.query(sql, job_config=job_config).total_bytes_processed or 0
+
+
+def report(client: bigquery.Client) -> dict:
+    """Dry-run bytes of the scans that matter for each table (free; nothing is read).
+
+    ``merge target scan`` is what a MERGE reads from the target: all of it
+    without the range predicate, the latest month's partition with it.
+    """
+    results = {}
+    for name in PARTITIONED_TABLES:
+        schema = schema_registry.get(name)
+        table_id = schema.table_id
+        try:
+            table = client.get_table(table_id)
+        except NotFound:
+            continue
+        latest = list(client.query(
+            f"SELECT MAX({schema.partition_field}) AS latest FROM `{table_id}`"
+        ).result())[0]['latest']
+        rows = {'partitioned': has_layout(table, schema), 'rows': table.num_rows,
+                'columns to cast': ', '.join(f"{name} -> {field_type}" for name, field_type
+                                             in retyped_columns(schema, table).items()) or '-'}
+        rows['merge target scan, whole table'] = _dry_run_bytes(client, f"SELECT * FROM `{table_id}` T")
+        if latest is not None:
+            rows['merge target scan, latest month'] = _dry_run_bytes(
+                client, f"SELECT * FROM `{table_id}` T WHERE {range_predicate(schema)}",
+                range_parameters(merge_range([latest])),
+            )
+        if name == 'activities':
+            rows['last 30 days of activities'] = _dry_run_bytes(
+                client, f"SELECT * FROM `{table_id}` "
+                        f"WHERE {schema.partition_field} >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 30 DAY)")
+        results[table_id] = rows
+    return results
+
+
+def migrate_table(client: bigquery.Client, schema: schema_registry.TableSchema) -> bool:
+    """Copy the table into one with its layout and the registry's column types, and swap it in.
+
+    Columns typed differently from the registry are SAFE_CAST; values that
+    don't cast (logged per column) become NULL. The old table is kept as
+    ``<table>_premigration`` until it is dropped by hand. Pause the ETL
+    deployment while this runs: the table is missing for a moment between the
+    two renames. Returns False if there was nothing to do.
+    """
+    table_id = schema.table_id
+    table = client.get_table(table_id)
+    retyped = retyped_columns(schema, table)
+    if has_layout(table, schema) and not retyped:
+        logger.info(f"{table_id} already has its layout and types")
+        return False
+
+    if retyped:
+        for name, lost in _uncastable_counts(client, table_id, retyped).items():
+            logger.info(f"Casting {table_id}.{name} to {retyped[name]}")
+            if lost:
+                logger.warning(f"{table_id}.{name}: {lost} value(s) don't cast to {retyped[name]} and become NULL")
+
+    name = table_id.rsplit('.', 1)[-1]
+    staging_id = f"{table_id}_partitioned"
+    client.query(f"""
+        CREATE TABLE `{staging_id}`
+        PARTITION BY TIMESTAMP_TRUNC({schema.partition_field}, MONTH)
+        CLUSTER BY {', '.join(schema.clustering_fields)}
+        AS SELECT {_select_list(table, retyped)} FROM `{table_id}`
+    """).result()
+
+    copied = client.get_table(staging_id).num_rows
+    if copied != table.num_rows:
+        raise RuntimeError(f"{staging_id} has {copied} rows, {table_id} has {table.num_rows}; not swapping")
+
+    client.query(f"ALTER TABLE `{table_id}` RENAME TO {name}{BACKUP_SUFFIX}").result()
+    client.query(f"ALTER TABLE `{staging_id}` RENAME TO {name}").result()
+    _tables_checked.discard(table_id)
+    logger.info(f"Migrated {table_id} ({copied} rows, cast {sorted(retyped)}); "
+                f"the old table is {table_id}{BACKUP_SUFFIX}")
+    return True
+
+
+def _print_report(results: dict) -> None:
+    for table_id, rows in results.items():
+        print(table_id)
+        for key, value in rows.items():
+            if isinstance(value, int) and not isinstance(value, bool):
+                value = f"{value:,}"
+            print(f"    {key:<34} {value!s:>16}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Partition, cluster and retype the activities and laps tables")
+    parser.add_argument('command', choices=['report', 'migrate'],
+                        help='report: dry-run bytes and columns to cast per table; migrate: report, migrate, report again')
+    args = parser.parse_args()
+
+    client = bigquery.Client(project='strava-etl')
+    print("Bytes processed" + (" before migration" if args.command == 'migrate' else ""))
+    _print_report(report(client))
+    if args.command == 'migrate':
+        for name in PARTITIONED_TABLES:
+            migrate_table(client, schema_registry.get(name))
+        print("Bytes processed after migration")
+        _print_report(report(client))